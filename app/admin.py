@@ -1,32 +1,44 @@
 # admin.py
 import streamlit as st
 import pandas as pd
-from app import utils
+import pyarrow.compute as pc
+import altair as alt
+from app import utils, analytics, events, export, importer, metrics
 from datetime import datetime, timedelta, date as dt_date
 
-@st.cache_data(ttl=300)
+@metrics.cached("timeslots_admin", ttl=events.CACHE_TTL)
 def get_timeslots_admin():
     return utils.list_timeslots()
 
-@st.cache_data(ttl=300)
+@metrics.cached("closed_map", ttl=events.CACHE_TTL)
 def get_closed_map(week_start_iso):
+    # (дата, время) -> маска закрытых дорожек
     week_start = datetime.fromisoformat(week_start_iso).date()
-    week_dates = [week_start + timedelta(days=i) for i in range(7)]
-    closed_map = {}
-    for single_date in week_dates:
-        for item in utils.list_closed_slots(single_date):
-            closed_map[(item["date"], item["time"])] = item["id"]
-    return closed_map
-
-@st.cache_data(ttl=300)
+    return utils.closed_lane_masks(week_start, week_start + timedelta(days=6))
+
+@metrics.cached("analytics", ttl=600)
+def get_analytics(date_from_iso, date_to_iso):
+    return analytics.utilization_report(
+        dt_date.fromisoformat(date_from_iso), dt_date.fromisoformat(date_to_iso))
+
+@metrics.cached("booking_map", ttl=events.CACHE_TTL)
 def get_booking_map(week_start_iso):
     week_start = datetime.fromisoformat(week_start_iso).date()
-    booking_map = set()
-    for i in range(7):
-        single_date = week_start + timedelta(days=i)
-        for b in utils.list_all_bookings_for_date(single_date):
-            booking_map.add((b["date"], b["time"]))
-    return booking_map
+    occupancy = utils.week_occupancy(week_start, week_start + timedelta(days=6))
+    return {key for key, (booked, _, _) in occupancy.items() if booked}
+
+@events.subscribe("occupancy")
+def _drop_week_maps(weeks):
+    if weeks is None:
+        get_closed_map.clear()
+        get_booking_map.clear()
+    for week_iso in weeks or ():
+        get_closed_map.clear(week_iso)
+        get_booking_map.clear(week_iso)
+
+@events.subscribe("timeslots")
+def _drop_timeslots(weeks):
+    get_timeslots_admin.clear()
 
 def admin_page():
     st.sidebar.title("Администрирование")
@@ -35,7 +47,10 @@ def admin_page():
         "Тренеры",
         "Расписание тренеров",
         "Пользователи",
-        "Бронирования"
+        "Бронирования",
+        "Аналитика",
+        "Экспорт",
+        "Импорт"
     ])
 
     if section == "Слоты":
@@ -48,6 +63,12 @@ def admin_page():
         manage_users()
     elif section == "Бронирования":
         manage_bookings()
+    elif section == "Аналитика":
+        show_analytics()
+    elif section == "Экспорт":
+        export_data()
+    elif section == "Импорт":
+        import_data()
 
 #  Недельный календарь для закрытых слотов
 def manage_timeslots():
@@ -61,14 +82,10 @@ def manage_timeslots():
     with nav1:
         if st.button("<< Предыдущая неделя", key="admin_prev_week"):
             st.session_state.week_start_admin -= timedelta(days=7)
-            get_closed_map.clear()
-            get_booking_map.clear()
             utils.safe_rerun()
     with nav2:
         if st.button("Следующая неделя >>", key="admin_next_week"):
             st.session_state.week_start_admin += timedelta(days=7)
-            get_closed_map.clear()
-            get_booking_map.clear()
             utils.safe_rerun()
     with nav3:
         picked = st.date_input(
@@ -88,8 +105,6 @@ def manage_timeslots():
         """, unsafe_allow_html=True)
         if picked != st.session_state.week_start_admin:
             st.session_state.week_start_admin = picked - timedelta(days=picked.weekday())
-            get_closed_map.clear()
-            get_booking_map.clear()
             utils.safe_rerun()
 
     week_start_iso = st.session_state.week_start_admin.isoformat()
@@ -103,56 +118,133 @@ def manage_timeslots():
     closed_map = get_closed_map(week_start_iso)
     booking_map = get_booking_map(week_start_iso)
 
-    # Таблица — заголовки
-    header_cols = st.columns([1] + [1]*7)
-    header_cols[0].write("Время")
-    for idx, label in enumerate(day_labels):
-        header_cols[idx+1].write(label)
+    # Набор правок: (дата, время) -> True (закрыть) / False (открыть), копится между неделями
+    changes = st.session_state.setdefault("closed_changes", {})
 
+    st.markdown("#### Редактирование (отметьте закрытые слоты)")
+    baseline = pd.DataFrame(
+        {label: [(d, t) in closed_map for t in timeslots] for d, label in zip(week_dates, day_labels)},
+        index=timeslots,
+    )
+    for (d, t), value in changes.items():
+        if d in week_dates and t in timeslots:
+            baseline.at[t, day_labels[week_dates.index(d)]] = value
+    edited = st.data_editor(
+        baseline,
+        key=f"closed_editor_{week_start_iso}",
+        column_config={label: st.column_config.CheckboxColumn(label, width="small") for label in day_labels},
+        use_container_width=True,
+    )
+    for d, label in zip(week_dates, day_labels):
+        for t in timeslots:
+            value = bool(edited.at[t, label])
+            if value == ((d, t) in closed_map):
+                changes.pop((d, t), None)
+            else:
+                changes[(d, t)] = value
+
+    # Обзор недели: текущее состояние + неприменённые правки
+    cell_html = ""
     for t in timeslots:
-        row_cols = st.columns([1] + [1]*7)
-        row_cols[0].write(t)
-        for idx, single_date in enumerate(week_dates):
-            cell_key = f"cell_admin_{single_date}_{t}"
-            if (single_date, t) in closed_map:
-                if row_cols[idx+1].button("❌", key=cell_key):
-                    utils.remove_closed_slot(closed_map[(single_date, t)])
-                    get_closed_map.clear()
-                    get_booking_map.clear()
-                    st.success(f"Время {t} на {single_date} снова доступно")
-                    utils.safe_rerun()
-            elif (single_date, t) in booking_map:
-                row_cols[idx+1].write("📌")
+        cell_html += f"<tr><td>{t}</td>"
+        for d in week_dates:
+            if (d, t) in changes:
+                mark = "🕒❌" if changes[(d, t)] else "🕒✅"
+            elif (d, t) in closed_map:
+                mask = closed_map[(d, t)]
+                mark = "❌" if mask == utils.FULL_LANE_MASK else "❌" + ",".join(map(str, utils.lanes_from_mask(mask)))
+            elif (d, t) in booking_map:
+                mark = "📌"
             else:
-                row_cols[idx+1].write("")
+                mark = ""
+            cell_html += f"<td>{mark}</td>"
+        cell_html += "</tr>"
+    st.markdown(
+        "<style>.closed-table td,.closed-table th{border:1px solid #e0e0e0;text-align:center;font-size:13px;padding:2px 4px;}</style>"
+        "<table class='closed-table' style='width:100%;border-collapse:collapse;'><tr><th>Время</th>"
+        + "".join(f"<th>{label}</th>" for label in day_labels) + "</tr>" + cell_html + "</table>",
+        unsafe_allow_html=True,
+    )
+    st.caption("❌ закрыто (с номерами — только эти дорожки), 📌 есть бронирования, 🕒 — правка ещё не применена")
+
+    if changes:
+        to_close = sorted(k for k, v in changes.items() if v)
+        to_open = sorted(k for k, v in changes.items() if not v)
+        st.info(f"Неприменённых правок: закрыть {len(to_close)}, открыть {len(to_open)}")
+        affected = utils.bookings_in_slots(to_close)
+        if affected:
+            st.warning(f"Закрытие заденет бронирования: {len(affected)}")
+            st.dataframe(pd.DataFrame(affected), hide_index=True)
+        apply_cols = st.columns([1, 1, 2])
+        with apply_cols[2]:
+            changes_comment = st.text_input("Комментарий к закрытию", key="closed_changes_comment", max_chars=50)
+        with apply_cols[0]:
+            if st.button("Применить правки", key="apply_closed_changes"):
+                res = utils.apply_closed_changes(to_close, to_open, changes_comment)
+                weeks = {(d - timedelta(days=d.weekday())).isoformat() for d, _ in changes}
+                for week_iso in weeks:
+                    st.session_state.pop(f"closed_editor_{week_iso}", None)
+                changes.clear()
+                st.success(f"Закрыто строк: {res['added']}, открыто: {res['removed']}")
+                utils.safe_rerun()
+        with apply_cols[1]:
+            if st.button("Сбросить правки", key="reset_closed_changes"):
+                for week_iso in {(d - timedelta(days=d.weekday())).isoformat() for d, _ in changes}:
+                    st.session_state.pop(f"closed_editor_{week_iso}", None)
+                changes.clear()
+                utils.safe_rerun()
 
     st.markdown("---")
-    st.markdown("#### Добавить новое закрытое время")
-    add_cols = st.columns([1, 1, 2])
+    st.markdown("#### Закрыть время (период, диапазон слотов, дорожки)")
+    add_cols = st.columns([1, 1, 1, 1])
     with add_cols[0]:
-        add_date = st.date_input(
-            label="Дата",
+        add_from = st.date_input(
+            label="С даты",
             value=dt_date.today(),
             key="add_closed_date_admin",
             format="DD.MM.YYYY"
         )
     with add_cols[1]:
+        add_to = st.date_input(
+            label="По дату",
+            value=add_from,
+            key="add_closed_date_to_admin",
+            format="DD.MM.YYYY"
+        )
+    with add_cols[2]:
         add_time = st.selectbox(
-            label="Время",
+            label="Время с",
             options=timeslots,
             key="add_closed_time_admin"
         )
-    with add_cols[2]:
+    with add_cols[3]:
+        add_time_to = st.selectbox(
+            label="Время по",
+            options=timeslots,
+            index=timeslots.index(add_time),
+            key="add_closed_time_to_admin"
+        )
+    lane_cols = st.columns([2, 2])
+    with lane_cols[0]:
+        all_lanes = list(range(1, utils.NUM_LANES + 1))
+        add_lanes = st.multiselect("Дорожки", all_lanes, default=all_lanes, key="add_closed_lanes_admin")
+    with lane_cols[1]:
         add_comment = st.text_input("Комментарий (необязательно)", key="add_closed_comment_admin", max_chars=50)
 
-    if st.button("Добавить закрытое время"):
-        ok = utils.add_closed_slot(add_date, add_time, add_comment)
-        if ok:
-            get_closed_map.clear()
-            st.success(f"Время {add_time} на {add_date} закрыто")
-            utils.safe_rerun()
+    if st.button("Закрыть время"):
+        if add_from > add_to or timeslots.index(add_time) > timeslots.index(add_time_to):
+            st.error("Начало периода не может быть позже конца!")
+        elif not add_lanes:
+            st.error("Выберите хотя бы одну дорожку.")
         else:
-            st.warning("Такое закрытое время уже существует.")
+            res = utils.close_slots(add_from, add_to, add_time, add_time_to, add_lanes, add_comment)
+            if res["added"]:
+                st.success(f"Закрыто слотов (дорожка × время): {res['added']}")
+            else:
+                st.warning("Всё выбранное время уже закрыто.")
+            if res["collisions"]:
+                st.warning(f"Под закрытие попали бронирования: {len(res['collisions'])}")
+                st.dataframe(pd.DataFrame(res["collisions"]), hide_index=True)
 
 #  Управление тренерами и прочее
 def manage_trainers():
@@ -188,7 +280,6 @@ def manage_trainers():
 def manage_trainer_schedule():
     st.subheader("Управление расписанием тренеров")
     st.session_state.setdefault("show_add_trainer_schedule", False)
-    schedules = utils.list_trainer_schedule()
     day_names = ["Пн","Вт","Ср","Чт","Пт","Сб","Вс"]
     trainers = utils.list_trainers()
     timeslots = get_timeslots_admin()
@@ -197,12 +288,8 @@ def manage_trainer_schedule():
     filter_trainer = st.selectbox("Фильтр по тренеру", ["Все"] + trainers, key="filter_trainer_schedule")
 
     # --- Построение таблицы расписания ---
-    # Словарь: (день, время) -> [тренеры]
-    slot_map = {}
-    for row in schedules:
-        if filter_trainer != "Все" and row["trainer"] != filter_trainer:
-            continue
-        slot_map.setdefault((row["day_of_week"], row["time"]), []).append(row)
+    # Словарь: (день, время) -> [записи]
+    slot_map = utils.get_trainer_schedule_matrix(None if filter_trainer == "Все" else filter_trainer)
 
     st.markdown("#### Таблица расписания")
     table_html = """
@@ -223,145 +310,321 @@ def manage_trainer_schedule():
             slot = slot_map.get((d, t), [])
             cell = ""
             for s in slot:
-                trainer_info = utils.get_trainer_by_name(s['trainer'])
-                if trainer_info:
-                    short_fio = f"{trainer_info['last_name']} {trainer_info['first_name'][0]}."
-                    if trainer_info['middle_name']:
-                        short_fio += f"{trainer_info['middle_name'][0]}."
-                else:
-                    short_fio = s['trainer']
-                cell += f"<span class='sch-trainer'>{short_fio} <span class='sch-del' title='Удалить' data-id='{s['id']}'>🗑️</span></span>"
+                cell += f"<span class='sch-trainer'>{s.short_fio} <span class='sch-del' title='Удалить' data-id='{s.id}'>🗑️</span></span>"
             table_html += f"<td>{cell}</td>"
         table_html += "</tr>"
     table_html += "</table>"
     st.markdown(table_html, unsafe_allow_html=True)
-    st.info("Для удаления тренера из времени используйте 🗑️. (Добавление — через форму ниже)")
+    st.info("Добавление и удаление записей — через форму ниже.")
 
-    # --- Старая форма массового добавления ---
+    # --- Форма массового редактирования ---
     st.markdown("---")
     if not st.session_state["show_add_trainer_schedule"]:
-        if st.button("Добавить расписание"):
+        if st.button("Изменить расписание"):
             st.session_state["show_add_trainer_schedule"] = True
 
     if st.session_state["show_add_trainer_schedule"]:
-        st.markdown("#### Массовое добавление записей в расписание")
+        st.markdown("#### Массовое изменение расписания")
         if not trainers:
             st.warning("Сначала добавьте хотя бы одного тренера в разделе «Тренеры».")
         else:
+            full_days = ["Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье"]
             trainer = st.selectbox("Тренер", trainers, key="new_sch_trainer")
-            day = st.selectbox("День недели", ["Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье"], key="new_sch_day")
+            days = st.multiselect("Дни недели", full_days, default=full_days[:5], key="new_sch_days")
             col_time1, col_time2 = st.columns(2)
             with col_time1:
                 start_time = st.selectbox("Время начала", timeslots, key="new_sch_time_start")
             with col_time2:
                 end_time = st.selectbox("Время конца", timeslots, index=len(timeslots)-1, key="new_sch_time_end")
-            dow_map = {name: idx for idx, name in enumerate(["Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье"])}
+            modes = {"Добавить": "add", "Удалить": "remove", "Заменить в выбранные дни": "replace"}
+            mode = st.radio("Действие", list(modes), horizontal=True, key="new_sch_mode")
 
             col_btn1, col_btn2 = st.columns([1,1])
             with col_btn1:
-                if st.button("Добавить", key="add_trainer_schedule_btn"):
-                    start_idx = timeslots.index(start_time)
-                    end_idx = timeslots.index(end_time)
-                    if start_idx > end_idx:
+                if st.button("Применить", key="add_trainer_schedule_btn"):
+                    if timeslots.index(start_time) > timeslots.index(end_time):
                         st.warning("Время начала не может быть позже времени конца!")
+                    elif not days:
+                        st.warning("Выберите хотя бы один день недели.")
                     else:
-                        ok_all = True
-                        for tt in timeslots[start_idx:end_idx+1]:
-                            ok = utils.add_trainer_schedule(trainer, dow_map[day], tt)
-                            ok_all = ok_all and ok
-                        if ok_all:
-                            st.success("Записи добавлены в расписание")
+                        res = utils.update_trainer_schedule(
+                            trainer, [full_days.index(d) for d in days], start_time, end_time, modes[mode]
+                        )
+                        if res is None:
+                            st.warning("Тренер не найден.")
                         else:
-                            st.warning("Некоторые записи уже существуют или возникла ошибка.")
-                        st.session_state["show_add_trainer_schedule"] = False
-                        utils.safe_rerun()
+                            st.success(f"Добавлено записей: {res[0]}, удалено: {res[1]}")
+                            st.session_state["show_add_trainer_schedule"] = False
+                            utils.safe_rerun()
             with col_btn2:
                 if st.button("Отмена", key="cancel_trainer_schedule"):
                     st.session_state["show_add_trainer_schedule"] = False
                     utils.safe_rerun()
 
+USERS_PAGE_SIZE = 50
+USER_SORT_OPTIONS = {
+    "По дате регистрации": "id",
+    "По логину": "username",
+    "По фамилии": "last_name",
+    "По email": "email",
+    "По роли": "role",
+}
+
 def manage_users():
     st.subheader("Список пользователей")
-    users = utils.list_users()
-    df = pd.DataFrame(users)
-    search = st.text_input("Поиск", key="user_search")
-    if search:
-        mask = df.apply(lambda row: row.astype(str).str.contains(search, case=False).any(), axis=1)
-        df = df[mask]
-    if df.empty:
+    f1, f2, f3, f4 = st.columns([3, 2, 2, 2])
+    with f1:
+        search = st.text_input("Поиск", key="user_search")
+    with f2:
+        role_label = st.selectbox("Роль", ["Все", "user", "org", "admin"], key="user_role_filter")
+    with f3:
+        sort_label = st.selectbox("Сортировка", list(USER_SORT_OPTIONS), key="user_sort")
+    with f4:
+        pending_only = st.checkbox("Ожидают подтверждения", key="user_pending_only")
+
+    filters = dict(
+        search=search or None,
+        role=None if role_label == "Все" else role_label,
+        confirmed=False if pending_only else None,
+    )
+    total = utils.count_users(**filters)
+    if not total:
         st.info("Нет пользователей по вашему запросу.")
         return
 
-    header_cols = st.columns([3,2,2,3,2,2,2,2,2])
-    headers = [
-        "Логин", "Имя", "Фамилия", "Email", "Телефон", "Роль", "Статус", "Подтвердить", "Удалить"
-    ]
-    for col, text in zip(header_cols, headers):
-        col.write(text)
-
-    for _, row in df.iterrows():
-        with st.container():
-            cols = st.columns([3,2,2,3,2,2,2,2,2])
-            with cols[0]:
-                st.write(row["username"])
-            with cols[1]:
-                st.write(row["first_name"])
-            with cols[2]:
-                st.write(row["last_name"])
-            with cols[3]:
-                st.write(row["email"])
-            with cols[4]:
-                st.write(row["phone"])
-            with cols[5]:
-                st.write(row["role"])
-            with cols[6]:
-                st.write("Подтвержден" if row["is_confirmed"] else "Ожидает подтверждения")
-            with cols[7]:
-                if not row["is_confirmed"]:
-                    if st.button("✅", key=f"confirm_{row['id']}"):
-                        utils.confirm_user(row["id"])
-                        get_closed_map.clear()
-                        get_booking_map.clear()
-                        st.success(f"Пользователь {row['username']} подтвержден")
-                        utils.safe_rerun()
-            with cols[8]:
-                if row["username"] != "admin":
-                    if st.button("🗑️", key=f"delete_{row['id']}"):
-                        utils.remove_user(row["id"])
-                        st.success(f"Пользователь {row['username']} удален")
-                        utils.safe_rerun()
+    pages = (total - 1) // USERS_PAGE_SIZE + 1
+    page = st.number_input(f"Страница (из {pages})", min_value=1, max_value=pages, value=1, step=1, key="user_page")
+    users = utils.list_users(
+        **filters,
+        sort=USER_SORT_OPTIONS[sort_label],
+        offset=(page - 1) * USERS_PAGE_SIZE,
+        limit=USERS_PAGE_SIZE,
+        as_arrow=True,
+    )
+    status = pc.if_else(pc.equal(users["is_confirmed"], 1), "Подтвержден", "Ожидает подтверждения")
+    st.caption(f"Найдено: {total}")
+    event = st.dataframe(
+        users.select(["username", "first_name", "last_name", "email", "phone", "role"])
+        .append_column("Статус", status)
+        .rename_columns(["Логин", "Имя", "Фамилия", "Email", "Телефон", "Роль", "Статус"]),
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key="users_table",
+    )
+    selected = users.take(event.selection.rows).to_pylist()
+    if not selected:
+        return
+
+    to_confirm = [u["id"] for u in selected if not u["is_confirmed"]]
+    to_delete = [u["id"] for u in selected if u["username"] != "admin"]
+    act1, act2 = st.columns([1, 1])
+    with act1:
+        if to_confirm and st.button(f"✅ Подтвердить выбранных ({len(to_confirm)})", key="confirm_selected_users"):
+            n = utils.confirm_users(to_confirm)
+            st.success(f"Подтверждено пользователей: {n}")
+            utils.safe_rerun()
+    with act2:
+        if to_delete and st.button(f"🗑️ Удалить выбранных ({len(to_delete)})", key="delete_selected_users"):
+            n = utils.remove_users(to_delete)
+            st.success(f"Удалено пользователей: {n}")
+            utils.safe_rerun()
 
 def manage_bookings():
     st.subheader("Бронирования на выбранный день")
     sel_date = st.date_input("Дата", value=dt_date.today(), key="admin_bookings_date")
-    all_bookings = utils.list_all_bookings_for_date(sel_date)
-    if not all_bookings:
+    all_bookings = utils.list_all_bookings_for_date(sel_date, as_arrow=True)
+    if not all_bookings.num_rows:
         st.info("На выбранный день нет бронирований.")
+    else:
+        event = st.dataframe(
+            all_bookings.select(["user", "date", "time", "lane", "trainer", "id"])
+            .rename_columns(["Пользователь", "Дата", "Время", "Дорожка", "Тренер", "ID"]),
+            hide_index=True,
+            use_container_width=True,
+            on_select="rerun",
+            selection_mode="multi-row",
+            key="bookings_table",
+        )
+        selected_ids = all_bookings["id"].take(event.selection.rows).to_pylist()
+        if selected_ids and st.button(f"🗑️ Удалить выбранные ({len(selected_ids)})", key="admin_del_selected_bookings"):
+            n = utils.remove_bookings(selected_ids)
+            st.success(f"Удалено бронирований: {n}")
+            utils.safe_rerun()
+
+    st.markdown("---")
+    st.markdown("#### Снять все бронирования за период")
+    range_cols = st.columns([1, 1, 2])
+    with range_cols[0]:
+        date_from = st.date_input("С", value=sel_date, key="admin_bulk_del_from", format="DD.MM.YYYY")
+    with range_cols[1]:
+        date_to = st.date_input("По", value=sel_date, key="admin_bulk_del_to", format="DD.MM.YYYY")
+    with range_cols[2]:
+        sure = st.checkbox("Подтверждаю удаление всех бронирований за период", key="admin_bulk_del_sure")
+    if st.button("Удалить за период", key="admin_bulk_del_btn", disabled=not sure):
+        if date_from > date_to:
+            st.error("Дата начала не может быть позже даты конца!")
+        else:
+            n = utils.remove_bookings(date_from=date_from, date_to=date_to)
+            st.success(f"Удалено бронирований: {n}")
+            utils.safe_rerun()
+
+#  Выгрузка для бухгалтерии
+EXPORT_KINDS = {"Бронирования": "bookings", "Групповые бронирования": "groups", "Пользователи": "users"}
+
+def export_data():
+    st.subheader("Экспорт данных")
+    cols = st.columns([2, 1, 1, 1])
+    with cols[0]:
+        kind = EXPORT_KINDS[st.selectbox("Что выгрузить", list(EXPORT_KINDS), key="export_kind")]
+    with cols[1]:
+        date_from = st.date_input("С", value=dt_date.today().replace(day=1), key="export_from",
+                                  format="DD.MM.YYYY", disabled=kind == "users")
+    with cols[2]:
+        date_to = st.date_input("По", value=dt_date.today(), key="export_to",
+                                format="DD.MM.YYYY", disabled=kind == "users")
+    with cols[3]:
+        fmt = st.radio("Формат", list(export.FORMATS), horizontal=True, key="export_fmt")
+    if date_from > date_to:
+        st.error("Дата начала не может быть позже даты конца!")
+        return
+    # download_button принимает только bytes/BytesIO и хранит файл в памяти сервера целиком,
+    # поэтому период ограничен; потоковая выгрузка без ограничений — python -m app.manage export
+    if kind != "users" and (date_to - date_from).days >= export.UI_MAX_DAYS:
+        st.error(f"Из админки — не больше {export.UI_MAX_DAYS} дней. Весь период выгружается из консоли: "
+                 f"python -m app.manage export {kind} --from {date_from} --to {date_to}")
         return
 
-    header_cols = st.columns([2,2,2,2,2,2,1])
-    headers = [
-        "Пользователь", "Дата", "Время", "Дорожка", "Тренер", "ID", "Удалить"
-    ]
-    for col, text in zip(header_cols, headers):
-        col.write(text)
-
-    for row in all_bookings:
-        cols = st.columns([2,2,2,2,2,2,1])
-        with cols[0]:
-            st.write(row["user"])
-        with cols[1]:
-            st.write(str(row["date"]))
-        with cols[2]:
-            st.write(row["time"])
-        with cols[3]:
-            st.write(row["lane"])
-        with cols[4]:
-            st.write(row["trainer"])
-        with cols[5]:
-            st.write(row["id"])
-        with cols[6]:
-            if st.button("🗑️", key=f"admin_del_booking_{row['id']}"):
-                utils.remove_booking(row["id"])
-                st.success("Бронирование удалено")
-                utils.safe_rerun()
+    if st.button("Подготовить файл", key="export_prepare"):
+        st.download_button(
+            "⬇️ Скачать",
+            data=b"".join(export.iter_export(kind, fmt, date_from, date_to)),
+            file_name=export.export_filename(kind, fmt, date_from, date_to),
+            mime=export.FORMATS[fmt],
+            on_click="ignore",
+            key="export_download",
+        )
+
+#  Массовая загрузка из файла
+IMPORT_KINDS = {"Пользователи": "users", "Тренеры": "trainers", "Бронирования": "bookings"}
+
+def import_data():
+    st.subheader("Импорт из CSV/Parquet")
+    kind = IMPORT_KINDS[st.selectbox("Что загрузить", list(IMPORT_KINDS), key="import_kind")]
+    required, optional = importer.IMPORT_COLUMNS[kind]
+    st.caption(f"Обязательные колонки: {', '.join(required)}. "
+               f"Необязательные: {', '.join(f'{c} (по умолчанию «{v}»)' for c, v in optional.items())}.")
+    upload = st.file_uploader("Файл", type=["csv", "parquet"], key="import_file")
+    if upload is None or not st.button("Загрузить", key="import_run"):
+        return
+    try:
+        with st.spinner("Проверка и загрузка…"):
+            report = importer.import_file(kind, upload)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    st.success(f"Строк в файле: {report['total']}, добавлено: {report['inserted']}.")
+    if report["skipped"]:
+        st.warning(f"Пропущено {report['skipped']} строк: их добавили параллельно с загрузкой.")
+    errors = report["errors"]
+    if not errors.empty:
+        st.error(f"Отклонено строк: {len(errors)}")
+        st.dataframe(errors.rename(columns={"row": "Строка", "error": "Ошибка"}),
+                     hide_index=True, use_container_width=True)
+        st.download_button("⬇️ Отчёт об ошибках", errors.to_csv(index=False).encode("utf-8-sig"),
+                           file_name=f"{kind}_errors.csv", mime="text/csv", on_click="ignore",
+                           key="import_errors_download")
+
+#  Аналитика загрузки
+def show_analytics():
+    st.subheader("Аналитика загрузки")
+    today = dt_date.today()
+    cols = st.columns([1, 1, 2])
+    with cols[0]:
+        date_from = st.date_input("С", value=today.replace(day=1) - timedelta(days=365),
+                                  key="analytics_from", format="DD.MM.YYYY")
+    with cols[1]:
+        date_to = st.date_input("По", value=today, key="analytics_to", format="DD.MM.YYYY")
+    if date_from > date_to:
+        st.error("Дата начала не может быть позже даты конца!")
+        return
+
+    report = get_analytics(date_from.isoformat(), date_to.isoformat())
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Бронирований", report["total"])
+    m2.metric("С тренером", report["with_trainer"])
+    lanes = report["by_lane"]
+    m3.metric("Средняя загрузка", f"{lanes['bookings'].sum() / max(lanes['capacity'].sum(), 1):.0%}")
+
+    pct = alt.Axis(format="%")
+    st.markdown("#### Загрузка по дням недели и часам")
+    st.altair_chart(
+        alt.Chart(report["heatmap"]).mark_rect().encode(
+            x=alt.X("time:O", title="Время"),
+            y=alt.Y("day:O", title=None, sort=analytics.WEEKDAYS),
+            color=alt.Color("utilization:Q", title="Загрузка", legend=alt.Legend(format="%")),
+            tooltip=["day", "time", "bookings", "capacity", alt.Tooltip("utilization:Q", format=".0%")],
+        ),
+        use_container_width=True,
+    )
+
+    c1, c2 = st.columns(2)
+    with c1:
+        st.markdown("#### По дорожкам")
+        st.altair_chart(
+            alt.Chart(lanes).mark_bar().encode(
+                x=alt.X("lane:O", title="Дорожка"),
+                y=alt.Y("utilization:Q", title="Загрузка", axis=pct),
+                tooltip=["lane", "bookings", "capacity"],
+            ),
+            use_container_width=True,
+        )
+    with c2:
+        st.markdown("#### По часам")
+        st.altair_chart(
+            alt.Chart(report["by_hour"]).mark_bar().encode(
+                x=alt.X("time:O", title="Время"),
+                y=alt.Y("utilization:Q", title="Загрузка", axis=pct),
+                tooltip=["time", "bookings", "capacity"],
+            ),
+            use_container_width=True,
+        )
+
+    st.markdown("#### Физ. лица и организации по месяцам")
+    if report["monthly"].empty:
+        st.info("За период нет бронирований.")
+    else:
+        st.altair_chart(
+            alt.Chart(report["monthly"]).mark_bar().encode(
+                x=alt.X("yearmonth(month):O", title="Месяц"),
+                y=alt.Y("bookings:Q", title="Бронирований", stack="normalize", axis=pct),
+                color=alt.Color("role:N", title=None),
+                tooltip=[alt.Tooltip("yearmonth(month):O", title="Месяц"), "role", "bookings"],
+            ),
+            use_container_width=True,
+        )
+
+    c3, c4 = st.columns(2)
+    with c3:
+        st.markdown("#### Загрузка тренеров")
+        st.dataframe(
+            report["trainers"].rename(columns={
+                "trainer": "Тренер", "scheduled": "Часов в расписании",
+                "booked": "Занято", "load": "Загрузка",
+            }),
+            hide_index=True,
+            use_container_width=True,
+            column_config={"Загрузка": st.column_config.ProgressColumn(format="percent", min_value=0, max_value=1)},
+        )
+    with c4:
+        st.markdown("#### Наименее загруженные слоты")
+        st.dataframe(
+            report["low_demand"].rename(columns={
+                "day": "День", "time": "Время", "bookings": "Бронирований",
+                "capacity": "Ёмкость", "utilization": "Загрузка",
+            }),
+            hide_index=True,
+            use_container_width=True,
+            column_config={"Загрузка": st.column_config.ProgressColumn(format="percent", min_value=0, max_value=1)},
+        )
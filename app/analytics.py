@@ -0,0 +1,139 @@
+# analytics.py — отчёты по загрузке бассейна
+#
+# Агрегация делается в SQL (GROUP BY дата/слот/дорожка/тренер), до pandas доходят
+# уже свёрнутые строки — не больше «дни × слоты × дорожки» за период.
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+
+from app.db import Booking, ClosedSlot, Lane, Timeslot, Trainer, TrainerSchedule, User, history_model
+from app.utils import NUM_LANES, short_fio, with_report_session
+
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+ROLE_LABELS = {"user": "Физ. лица", "org": "Организации", "admin": "Админ"}
+
+
+def _weekday_counts(date_from, date_to) -> np.ndarray:
+    """Сколько раз каждый день недели (0=Пн) встречается в периоде."""
+    days = pd.date_range(date_from, date_to, freq="D")
+    return np.bincount(days.weekday, minlength=7)
+
+
+def _bookings_frame(db, date_from, date_to) -> pd.DataFrame:
+    bookings = history_model(db, Booking, date_from)
+    rows = (
+        db.query(bookings.date, Timeslot.time, Lane.number, User.role,
+                 func.count(bookings.id), func.count(bookings.trainer_id))
+        .join(Timeslot, bookings.timeslot_id == Timeslot.id)
+        .join(Lane, bookings.lane_id == Lane.id)
+        .join(User, bookings.user_id == User.id)
+        .filter(bookings.date.between(date_from, date_to))
+        .group_by(bookings.date, Timeslot.time, Lane.number, User.role)
+        .all()
+    )
+    df = pd.DataFrame(rows, columns=["date", "time", "lane", "role", "bookings", "with_trainer"])
+    df["date"] = pd.to_datetime(df["date"])
+    df["time"] = df["time"].map(lambda t: t.strftime("%H:%M"))
+    return df
+
+
+def _closed_frame(db, date_from, date_to) -> pd.DataFrame:
+    closed = history_model(db, ClosedSlot, date_from)
+    rows = (
+        db.query(closed.date, Timeslot.time, Lane.number)
+        .join(Timeslot, closed.timeslot_id == Timeslot.id)
+        .join(Lane, closed.lane_id == Lane.id)
+        .filter(closed.date.between(date_from, date_to))
+        .all()
+    )
+    df = pd.DataFrame(rows, columns=["date", "time", "lane"])
+    df["date"] = pd.to_datetime(df["date"])
+    df["time"] = df["time"].map(lambda t: t.strftime("%H:%M"))
+    return df
+
+
+def _trainer_frame(db, date_from, date_to, weekday_counts) -> pd.DataFrame:
+    bookings = history_model(db, Booking, date_from)
+    booked = dict(
+        db.query(bookings.trainer_id, func.count(bookings.id))
+        .filter(bookings.trainer_id.isnot(None), bookings.date.between(date_from, date_to))
+        .group_by(bookings.trainer_id)
+        .all()
+    )
+    scheduled = (
+        db.query(Trainer.id, Trainer.last_name, Trainer.first_name, Trainer.middle_name,
+                 TrainerSchedule.day_of_week, func.count(TrainerSchedule.id))
+        .outerjoin(TrainerSchedule, TrainerSchedule.trainer_id == Trainer.id)
+        .group_by(Trainer.id, Trainer.last_name, Trainer.first_name, Trainer.middle_name,
+                  TrainerSchedule.day_of_week)
+        .all()
+    )
+    hours, names = {}, {}
+    for tid, last, first, middle, dow, n in scheduled:
+        names[tid] = short_fio(last, first, middle)
+        hours[tid] = hours.get(tid, 0) + (int(weekday_counts[dow]) * n if dow is not None else 0)
+    df = pd.DataFrame({
+        "trainer": [names[tid] for tid in names],
+        "scheduled": [hours[tid] for tid in names],
+        "booked": [booked.get(tid, 0) for tid in names],
+    })
+    df["load"] = np.where(df["scheduled"] > 0, df["booked"] / df["scheduled"].clip(lower=1), 0.0)
+    return df.sort_values("load", ascending=False, ignore_index=True)
+
+
+@with_report_session
+def utilization_report(db, date_from, date_to) -> dict:
+    """Сводка загрузки за период [date_from, date_to]: total, with_trainer и таблицы
+    by_lane, by_hour, heatmap (день недели × время), monthly (физ./юр. лица по месяцам),
+    trainers (часы в расписании и занятые часы) и low_demand (наименее загруженные слоты).
+    Загрузка — доля занятых дорожко-часов от открытых.
+    """
+    weekday_counts = _weekday_counts(date_from, date_to)
+    n_days = int(weekday_counts.sum())
+    times = sorted(t.strftime("%H:%M") for (t,) in db.query(Timeslot.time))
+    bookings = _bookings_frame(db, date_from, date_to)
+    closed = _closed_frame(db, date_from, date_to)
+    bookings["weekday"] = bookings["date"].dt.weekday
+    closed["weekday"] = closed["date"].dt.weekday
+
+    # ёмкость: дни × слоты × дорожки минус закрытые дорожко-часы
+    lanes = np.arange(1, NUM_LANES + 1)
+    by_lane = pd.DataFrame({"lane": lanes})
+    by_lane["bookings"] = bookings.groupby("lane")["bookings"].sum().reindex(lanes, fill_value=0).to_numpy()
+    by_lane["capacity"] = n_days * len(times) - closed.groupby("lane").size().reindex(lanes, fill_value=0).to_numpy()
+
+    by_hour = pd.DataFrame({"time": times})
+    by_hour["bookings"] = bookings.groupby("time")["bookings"].sum().reindex(times, fill_value=0).to_numpy()
+    by_hour["capacity"] = n_days * NUM_LANES - closed.groupby("time").size().reindex(times, fill_value=0).to_numpy()
+
+    grid = pd.MultiIndex.from_product([range(7), times], names=["weekday", "time"])
+    heatmap = pd.DataFrame(index=grid).reset_index()
+    heatmap["bookings"] = bookings.groupby(["weekday", "time"])["bookings"].sum().reindex(grid, fill_value=0).to_numpy()
+    heatmap["capacity"] = (
+        weekday_counts[heatmap["weekday"].to_numpy()] * NUM_LANES
+        - closed.groupby(["weekday", "time"]).size().reindex(grid, fill_value=0).to_numpy()
+    )
+    heatmap = heatmap[heatmap["capacity"] > 0].reset_index(drop=True)
+
+    for df in (by_lane, by_hour, heatmap):
+        df["utilization"] = df["bookings"] / df["capacity"].clip(lower=1)
+    heatmap["day"] = heatmap["weekday"].map(WEEKDAYS.__getitem__)
+
+    monthly = (
+        bookings.assign(month=bookings["date"].dt.to_period("M").dt.to_timestamp(),
+                        role=bookings["role"].map(ROLE_LABELS).fillna(bookings["role"]))
+        .groupby(["month", "role"], as_index=False)["bookings"].sum()
+    )
+
+    low_demand = heatmap.nsmallest(10, "utilization")[["day", "time", "bookings", "capacity", "utilization"]]
+
+    return {
+        "total": int(bookings["bookings"].sum()),
+        "with_trainer": int(bookings["with_trainer"].sum()),
+        "by_lane": by_lane,
+        "by_hour": by_hour,
+        "heatmap": heatmap,
+        "monthly": monthly,
+        "trainers": _trainer_frame(db, date_from, date_to, weekday_counts),
+        "low_demand": low_demand.reset_index(drop=True),
+    }
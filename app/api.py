@@ -0,0 +1,309 @@
+# api.py — JSON API для мобильного приложения и киосков (ASGI, отдельный процесс)
+#
+# Запуск: uvicorn app.api:app --host 0.0.0.0 --port 8600
+# Работает поверх тех же функций utils, что и Streamlit (тот же engine и реплики),
+# кэш доступности сбрасывается теми же событиями (events.py). Вызовы БД синхронные
+# и выполняются в пуле потоков размером с пул соединений engine.
+import asyncio
+import base64
+import contextvars
+import hashlib
+import hmac
+import json
+import re
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import parse_qs
+
+import streamlit as st
+
+from app import events, logs, metrics, utils
+from app.db import ENGINE
+
+TOKEN_TTL = 12 * 3600
+RETRY_AFTER = 5  # секунд; ответ 503 при перегрузке БД
+# без [api] secret в secrets токены живут до перезапуска и только в этом процессе
+_SECRET = (st.secrets.get("api", {}).get("secret") or secrets.token_hex(32)).encode()
+_db_pool = ThreadPoolExecutor(max_workers=ENGINE.pool.size(), thread_name_prefix="api-db")
+_availability: dict[str, tuple[str, bytes]] = {}  # неделя -> (ETag, тело ответа)
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+#  токены: base64(логин:роль:подтверждён:срок).подпись
+def issue_token(user: dict) -> str:
+    claims = f"{user['username']}:{user['role']}:{user['is_confirmed']}:{int(time.time()) + TOKEN_TTL}"
+    body = base64.urlsafe_b64encode(claims.encode()).decode()
+    sig = hmac.new(_SECRET, body.encode(), hashlib.sha256).hexdigest()
+    return f"{body}.{sig}"
+
+
+def _read_token(headers: dict) -> dict:
+    auth = headers.get("authorization", "")
+    if not auth.startswith("Bearer "):
+        raise ApiError(401, "Нужен заголовок Authorization: Bearer <token>")
+    body, _, sig = auth[7:].partition(".")
+    if not hmac.compare_digest(sig, hmac.new(_SECRET, body.encode(), hashlib.sha256).hexdigest()):
+        raise ApiError(401, "Неверный токен")
+    username, role, confirmed, expires = base64.urlsafe_b64decode(body).decode().rsplit(":", 3)
+    if int(expires) < time.time():
+        raise ApiError(401, "Токен истёк")
+    return {"username": username, "role": role, "is_confirmed": int(confirmed)}
+
+
+def _need(params: dict, name: str, parse=str):
+    if name not in params:
+        raise ApiError(400, f"Не указан параметр {name}")
+    try:
+        return parse(params[name])
+    except (TypeError, ValueError):
+        raise ApiError(400, f"Некорректный параметр {name}")
+
+
+def _need_list(params: dict, name: str, parse=str) -> list:
+    values = _need(params, name, lambda v: v if isinstance(v, list) else None)
+    if values is None:
+        raise ApiError(400, f"Параметр {name} должен быть списком")
+    try:
+        return [parse(v) for v in values]
+    except (TypeError, ValueError):
+        raise ApiError(400, f"Некорректный параметр {name}")
+
+
+def _time(value) -> str:
+    return time.strftime("%H:%M", time.strptime(value, "%H:%M"))
+
+
+def _check_timeslots(times) -> None:
+    """Бронировать можно только существующие слоты: иначе utils заведёт новый слот на весь бассейн."""
+    unknown = sorted(set(times) - set(utils.list_timeslots()))
+    if unknown:
+        raise ApiError(400, f"Нет слотов времени: {', '.join(unknown)}")
+
+
+#  обработчики: (user, params, body) -> JSON-совместимый объект
+def login(user, params, body):
+    username, password = _need(body, "username"), _need(body, "password")
+    if not utils.validate_user(username, password):
+        raise ApiError(401, "Неверный логин или пароль")
+    found = utils.get_user(username)
+    return {"token": issue_token(found), "role": found["role"], "expires_in": TOKEN_TTL}
+
+
+def availability_body(week_iso: str) -> tuple[str, bytes]:
+    """Занятость недели в компактном виде: по дню списки масок на каждый слот времени."""
+    if week_iso in _availability:
+        return _availability[week_iso]
+    week_start = date.fromisoformat(week_iso)
+    times = utils.list_timeslots()
+    occupancy = utils.week_occupancy(week_start, week_start + timedelta(days=6))
+    schedule = utils.get_trainer_schedule_matrix()
+    days = []
+    for i in range(7):
+        d = week_start + timedelta(days=i)
+        cells = [occupancy.get((d, t), (0, 0, set())) for t in times]
+        days.append({
+            "date": d.isoformat(),
+            "booked": [c[0] for c in cells],
+            "closed": [c[1] for c in cells],
+            "trainers": [max(len(schedule.get((i, t), ())) - len(c[2]), 0) for t, c in zip(times, cells)],
+        })
+    payload = {"week": week_iso, "lanes": utils.NUM_LANES, "times": times, "days": days}
+    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode()
+    entry = (f'"{hashlib.sha1(body).hexdigest()}"', body)
+    _availability[week_iso] = entry
+    return entry
+
+
+@events.subscribe("occupancy")
+@events.subscribe("timeslots")
+@events.subscribe("schedule")
+@events.subscribe("trainers")
+def _drop_availability(weeks):
+    if weeks is None:
+        _availability.clear()
+    for week_iso in weeks or ():
+        _availability.pop(week_iso, None)
+
+
+def slot_options(user, params, body):
+    opts = utils.get_slot_options(_need(params, "date", date.fromisoformat), _need(params, "time", _time))
+    return {
+        "closed": opts["closed"],
+        "free_lanes": opts["free_lanes"],
+        "closed_lanes": opts["closed_lanes"],
+        "trainers": [
+            {"name": t["name"], "short_fio": t["short_fio"], "busy": t["busy"]} for t in opts["trainers"]
+        ],
+    }
+
+
+def _need_confirmed(user):
+    if not user["is_confirmed"]:
+        raise ApiError(403, "Аккаунт ещё не подтверждён администрацией")
+
+
+def book(user, params, body):
+    _need_confirmed(user)
+    d, t = _need(body, "date", date.fromisoformat), _need(body, "time", _time)
+    lane, trainer = _need(body, "lane", int), body.get("trainer") or None
+    _check_timeslots([t])
+    opts = utils.get_slot_options(d, t)
+    if lane not in opts["free_lanes"]:
+        raise ApiError(409, "Дорожка закрыта или занята")
+    if trainer and not any(tr["name"] == trainer and not tr["busy"] for tr in opts["trainers"]):
+        raise ApiError(409, "Тренер недоступен в это время")
+    if not utils.add_booking(user["username"], d, t, lane, trainer):
+        raise ApiError(409, "Не удалось забронировать: слот уже занят")
+    return {"ok": True}
+
+
+def cancel(user, params, body, booking_id):
+    if utils.booking_owner(int(booking_id)) != user["username"]:
+        raise ApiError(404, "Бронь не найдена")
+    utils.remove_booking(int(booking_id))
+    return {"ok": True}
+
+
+def group_book(user, params, body):
+    if user["role"] != "org":
+        raise ApiError(403, "Групповое бронирование доступно только организациям")
+    _need_confirmed(user)
+    d = _need(body, "date", date.fromisoformat)
+    times, lanes = _need_list(body, "times", _time), _need_list(body, "lanes", int)
+    if not times or not lanes or not all(1 <= l <= utils.NUM_LANES for l in lanes):
+        raise ApiError(400, "Нужны непустые times и lanes")
+    _check_timeslots(times)
+    if not utils.add_org_booking_group(user["username"], d, times, lanes):
+        raise ApiError(409, "Не удалось создать бронирование: время или дорожки заняты")
+    return {"ok": True}
+
+
+def group_cancel(user, params, body, group_id):
+    if utils.booking_owner(int(group_id), group=True) != user["username"]:
+        raise ApiError(404, "Бронирование не найдено")
+    utils.remove_org_booking_group(int(group_id))
+    return {"ok": True}
+
+
+def my_bookings(user, params, body):
+    bookings = [
+        {**b._asdict(), "date": b.date.isoformat()} for b in utils.list_user_bookings(user["username"])
+    ]
+    groups = [
+        {**g._asdict(), "date": g.date.isoformat()} for g in utils.list_org_booking_groups(user["username"])
+    ] if user["role"] == "org" else []
+    return {"bookings": bookings, "groups": groups}
+
+
+# (метод, путь, обработчик, нужен ли токен)
+ROUTES = [
+    ("POST", r"/api/login", login, False),
+    ("GET", r"/api/slot", slot_options, True),
+    ("POST", r"/api/bookings", book, True),
+    ("DELETE", r"/api/bookings/(\d+)", cancel, True),
+    ("POST", r"/api/groups", group_book, True),
+    ("DELETE", r"/api/groups/(\d+)", group_cancel, True),
+    ("GET", r"/api/my/bookings", my_bookings, True),
+]
+_ROUTES = [(method, re.compile(path + "$"), fn, auth) for method, path, fn, auth in ROUTES]
+
+
+#  ASGI
+async def _read_body(receive) -> dict:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    raw = b"".join(chunks)
+    if not raw:
+        return {}
+    try:
+        body = json.loads(raw)
+    except ValueError:
+        raise ApiError(400, "Тело запроса должно быть JSON")
+    if not isinstance(body, dict):
+        raise ApiError(400, "Тело запроса должно быть JSON-объектом")
+    return body
+
+
+async def _send(send, status: int, body: bytes = b"", headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json; charset=utf-8"), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def _json(obj) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode()
+
+
+async def _dispatch(scope, receive) -> tuple[int, bytes, list]:
+    method, path = scope["method"], scope["path"]
+    headers = {k.decode().lower(): v.decode() for k, v in scope.get("headers", [])}
+    params = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+    loop = asyncio.get_running_loop()
+    # read-your-writes по вызывающему, а не на весь процесс (см. utils.caller_key)
+    client = scope.get("client") or ("", 0)
+    utils.caller_key.set(f"api@{client[0]}")
+
+    if method == "GET" and path == "/api/availability":
+        week = _need(params, "week", date.fromisoformat)
+        week_iso = (week - timedelta(days=week.weekday())).isoformat()
+        etag, body = await loop.run_in_executor(_db_pool, contextvars.copy_context().run,
+                                                availability_body, week_iso)
+        cache_headers = [(b"etag", etag.encode()), (b"cache-control", b"no-cache")]
+        if etag in [t.strip() for t in headers.get("if-none-match", "").split(",")]:
+            return 304, b"", cache_headers
+        return 200, body, cache_headers
+
+    for route_method, pattern, fn, need_auth in _ROUTES:
+        match = pattern.match(path)
+        if not match:
+            continue
+        if route_method != method:
+            raise ApiError(405, "Метод не поддерживается")
+        user = _read_token(headers) if need_auth else None
+        body = await _read_body(receive)
+        if user:
+            utils.caller_key.set(f"api:{user['username']}")
+        # run_in_executor не переносит contextvars в поток пула — передаём контекст явно
+        result = await loop.run_in_executor(_db_pool, contextvars.copy_context().run,
+                                            lambda: fn(user, params, body, *match.groups()))
+        return 200, _json(result), []
+    raise ApiError(404, "Не найдено")
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                logs.setup()
+                metrics.start_server(int(st.secrets.get("metrics", {}).get("api_port", metrics.DEFAULT_API_PORT)))
+                events.start_listener()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                _db_pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    try:
+        status, body, headers = await _dispatch(scope, receive)
+    except ApiError as e:
+        status, body, headers = e.status, _json({"error": str(e)}), []
+    except utils.Overloaded:
+        status, body = 503, _json({"error": "Высокая нагрузка, повторите позже"})
+        headers = [(b"retry-after", str(RETRY_AFTER).encode())]
+    await _send(send, status, body, headers)
@@ -1,13 +1,18 @@
 import streamlit as st
-from app import utils
+from app import metrics, utils
 import re
 
+PHONE_RE = r"\+7\d{10}"  # после удаления пробелов и дефисов
+PHONE_STRIP_RE = r"[ -]"
+EMAIL_RE = r"[^@\s]+@[^@\s]+\.[^@\s]+"
+
+
 def is_valid_phone(phone):
-    return bool(re.fullmatch(r"\+7\d{10}", re.sub(r"[ -]", "", phone)))
+    return bool(re.fullmatch(PHONE_RE, re.sub(PHONE_STRIP_RE, "", phone)))
 
 
 def is_valid_email(email):
-    return bool(re.fullmatch(r"[^@\s]+@[^@\s]+\.[^@\s]+", email))
+    return bool(re.fullmatch(EMAIL_RE, email))
 
 
 def login():
@@ -23,7 +28,9 @@ def login():
                                  placeholder="Введите пароль")
 
         if st.button("Войти"):
-            role = utils.validate_user(username, password)
+            with metrics.LOGIN_SECONDS.time():
+                role = utils.validate_user(username, password)
+            metrics.LOGINS.labels("ok" if role else "fail").inc()
             if role:
                 from utils import SessionLocal, User
                 with SessionLocal() as db:
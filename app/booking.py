@@ -1,13 +1,84 @@
 # booking.py
 import streamlit as st
-from app import utils
+from app import events, metrics, utils
 from datetime import timedelta, date as dt_date
 import pandas as pd
 
-@st.cache_data(ttl=300)
+#  кэши сбрасываются событиями из utils (см. events.py), в том числе из других процессов
+@metrics.cached("timeslots", ttl=events.CACHE_TTL)
 def get_timeslots():
     return utils.list_timeslots()
 
+@metrics.cached("week_occupancy", ttl=events.CACHE_TTL)
+def get_week_occupancy(week_start_iso):
+    # (дата, время) -> (маска занятых, маска закрытых, тренеры) — одна выборка из сводки
+    week_start = dt_date.fromisoformat(week_start_iso)
+    return utils.week_occupancy(week_start, week_start + timedelta(days=6))
+
+@metrics.cached("schedule_matrix", ttl=events.CACHE_TTL)
+def get_schedule_matrix():
+    return utils.get_trainer_schedule_matrix()
+
+@metrics.cached("week_grid", ttl=events.CACHE_TTL)
+def get_week_grid_sql(week_start_iso):
+    return utils.week_grid(dt_date.fromisoformat(week_start_iso))
+
+def get_week_grid(week_start):
+    """{(дата, "HH:MM"): (маска занятых, маска закрытых, есть тренер)} — движок по utils.GRID_ENGINE."""
+    if utils.GRID_ENGINE == "sql":
+        return get_week_grid_sql(week_start.isoformat())
+    return utils.assemble_week_grid(
+        week_start, get_timeslots(), get_week_occupancy(week_start.isoformat()), get_schedule_matrix()
+    )
+
+@events.subscribe("occupancy")
+def _drop_week_occupancy(weeks):
+    if weeks is None:
+        get_week_occupancy.clear()
+        get_week_grid_sql.clear()
+    for week_iso in weeks or ():
+        get_week_occupancy.clear(week_iso)
+        get_week_grid_sql.clear(week_iso)
+
+@events.subscribe("timeslots")
+def _drop_timeslots(weeks):
+    get_timeslots.clear()
+    get_week_grid_sql.clear()
+
+@events.subscribe("schedule")
+@events.subscribe("trainers")
+def _drop_schedule(weeks):
+    get_schedule_matrix.clear()
+    get_week_grid_sql.clear()
+
+def my_history():
+    """Прошедшие брони пользователя: подгружаются только по кнопке, по MY_HISTORY_PAGE строк."""
+    shown = st.session_state.get("history_rows", 0)
+    if not shown:
+        if st.button("Показать историю", key="show_history"):
+            st.session_state["history_rows"] = utils.MY_HISTORY_PAGE
+            utils.safe_rerun()
+        return
+    rows = utils.list_user_history(st.session_state["username"], dt_date.today(), limit=shown + 1)
+    if not rows:
+        st.caption("Прошедших бронирований нет.")
+    else:
+        st.dataframe(pd.DataFrame([{
+            "Дата": r.date.strftime("%d.%m.%Y"),
+            "Время": r.time,
+            "Дорожка": r.lane,
+            "Тренер": r.trainer,
+        } for r in rows[:shown]]), hide_index=True, use_container_width=True)
+    hist_cols = st.columns([1, 1])
+    with hist_cols[0]:
+        if len(rows) > shown and st.button("Показать ещё", key="more_history"):
+            st.session_state["history_rows"] = shown + utils.MY_HISTORY_PAGE
+            utils.safe_rerun()
+    with hist_cols[1]:
+        if st.button("Скрыть историю", key="hide_history"):
+            st.session_state["history_rows"] = 0
+            utils.safe_rerun()
+
 def booking_page():
     st.subheader("Бронирование дорожек")
 
@@ -49,19 +120,11 @@ def booking_page():
             d.strftime("%d.%m") + " " + ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][d.weekday()]
             for d in week_dates
         ]
-        my_bookings = utils.list_user_bookings(st.session_state["username"])
-        my_slots = set((b["date"], b["time"]) for b in my_bookings)
-        busy_slots = set()
-        for d in week_dates:
-            all_b = utils.list_all_bookings_for_date(d)
-            for b in all_b:
-                busy_slots.add((b["date"], b["time"]))
-        closed_slots = set()
-        for d in week_dates:
-            for item in utils.list_closed_slots(d):
-                closed_slots.add((item["date"], item["time"]))
-        # Кэшируем все бронирования на неделю для ускорения
-        week_bookings = {d: utils.list_all_bookings_for_date(d) for d in week_dates}
+        my_lanes = {
+            (b.date, b.time, b.lane)
+            for b in utils.list_user_bookings(st.session_state["username"], week_dates[0], week_dates[-1])
+        }
+        grid = get_week_grid(week_start)
         num_lanes = 6  # количество дорожек
         cell_height = 44
         html = """
@@ -83,9 +146,8 @@ def booking_page():
         for t in timeslots:
             html += f"<tr><td>{t}</td>"
             for d in week_dates:
-                key = (d, t)
-                trainers_on_slot = utils.get_scheduled_trainers(d, t)
-                trainer_icon = f"<span class='trainer-ico' title='Работает тренер' style='font-size:16px;'>👨‍🏫</span>" if trainers_on_slot else ""
+                booked, closed_mask, has_trainer = grid.get((d, t), (0, 0, False))
+                trainer_icon = f"<span class='trainer-ico' title='Работает тренер' style='font-size:16px;'>👨‍🏫</span>" if has_trainer else ""
                 lane_html = ""
                 for row in range(3):
                     lane_html += "<div class='lane-num-row'>"
@@ -93,9 +155,9 @@ def booking_page():
                         lane = row*2 + col + 1
                         if lane > num_lanes:
                             continue
-                        my = any(b["date"] == d and b["time"] == t and b["lane"] == lane for b in my_bookings)
-                        closed = (d, t) in closed_slots
-                        busy = any(bk["date"] == d and bk["time"] == t and bk["lane"] == lane for bk in week_bookings[d])
+                        my = (d, t, lane) in my_lanes
+                        closed = bool(closed_mask >> (lane - 1) & 1)
+                        busy = bool(booked >> (lane - 1) & 1)
                         cls = "lane-num "
                         if my:
                             cls += "my"
@@ -116,31 +178,32 @@ def booking_page():
     #  Правая колонка: список броней и форма
     with cols[1]:
         st.markdown("### Мои бронирования")
-        my_bookings = utils.list_user_bookings(st.session_state["username"])
+        # по умолчанию только предстоящие; прошедшие — по кнопке, страницами
+        my_bookings = utils.list_user_bookings(st.session_state["username"], dt_date.today())
         if my_bookings:
-            dfb = pd.DataFrame(my_bookings)
-            for _, row in dfb.iterrows():
+            for row in my_bookings:
                 c1, c2, c3, c4, c5, c6 = st.columns([2, 2, 2, 2, 1, 1])
                 with c1:
-                    st.write(row["date"])
+                    st.write(row.date)
                 with c2:
-                    st.write(row["time"])
+                    st.write(row.time)
                 with c3:
-                    st.write(row["lane"])
+                    st.write(row.lane)
                 with c4:
-                    st.write(row["trainer"] if row["trainer"] else "Без тренера")
+                    st.write(row.trainer if row.trainer else "Без тренера")
                 with c5:
-                    if st.button("🗑️", key=f"del_{row['id']}"):
-                        utils.remove_booking(row["id"])
+                    if st.button("🗑️", key=f"del_{row.id}"):
+                        utils.remove_booking(row.id)
                         st.success("Бронирование удалено")
                         utils.safe_rerun()
                 with c6:
-                    if st.button("✏️", key=f"edit_{row['id']}"):
-                        st.session_state["edit_booking_id"] = row["id"]
+                    if st.button("✏️", key=f"edit_{row.id}"):
+                        st.session_state["edit_booking_id"] = row.id
                         st.session_state["edit_booking_data"] = row
                         st.session_state["show_edit_form"] = True
         else:
-            st.info("У вас нет бронирований.")
+            st.info("У вас нет предстоящих бронирований.")
+        my_history()
 
         # Форма редактирования
         if st.session_state.get("show_edit_form"):
@@ -148,23 +211,27 @@ def booking_page():
             st.markdown("#### Изменить бронирование")
             form_cols = st.columns([2, 2, 2, 2])
             with form_cols[0]:
-                new_date = st.date_input("Дата", value=b["date"], key="edit_date")
+                new_date = st.date_input("Дата", value=b.date, key="edit_date")
             with form_cols[1]:
                 slots = get_timeslots()
-                new_time = st.selectbox("Время", slots, index=slots.index(b["time"]), placeholder="Выберите время")
+                new_time = st.selectbox("Время", slots, index=slots.index(b.time), placeholder="Выберите время")
+            opts = utils.get_slot_options(new_date, new_time)
             with form_cols[2]:
-                busy_lanes, busy_trainers = utils.lane_trainer_status(new_date, new_time)
-                free_lanes = [l for l in range(1, 7) if l not in busy_lanes or l == b["lane"]]
-                new_lane = st.selectbox("Дорожка", free_lanes, index=free_lanes.index(b["lane"]), placeholder="Выберите дорожку")
+                # как при создании: свободные и не закрытые; в своём слоте — и текущая дорожка брони
+                free_lanes = opts["free_lanes"]
+                if (new_date, new_time) == (b.date, b.time) and b.lane not in opts["closed_lanes"]:
+                    free_lanes = sorted({*free_lanes, b.lane})
+                new_lane = st.selectbox("Дорожка", free_lanes, index=free_lanes.index(b.lane) if b.lane in free_lanes else 0,
+                                        placeholder="Выберите дорожку")
             with form_cols[3]:
-                scheduled = utils.get_scheduled_trainers(new_date, new_time)
-                free_trainers = [t for t in scheduled if t not in busy_trainers or t == b["trainer"]]
+                trainers_by_name = {t["name"]: t for t in opts["trainers"]}
+                free_trainers = [t["name"] for t in opts["trainers"] if not t["busy"] or t["name"] == b.trainer]
                 trainer_options = ["Без тренера"] + free_trainers
-                trainer_index = trainer_options.index(b["trainer"] if b["trainer"] else "Без тренера")
+                trainer_index = trainer_options.index(b.trainer) if b.trainer in trainer_options else 0
                 new_trainer = st.selectbox("Тренер", trainer_options, index=trainer_index, placeholder="Выберите тренера")
                 if new_trainer and new_trainer != "Без тренера":
                     if st.button(f"Показать информацию о тренере (редакт)", key="show_trainer_info_edit"):
-                        trainer_info = utils.get_trainer_by_name(new_trainer)
+                        trainer_info = trainers_by_name.get(new_trainer)
                         if trainer_info:
                             st.info(
                                 f"**Фамилия, имя, отчество:** {trainer_info['last_name']} {trainer_info['first_name']} {trainer_info['middle_name']}\n"
@@ -203,26 +270,26 @@ def booking_page():
                 "Ваша регистрация ожидает подтверждения администрацией. Пожалуйста, принесите все необходимые бумаги в бассейн.")
             return
 
+        find_slots_panel()
+
+
         form_cols = st.columns([2, 2, 2, 2])
         with form_cols[0]:
             sel_date = st.date_input("Дата бронирования", value=dt_date.today(), key="new_booking_date")
         with form_cols[1]:
             slots = get_timeslots()
             sel_time = st.selectbox("Время", slots, key="new_booking_time", placeholder="Выберите время")
+        opts = utils.get_slot_options(sel_date, sel_time)
         with form_cols[2]:
-            busy_lanes, busy_trainers = utils.lane_trainer_status(sel_date, sel_time)
-            free_lanes = [l for l in range(1, 7) if l not in busy_lanes]
+            free_lanes = opts["free_lanes"]
             if not free_lanes:
                 st.warning("На это время нет свободных дорожек. Бронирование невозможно.")
             else:
                 lane = st.selectbox("Дорожка", free_lanes, key="new_booking_lane", placeholder="Выберите дорожку")
         with form_cols[3]:
-            scheduled = utils.get_scheduled_trainers(sel_date, sel_time)
-            free_trainers = [t for t in scheduled if t not in busy_trainers]
-            trainer_data = utils.list_trainers(full=True)
-
             # Сопоставление сокращённого ФИО с полным
-            short_to_full = {t['short_fio']: t['name'] for t in trainer_data if t['name'] in free_trainers}
+            free_trainers = {t["short_fio"]: t for t in opts["trainers"] if not t["busy"]}
+            short_to_full = {short: t["name"] for short, t in free_trainers.items()}
             short_fios = ["Без тренера"] + list(short_to_full.keys())
 
             selected_short = st.selectbox("Тренер", short_fios, key="new_booking_trainer_short",
@@ -231,8 +298,7 @@ def booking_page():
         # Кнопка показать информацию
         if selected_short != "Без тренера":
             if st.button("Показать информацию о тренере", key="show_trainer_info_new"):
-                full_name = short_to_full.get(selected_short)
-                trainer_info = utils.get_trainer_by_name(full_name)
+                trainer_info = free_trainers.get(selected_short)
                 if trainer_info:
                     st.info(
                         f"**Фамилия, имя, отчество:** {trainer_info['last_name']} {trainer_info['first_name']} {trainer_info['middle_name']}\n"
@@ -246,8 +312,8 @@ def booking_page():
         if free_lanes:
             with btn_cols[0]:
                 if st.button("Забронировать", key="new_booking_btn"):
-                    if utils.is_slot_closed(sel_date, sel_time):
-                        st.error("Этот слот закрыт для бронирования администратором.")
+                    if lane in opts["closed_lanes"]:
+                        st.error("Эта дорожка закрыта для бронирования администратором.")
                         return
                     trainer_val = None if selected_short == "Без тренера" else short_to_full[selected_short]
                     ok = utils.add_booking(
@@ -264,6 +330,50 @@ def booking_page():
                         st.error("Не удалось забронировать (слот уже занят или вы не подтверждены). Обновите страницу.")
 
 
+def find_slots_panel():
+    with st.expander("🔎 Найти ближайшее свободное время"):
+        slots = get_timeslots()
+        day_names = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+        c1, c2, c3, c4 = st.columns([2, 2, 1, 1])
+        with c1:
+            period = st.date_input(
+                "Период", value=(dt_date.today(), dt_date.today() + timedelta(days=30)), key="find_period"
+            )
+        with c2:
+            days = st.multiselect("Дни недели", day_names, default=day_names, key="find_days")
+        with c3:
+            t_from = st.selectbox("С", slots, key="find_time_from")
+        with c4:
+            t_to = st.selectbox("До", slots, index=len(slots) - 1, key="find_time_to")
+        c5, c6, c7 = st.columns([2, 2, 1])
+        with c5:
+            lanes = st.multiselect("Дорожки", list(range(1, utils.NUM_LANES + 1)), key="find_lanes",
+                                   placeholder="Любые")
+        with c6:
+            trainer = st.selectbox("Тренер", ["Без тренера"] + utils.list_trainers(), key="find_trainer")
+        with c7:
+            limit = st.number_input("Сколько", min_value=1, max_value=50, value=10, key="find_limit")
+        if st.button("Найти", key="find_btn"):
+            if len(period) != 2:
+                st.warning("Выберите начало и конец периода.")
+                return
+            found = utils.find_free_slots(
+                period[0], period[1], t_from, t_to,
+                weekdays=[day_names.index(d) for d in days],
+                lanes=lanes or None,
+                trainer_name=None if trainer == "Без тренера" else trainer,
+                limit=limit,
+            )
+            if not found:
+                st.info("Свободного времени по этим условиям нет.")
+            else:
+                st.dataframe(pd.DataFrame([{
+                    "Дата": f["date"].strftime("%d.%m.%Y") + " " + day_names[f["date"].weekday()],
+                    "Время": f["time"],
+                    "Свободные дорожки": ", ".join(map(str, f["lanes"])),
+                } for f in found]), hide_index=True)
+
+
 def booking_page_org():
     st.subheader("Бронирование для юридических лиц (групповое)")
 
@@ -303,22 +413,15 @@ def booking_page_org():
         groups = utils.list_org_booking_groups(st.session_state["username"])
         my_slots = set()
         group_lookup = dict()
+        my_lanes = set()
         for g in groups:
-            times = (g["times"].split(",") if g["times"] else [g["times"]])
+            times = (g.times.split(",") if g.times else [g.times])
+            lanes = [int(l) for l in g.lanes.split(",") if l]
             for t in times:
-                my_slots.add((g["date"], t))
-                group_lookup[(g["date"], t)] = g
-        busy_slots = set()
-        for d in week_dates:
-            all_b = utils.list_all_bookings_for_date(d)
-            for b in all_b:
-                busy_slots.add((b["date"], b["time"]))
-        closed_slots = set()
-        for d in week_dates:
-            for item in utils.list_closed_slots(d):
-                closed_slots.add((item["date"], item["time"]))
-        # Кэшируем все бронирования на неделю для ускорения
-        week_bookings = {d: utils.list_all_bookings_for_date(d) for d in week_dates}
+                my_slots.add((g.date, t))
+                group_lookup[(g.date, t)] = g
+                my_lanes.update((g.date, t, lane) for lane in lanes)
+        grid = get_week_grid(week_start)
         num_lanes = 6
         cell_height = 44
         html = """
@@ -339,7 +442,7 @@ def booking_page_org():
         for t in timeslots:
             html += f"<tr><td>{t}</td>"
             for d in week_dates:
-                key = (d, t)
+                booked, closed_mask, _ = grid.get((d, t), (0, 0, False))
                 lane_html = ""
                 for row in range(3):
                     lane_html += "<div class='lane-num-row'>"
@@ -347,9 +450,9 @@ def booking_page_org():
                         lane = row*2 + col + 1
                         if lane > num_lanes:
                             continue
-                        my = any(g["date"] == d and t in g["times"].split(",") and str(lane) in g["lanes"].split(",") for g in groups)
-                        closed = (d, t) in closed_slots
-                        busy = any(bk["date"] == d and bk["time"] == t and bk["lane"] == lane for bk in week_bookings[d])
+                        my = (d, t, lane) in my_lanes
+                        closed = bool(closed_mask >> (lane - 1) & 1)
+                        busy = bool(booked >> (lane - 1) & 1)
                         cls = "lane-num "
                         if my:
                             cls += "my"
@@ -375,21 +478,21 @@ def booking_page_org():
             for g in groups:
                 c1, c2, c3, c4, c5, c6 = st.columns([2, 2, 2, 2, 1, 1])
                 with c1:
-                    st.write(g["date"])
+                    st.write(g.date)
                 with c2:
-                    st.write(g["times"])
+                    st.write(g.times)
                 with c3:
-                    st.write("Все дорожки" if g["lanes"]=="1,2,3,4,5,6" else g["lanes"])
+                    st.write("Все дорожки" if g.lanes=="1,2,3,4,5,6" else g.lanes)
                 with c4:
-                    st.write(g.get("comment", ""))
+                    st.write("")  # у групповых бронирований нет комментария
                 with c5:
-                    if st.button("🗑️", key=f"org_del_{g['id']}"):
-                        utils.remove_org_booking_group(g["id"])
+                    if st.button("🗑️", key=f"org_del_{g.id}"):
+                        utils.remove_org_booking_group(g.id)
                         st.success("Бронирование удалено")
                         utils.safe_rerun()
                 with c6:
-                    if st.button("✏️", key=f"org_edit_{g['id']}"):
-                        st.session_state["org_edit_group_id"] = g["id"]
+                    if st.button("✏️", key=f"org_edit_{g.id}"):
+                        st.session_state["org_edit_group_id"] = g.id
                         st.session_state["org_edit_group_data"] = g
                         st.session_state["show_org_edit_form"] = True
         else:
@@ -401,16 +504,16 @@ def booking_page_org():
             st.markdown("#### Изменить групповое бронирование")
             form_cols = st.columns([2, 2, 2, 2])
             with form_cols[0]:
-                new_date = st.date_input("Дата", value=g["date"], key="org_edit_date")
+                new_date = st.date_input("Дата", value=g.date, key="org_edit_date")
             with form_cols[1]:
                 slots = get_timeslots()
-                group_times = g["times"].split(",") if g["times"] else [g["times"]]
+                group_times = g.times.split(",") if g.times else [g.times]
                 start_time = st.selectbox("Время начала", slots, index=slots.index(group_times[0]), placeholder="Выберите время начала")
             with form_cols[2]:
                 end_time = st.selectbox("Время конца", slots, index=slots.index(group_times[-1]), placeholder="Выберите время конца")
             with form_cols[3]:
                 available_lanes = [1,2,3,4,5,6]
-                default_lanes = [int(l) for l in g["lanes"].split(",")]
+                default_lanes = [int(l) for l in g.lanes.split(",")]
                 sel_lanes = st.multiselect("Дорожки", available_lanes, default=default_lanes, placeholder="Выберите дорожки")
             btn_cols = st.columns([1, 1])
             with btn_cols[0]:
@@ -422,7 +525,7 @@ def booking_page_org():
                         return
                     time_range = slots[start_idx:end_idx+1]
                     ok = utils.update_org_booking_group(
-                        g["id"], new_date, start_time, sel_lanes
+                        g.id, new_date, start_time, sel_lanes
                     )
                     if ok:
                         st.success("Групповое бронирование изменено")
@@ -1,13 +1,30 @@
 # db.py — ORM схема, синхронизированная с SQL-файлом
+import logging
+import threading
+from datetime import date
+
 import streamlit as st
 from sqlalchemy import (
     create_engine, Column, Integer, String, Date, Time, BigInteger,
-    ForeignKey, inspect
+    ForeignKey, Index, inspect, func, literal_column, text,
+    column, delete, select, table, union_all
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import aliased, declarative_base, relationship, sessionmaker
 from sqlalchemy.exc import DBAPIError, OperationalError
 
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
 #  engine
+# [pool] в secrets: size, max_overflow, timeout (сек. ожидания соединения), leak_seconds
+# (дольше держать соединение — предупреждение в лог); остальное — допуск отчётов в utils
+POOL_SETTINGS = st.secrets.get("pool", {})
+POOL_SIZE = int(POOL_SETTINGS.get("size", 10))
+MAX_OVERFLOW = int(POOL_SETTINGS.get("max_overflow", 20))
+POOL_TIMEOUT = float(POOL_SETTINGS.get("timeout", 5))  # вместо 30 с по умолчанию: лучше отказ, чем зависание
+LEAK_SECONDS = float(POOL_SETTINGS.get("leak_seconds", 30))
 
 def get_engine(connection_url=None):
     if not connection_url:
@@ -33,14 +50,51 @@ def _connection_url() -> str:
 
 ENGINE = create_engine(
     _connection_url(),
-    pool_size=10,
-    max_overflow=20,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
     echo=False,
     future=True,
 )
 SessionLocal = sessionmaker(bind=ENGINE, autoflush=False, autocommit=False, future=True)
 Base = declarative_base()
 
+#  реплики для чтения
+
+def _replica_urls() -> list[str]:
+    """[postgres_replica] в secrets: hosts = ["host:port", …]; остальное берётся из [postgres]."""
+    replica = st.secrets.get("postgres_replica")
+    if not replica:
+        return []
+    cfg = {**st.secrets["postgres"], **replica}
+    hosts = cfg.get("hosts") or [f"{cfg['host']}:{cfg['port']}"]
+    return [
+        f"postgresql+psycopg2://{cfg['user']}:{cfg['password']}@{host}/{cfg['dbname']}"
+        for host in hosts
+    ]
+
+REPLICA_ENGINES = [
+    create_engine(
+        url,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_pre_ping=True,
+        connect_args={"connect_timeout": 2},
+        echo=False,
+        future=True,
+    )
+    for url in _replica_urls()
+]
+ReplicaSessions = [
+    sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+    for engine in REPLICA_ENGINES
+]
+
+metrics.instrument_engine(ENGINE, "primary", LEAK_SECONDS)
+for i, engine in enumerate(REPLICA_ENGINES):
+    metrics.instrument_engine(engine, f"replica{i}", LEAK_SECONDS)
+
 #  models
 
 class User(Base):
@@ -153,15 +207,323 @@ class ClosedSlot(Base):
     timeslot    = relationship("Timeslot")
 
 
+class SlotOccupancy(Base):
+    """Сводка по слоту: маски занятых/закрытых дорожек и занятые тренеры.
+
+    Поддерживается utils._touch_occupancy в той же транзакции, что и записи в bookings/closed_slots.
+    """
+    __tablename__ = "slot_occupancy"
+
+    date        = Column(Date, primary_key=True)
+    timeslot_id = Column(Integer, ForeignKey("timeslots.id", ondelete="CASCADE"), primary_key=True)
+    booked_mask = Column(Integer, nullable=False, default=0)   # бит (n-1) — дорожка n
+    closed_mask = Column(Integer, nullable=False, default=0)
+    trainer_ids = Column(String(200), nullable=False, default="")  # "3,7"
+
+
+class SchemaMigration(Base):
+    """Применённые одноразовые миграции данных (DATA_MIGRATIONS)."""
+    __tablename__ = "schema_migrations"
+
+    name = Column(String(100), primary_key=True)
+
+
 class Table9(Base):
     __tablename__ = "table_9"
 
     id = Column(BigInteger, primary_key=True, index=True)
 
+#  indexes
+
+# Строка поиска пользователя: логин, ФИО, email и телефон в нижнем регистре.
+# Выражение должно совпадать с триграммным индексом ix_users_search_trgm.
+_SP = literal_column("' '")
+USER_SEARCH = func.lower(
+    User.username + _SP + User.first_name + _SP + User.last_name + _SP
+    + User.middle_name + _SP + User.email + _SP + User.phone
+)
+
+Index(
+    "uq_trainer_schedule_slot",
+    TrainerSchedule.trainer_id, TrainerSchedule.day_of_week, TrainerSchedule.timeslot_id,
+    unique=True,
+)
+Index(
+    "uq_closed_slot_lane",
+    ClosedSlot.date, ClosedSlot.timeslot_id, ClosedSlot.lane_id,
+    unique=True,
+)
+# «мои брони»: окно по датам одного пользователя, без просмотра всей таблицы
+Index("ix_bookings_user_date", Booking.user_id, Booking.date)
+Index(
+    "ix_users_pending", User.id,
+    postgresql_where=User.is_confirmed == 0,
+    sqlite_where=User.is_confirmed == 0,
+)
+
+# DDL, которое нельзя выразить через metadata (расширения, GIN-индексы).
+# Выполняется идемпотентно при каждом старте, только на PostgreSQL.
+PG_MIGRATIONS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # дубли мешают уникальному индексу uq_trainer_schedule_slot
+    "DELETE FROM trainer_schedules a USING trainer_schedules b "
+    "WHERE a.id > b.id AND a.trainer_id = b.trainer_id "
+    "AND a.timeslot_id = b.timeslot_id AND a.day_of_week = b.day_of_week",
+    # то же для uq_closed_slot_lane
+    "DELETE FROM closed_slots a USING closed_slots b "
+    "WHERE a.id > b.id AND a.date = b.date "
+    "AND a.timeslot_id = b.timeslot_id AND a.lane_id = b.lane_id",
+    "CREATE INDEX IF NOT EXISTS ix_users_search_trgm ON users USING gin ("
+    "lower(username || ' ' || first_name || ' ' || last_name || ' ' "
+    "|| middle_name || ' ' || email || ' ' || phone) gin_trgm_ops)",
+]
+
+#  партиционирование по месяцам
+
+# bookings и closed_slots секционируются по date: <table>_pYYYYMM на каждый месяц
+# и <table>_default для дат вне созданных секций. Старые месяцы переносятся
+# в схему archive (archive.<table>) и из «горячих» запросов не видны.
+PARTITIONED_TABLES = ["bookings", "closed_slots"]
+PARTITION_MONTHS_AHEAD = 12
+ARCHIVE_HORIZON_MONTHS = int(st.secrets.get("archive", {}).get("horizon_months", 24))
+
+PG_PARTITION_MIGRATIONS = [
+    # обычная таблица -> секционированная; данные переезжают в _default,
+    # затем ensure_month_partitions раскладывает их по месяцам
+    """
+    DO $$
+    DECLARE
+        t text;
+        seq text;
+        fk record;
+    BEGIN
+        FOREACH t IN ARRAY ARRAY['bookings', 'closed_slots'] LOOP
+            CONTINUE WHEN EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = t::regclass);
+            EXECUTE format('ALTER TABLE %I RENAME TO %I', t, t || '_unpartitioned');
+            EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS) PARTITION BY RANGE (date)',
+                           t, t || '_unpartitioned');
+            EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, date)', t);
+            FOR fk IN SELECT pg_get_constraintdef(oid) AS def FROM pg_constraint
+                      WHERE conrelid = (t || '_unpartitioned')::regclass AND contype = 'f' LOOP
+                EXECUTE format('ALTER TABLE %I ADD %s', t, fk.def);
+            END LOOP;
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', t || '_default', t);
+            EXECUTE format('INSERT INTO %I SELECT * FROM %I', t, t || '_unpartitioned');
+            seq := pg_get_serial_sequence(t || '_unpartitioned', 'id');
+            IF seq IS NOT NULL THEN
+                EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', seq, t);
+            END IF;
+            EXECUTE format('DROP TABLE %I', t || '_unpartitioned');
+        END LOOP;
+    END $$
+    """,
+    # пустые archive.<table> заводим сразу: history_model объединяет их с текущими
+    # таблицами и там, где архивирование ещё ни разу не запускалось
+    "CREATE SCHEMA IF NOT EXISTS archive",
+    *[
+        f"CREATE TABLE IF NOT EXISTS archive.{t} (LIKE public.{t} INCLUDING DEFAULTS) PARTITION BY RANGE (date)"
+        for t in PARTITIONED_TABLES
+    ],
+    # секции по месяцам от самой ранней даты в _default до months_ahead вперёд;
+    # строки, уже попавшие в _default, переносятся в новую секцию
+    """
+    CREATE OR REPLACE FUNCTION ensure_month_partitions(parent text, months_ahead integer)
+    RETURNS integer LANGUAGE plpgsql AS $$
+    DECLARE
+        oldest date;
+        m date;
+        part text;
+        created integer := 0;
+    BEGIN
+        EXECUTE format('SELECT min(date) FROM %I', parent || '_default') INTO oldest;
+        m := date_trunc('month', LEAST(coalesce(oldest, current_date), current_date))::date;
+        WHILE m <= current_date + make_interval(months => months_ahead) LOOP
+            part := parent || '_p' || to_char(m, 'YYYYMM');
+            IF to_regclass(part) IS NULL AND to_regclass('archive.' || part) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', part, parent);
+                EXECUTE format('WITH moved AS (DELETE FROM %I WHERE date >= %L AND date < %L RETURNING *) '
+                               'INSERT INTO %I SELECT * FROM moved',
+                               parent || '_default', m, (m + interval '1 month')::date, part);
+                EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                               parent, part, m, (m + interval '1 month')::date);
+                created := created + 1;
+            END IF;
+            m := (m + interval '1 month')::date;
+        END LOOP;
+        RETURN created;
+    END $$
+    """,
+    # отцепляет месячные секции, целиком лежащие до before, и переносит их в archive.<parent>
+    """
+    CREATE OR REPLACE FUNCTION archive_month_partitions(parent text, before date)
+    RETURNS SETOF text LANGUAGE plpgsql AS $$
+    DECLARE
+        part record;
+    BEGIN
+        CREATE SCHEMA IF NOT EXISTS archive;
+        IF to_regclass('archive.' || parent) IS NULL THEN
+            EXECUTE format('CREATE TABLE archive.%I (LIKE public.%I INCLUDING DEFAULTS) PARTITION BY RANGE (date)',
+                           parent, parent);
+        END IF;
+        FOR part IN
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = ('public.' || parent)::regclass
+              AND c.relname ~ ('^' || parent || '_p[0-9]{6}$')
+              AND to_date(right(c.relname, 6), 'YYYYMM') + interval '1 month' <= before
+            ORDER BY c.relname
+        LOOP
+            EXECUTE format('ALTER TABLE public.%I DETACH PARTITION public.%I', parent, part.relname);
+            EXECUTE format('ALTER TABLE public.%I SET SCHEMA archive', part.relname);
+            EXECUTE format('ALTER TABLE archive.%I ATTACH PARTITION archive.%I %s', parent, part.relname, part.bound);
+            RETURN NEXT part.relname;
+        END LOOP;
+    END $$
+    """,
+] + [
+    f"SELECT ensure_month_partitions('{t}', {PARTITION_MONTHS_AHEAD})" for t in PARTITIONED_TABLES
+]
+
+
+#  одноразовые миграции данных: (имя, [SQL]) — в отличие от PG_MIGRATIONS не идемпотентны,
+#  поэтому каждая выполняется один раз и записывается в schema_migrations; SQL общий для
+#  PostgreSQL и SQLite
+DATA_MIGRATIONS = [
+    # до закрытия по дорожкам строка closed_slots закрывала слот целиком и писалась с дорожкой 1;
+    # такие слоты (закрыта только дорожка 1) закрываем на всех дорожках и пересчитываем маски сводки
+    ("closed_slots_all_lanes", [
+        "INSERT INTO closed_slots (date, time, comment, lane_id, timeslot_id) "
+        "SELECT c.date, c.time, c.comment, l.id, c.timeslot_id "
+        "FROM closed_slots c JOIN lanes first_lane ON first_lane.id = c.lane_id AND first_lane.number = 1 "
+        "JOIN lanes l ON l.number > 1 "
+        "WHERE NOT EXISTS (SELECT 1 FROM closed_slots o WHERE o.date = c.date "
+        "AND o.timeslot_id = c.timeslot_id AND o.lane_id <> c.lane_id) "
+        "ON CONFLICT DO NOTHING",
+        "UPDATE slot_occupancy SET closed_mask = ("
+        "SELECT coalesce(sum(1 << (l.number - 1)), 0) FROM closed_slots c JOIN lanes l ON l.id = c.lane_id "
+        "WHERE c.date = slot_occupancy.date AND c.timeslot_id = slot_occupancy.timeslot_id)",
+    ]),
+]
+
+
+def apply_data_migrations(engine=None) -> list[str]:
+    """Выполняет ещё не применённые DATA_MIGRATIONS, каждую в своей транзакции; возвращает имена.
+
+    Запись в schema_migrations вставляется первой: второй процесс, стартовавший одновременно,
+    дождётся коммита первого и миграцию пропустит.
+    """
+    engine = engine or ENGINE
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    applied = []
+    for name, statements in DATA_MIGRATIONS:
+        with engine.begin() as conn:
+            claim = insert(SchemaMigration).values(name=name).on_conflict_do_nothing()
+            if conn.execute(claim).rowcount != 1:
+                continue
+            for stmt in statements:
+                conn.execute(text(stmt))
+        logger.info("Миграция данных %s применена", name)
+        applied.append(name)
+    return applied
+
+
+def archive_boundary(horizon_months: int | None = None) -> date:
+    """Первое число месяца, раньше которого данные считаются архивными."""
+    horizon = ARCHIVE_HORIZON_MONTHS if horizon_months is None else horizon_months
+    today = date.today()
+    months = today.year * 12 + today.month - 1 - horizon
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def archive_partitions(horizon_months: int | None = None, engine=None) -> list[str]:
+    """Переносит месячные секции старше горизонта в схему archive; возвращает их имена.
+
+    Сводка slot_occupancy за архивные даты удаляется — сетки туда не заглядывают.
+    Не на PostgreSQL ничего не делает.
+    """
+    engine = engine or ENGINE
+    if engine.dialect.name != "postgresql":
+        return []
+    before = archive_boundary(horizon_months)
+    with engine.begin() as conn:
+        moved = [
+            name
+            for t in PARTITIONED_TABLES
+            for (name,) in conn.execute(text("SELECT archive_month_partitions(:t, :before)"),
+                                        {"t": t, "before": before})
+        ]
+        conn.execute(delete(SlotOccupancy).where(SlotOccupancy.date < before))
+    return moved
+
+
+def history_model(db, model, date_from=None):
+    """Booking/ClosedSlot для исторических выборок: с архивом, если период заходит за горизонт.
+
+    Горячие запросы используют модели напрямую и видят только текущие секции.
+    """
+    if db.get_bind().dialect.name != "postgresql" or (
+            date_from is not None and date_from >= archive_boundary()):
+        return model
+    hot = model.__table__
+    archived = table(hot.name, *[column(c.name) for c in hot.c], schema="archive")
+    with_archive = union_all(select(*hot.c), select(*archived.c)).subquery(f"{hot.name}_all")
+    return aliased(model, with_archive)
+
+
+def apply_migrations(engine=None) -> int:
+    """Применяем PG_MIGRATIONS и досоздаём индексы из metadata на существующих таблицах.
+
+    Возвращает число неприменённых миграций (подробности — в логе).
+    """
+    engine = engine or ENGINE
+    failed = 0
+    if engine.dialect.name == "postgresql":
+        for stmt in PG_MIGRATIONS + PG_PARTITION_MIGRATIONS:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(stmt))
+            except DBAPIError as e:
+                failed += 1
+                logger.warning("Миграция не применена: %s…\n%s", stmt[:60], getattr(e, "orig", e))
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for idx in table.indexes:
+                conn.execute(CreateIndex(idx, if_not_exists=True))
+    return failed
+
+
+_migrated = False
+_migrate_lock = threading.Lock()
+
+
+def migrate(engine=None) -> int:
+    """Схема целиком: create_all, apply_migrations и apply_data_migrations. DDL берёт блокировки (CREATE INDEX
+    мешает вставке броней), поэтому не на каждом перезапуске скрипта, а через migrate_once()
+    или python -m app.manage migrate (его же — раз в месяц по cron для новых секций).
+    """
+    engine = engine or ENGINE
+    Base.metadata.create_all(bind=engine)
+    failed = apply_migrations(engine)
+    apply_data_migrations(engine)
+    return failed
+
+
+def migrate_once() -> None:
+    """migrate() один раз на процесс; повторные вызовы (перезапуски скрипта) ничего не делают."""
+    global _migrated
+    with _migrate_lock:
+        if _migrated:
+            return
+        migrate()
+        _migrated = True
+
 #  init
 
 def init_db():
-    """Создаём таблицы и сеем базовые справочники (6 дорожек, слоты 09:00–18:00)."""
+    """Проверяем соединение, схема — migrate_once(); сеем базовые справочники (6 дорожек, слоты 09:00–18:00)."""
     try:
         with ENGINE.connect():
             pass
@@ -170,7 +532,7 @@ def init_db():
         st.stop()
 
     try:
-        Base.metadata.create_all(bind=ENGINE)
+        migrate_once()
     except DBAPIError as e:
         st.error(f"Ошибка создания схемы:\n{e.orig if hasattr(e,'orig') else e}")
         st.stop()
@@ -206,3 +568,8 @@ def init_db():
             ))
 
         db.commit()
+
+        #  сводка занятости для существующих данных
+        if not db.query(SlotOccupancy).first() and (db.query(Booking).first() or db.query(ClosedSlot).first()):
+            from app import utils
+            utils.rebuild_occupancy()
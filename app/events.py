@@ -0,0 +1,131 @@
+# events.py — инвалидация кэшей между процессами через PostgreSQL LISTEN/NOTIFY
+#
+# Изменяющие функции utils вызывают publish() внутри своей транзакции: на PostgreSQL
+# это pg_notify, который уходит остальным процессам только после COMMIT. После
+# коммита те же события разбираются и в текущем процессе. Каждый процесс держит
+# поток-слушатель, который передаёт чужие события подписчикам (сбросу st.cache_data).
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import event, func
+from sqlalchemy import select as sa_select
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "waterpool_changes"
+MAX_WEEKS = 50  # больше недель в одном событии — сбрасываем тему целиком
+CACHE_TTL = 3600  # для кэшей, которые сбрасываются событиями; TTL — только страховка
+ORIGIN = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# темы: occupancy (брони и закрытия, с неделями), timeslots, trainers, schedule, users
+_handlers: dict[str, dict[str, callable]] = {}
+_listener: threading.Thread | None = None
+_listener_lock = threading.Lock()
+
+
+def week_of(d) -> str:
+    """ISO-дата понедельника недели — ключ кэшей недельных сеток."""
+    return (d - timedelta(days=d.weekday())).isoformat()
+
+
+def subscribe(topic: str):
+    """Декоратор: fn(weeks) вызывается при изменениях темы; weeks=None — «всё»."""
+    def register(fn):
+        # по qualname, чтобы перезагрузка модуля Streamlit не плодила дубли
+        _handlers.setdefault(topic, {})[f"{fn.__module__}.{fn.__qualname__}"] = fn
+        return fn
+    return register
+
+
+def dispatch(topic: str | None, weeks=None) -> None:
+    """Вызывает подписчиков темы (topic=None — всех тем). Ошибки подписчиков только логируются."""
+    topics = list(_handlers) if topic is None else [topic]
+    for t in topics:
+        for name, fn in list(_handlers.get(t, {}).items()):
+            try:
+                fn(None if topic is None else weeks)
+            except Exception:
+                logger.exception("Ошибка подписчика %s на %s", name, t)
+
+
+def publish(db, topic: str, dates=None) -> None:
+    """Регистрирует изменение темы в текущей транзакции; dates — затронутые даты или None."""
+    weeks = None
+    if dates is not None:
+        weeks = sorted({week_of(d) for d in dates})
+        if len(weeks) > MAX_WEEKS:
+            weeks = None
+    db.info.setdefault("events", []).append((topic, weeks))
+    if db.get_bind().dialect.name == "postgresql":
+        payload = json.dumps({"origin": ORIGIN, "topic": topic, "weeks": weeks})
+        db.execute(sa_select(func.pg_notify(CHANNEL, payload)))
+
+
+@event.listens_for(Session, "after_commit")
+def _dispatch_committed(session) -> None:
+    for topic, weeks in session.info.pop("events", []):
+        dispatch(topic, weeks)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_rolled_back(session) -> None:
+    session.info.pop("events", None)
+
+
+#  слушатель
+def _listen(engine, stop: threading.Event) -> None:
+    delay = 1.0
+    while not stop.is_set():
+        try:
+            raw = engine.raw_connection()
+            try:
+                dbapi = raw.driver_connection
+                dbapi.autocommit = True
+                with dbapi.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANNEL}")
+                # пока слушателя не было, события могли потеряться — сбрасываем всё
+                dispatch(None)
+                delay = 1.0
+                while not stop.is_set():
+                    if select.select([dbapi], [], [], 5.0)[0]:
+                        dbapi.poll()
+                        while dbapi.notifies:
+                            _handle(dbapi.notifies.pop(0).payload)
+            finally:
+                raw.invalidate()
+        except Exception as e:
+            logger.warning("Слушатель %s: %s; переподключение через %.0f с", CHANNEL, e, delay)
+            stop.wait(delay)
+            delay = min(delay * 2, 60.0)
+
+
+def _handle(payload: str) -> None:
+    try:
+        msg = json.loads(payload)
+    except ValueError:
+        logger.warning("Непонятное событие %s: %r", CHANNEL, payload)
+        return
+    if msg.get("origin") != ORIGIN:  # свои события уже разобраны после коммита
+        dispatch(msg.get("topic"), msg.get("weeks"))
+
+
+def start_listener(engine=None) -> bool:
+    """Запускает поток-слушатель один раз на процесс; не на PostgreSQL ничего не делает."""
+    global _listener
+    if engine is None:
+        from app.db import ENGINE as engine
+    if engine.dialect.name != "postgresql":
+        return False
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(
+                target=_listen, args=(engine, threading.Event()), name="cache-invalidation", daemon=True)
+            _listener.start()
+    return True
@@ -0,0 +1,152 @@
+# export.py — выгрузка бронирований, групп и пользователей в CSV/Parquet
+#
+# Строки читаются серверным курсором (stream_results) пачками по batch_size и сразу
+# превращаются в байты, так что память не зависит от длины периода.
+import csv
+import io
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select
+
+from app import utils
+from app.db import Booking, Lane, OrgBookingGroup, Timeslot, Trainer, User, history_model
+
+BATCH_SIZE = 5000
+UI_MAX_DAYS = 93  # период выгрузки из админки (файл там собирается в памяти); длиннее — python -m app.manage export
+FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+# kind -> [(колонка, тип arrow)]
+EXPORT_COLUMNS = {
+    "bookings": [
+        ("id", pa.int64()), ("date", pa.date32()), ("time", pa.string()), ("lane", pa.int64()),
+        ("username", pa.string()), ("role", pa.string()), ("trainer", pa.string()),
+        ("group_id", pa.int64()),
+    ],
+    "groups": [
+        ("id", pa.int64()), ("date", pa.date32()), ("username", pa.string()),
+        ("times", pa.string()), ("lanes", pa.string()), ("created_at", pa.string()),
+    ],
+    "users": [
+        ("id", pa.int64()), ("username", pa.string()), ("role", pa.string()),
+        ("last_name", pa.string()), ("first_name", pa.string()), ("middle_name", pa.string()),
+        ("phone", pa.string()), ("email", pa.string()), ("gender", pa.string()),
+        ("is_confirmed", pa.int64()),
+    ],
+}
+
+
+def _export_stmt(kind: str, date_from=None, date_to=None, bookings=Booking):
+    if kind == "bookings":
+        stmt = (
+            select(bookings.id, bookings.date, Timeslot.time, Lane.number, User.username, User.role,
+                   Trainer.name, bookings.group_id)
+            .select_from(bookings)
+            .join(Timeslot, bookings.timeslot_id == Timeslot.id)
+            .join(Lane, bookings.lane_id == Lane.id)
+            .join(User, bookings.user_id == User.id)
+            .outerjoin(Trainer, bookings.trainer_id == Trainer.id)
+            .order_by(bookings.date, Timeslot.time, Lane.number)
+        )
+        date_col = bookings.date
+    elif kind == "groups":
+        stmt = (
+            select(OrgBookingGroup.id, OrgBookingGroup.date, User.username, OrgBookingGroup.times,
+                   OrgBookingGroup.lanes, OrgBookingGroup.created_at)
+            .join(User, OrgBookingGroup.user_id == User.id)
+            .order_by(OrgBookingGroup.date, OrgBookingGroup.id)
+        )
+        date_col = OrgBookingGroup.date
+    elif kind == "users":
+        # у пользователей нет даты — период не применяется
+        return (
+            select(User.id, User.username, User.role, User.last_name, User.first_name,
+                   User.middle_name, User.phone, User.email, User.gender, User.is_confirmed)
+            .order_by(User.id)
+        )
+    else:
+        raise ValueError(f"Неизвестный тип выгрузки: {kind}")
+    if date_from is not None:
+        stmt = stmt.where(date_col >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(date_col <= date_to)
+    return stmt
+
+
+def iter_batches(kind: str, date_from=None, date_to=None, batch_size: int = BATCH_SIZE):
+    """Пачки строк (списки кортежей) из серверного курсора; время — строкой "HH:MM".
+
+    Брони за период старше горизонта архива читаются вместе с archive.bookings.
+    """
+    with utils.admit(f"export_{kind}"), utils.SessionLocal() as db:
+        stmt = _export_stmt(kind, date_from, date_to, history_model(db, Booking, date_from))
+        result = db.execute(stmt.execution_options(stream_results=True, yield_per=batch_size))
+        for part in result.partitions():
+            if kind == "bookings":
+                part = [(r[0], r[1], r[2].strftime("%H:%M"), *r[3:]) for r in part]
+            yield part
+
+
+def _iter_csv(kind, batches):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")  # BOM, чтобы Excel открыл кириллицу
+    writer.writerow([name for name, _ in EXPORT_COLUMNS[kind]])
+    for rows in batches:
+        writer.writerows(rows)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+class _Sink(io.RawIOBase):
+    """Файл для ParquetWriter, из которого записанные байты забираются по частям."""
+
+    def __init__(self):
+        self._chunks, self._pos = [], 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _iter_parquet(kind, batches):
+    schema = pa.schema(EXPORT_COLUMNS[kind])
+    sink = _Sink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in batches:
+            columns = list(zip(*rows)) if rows else [[] for _ in schema]
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+
+def iter_export(kind: str, fmt: str = "csv", date_from=None, date_to=None, batch_size: int = BATCH_SIZE):
+    """Генератор байтов файла выгрузки; каждая пачка строк отдаётся сразу после чтения."""
+    batches = iter_batches(kind, date_from, date_to, batch_size)
+    if fmt == "csv":
+        return _iter_csv(kind, batches)
+    if fmt == "parquet":
+        return _iter_parquet(kind, batches)
+    raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+
+def export_filename(kind: str, fmt: str, date_from=None, date_to=None) -> str:
+    period = f"_{date_from:%Y%m%d}-{date_to:%Y%m%d}" if kind != "users" and date_from and date_to else ""
+    return f"{kind}{period}.{fmt}"
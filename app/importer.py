@@ -0,0 +1,258 @@
+# importer.py — массовая загрузка пользователей, тренеров и бронирований из CSV/Parquet
+#
+# Файл проверяется целиком векторно (pandas), внешние ключи разрешаются одним запросом
+# на справочник, корректные строки копируются во временную таблицу (COPY на PostgreSQL)
+# и вливаются в основную одним INSERT … SELECT. Ошибки собираются построчно, а не
+# прерывают загрузку.
+import csv
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from passlib.hash import bcrypt
+from sqlalchemy import Column, MetaData, Table, and_, exists, insert, or_, select
+
+from app import auth, events
+from app.db import Booking, SlotOccupancy, Trainer, User
+from app.utils import NUM_LANES, with_session, _lane_ids, _timeslot_ids, _touch_occupancy
+
+# kind -> (обязательные колонки, {необязательная колонка: значение по умолчанию})
+IMPORT_COLUMNS = {
+    "users": (
+        ["username", "password", "first_name", "last_name", "phone", "email"],
+        {"middle_name": "", "gender": "other", "role": "user", "org_name": "", "is_confirmed": "0"},
+    ),
+    "trainers": (
+        ["name", "first_name", "last_name", "age"],
+        {"middle_name": "", "description": ""},
+    ),
+    "bookings": (
+        ["username", "date", "time", "lane"],
+        {"trainer": ""},
+    ),
+}
+PARALLEL_HASH_MIN = 32  # меньше — хэшируем в текущем процессе, пул дороже
+
+
+def read_table(source, fmt: str | None = None) -> pd.DataFrame:
+    """CSV/Parquet из пути или файлового объекта; все значения — строки без пропусков."""
+    if fmt is None:
+        fmt = Path(getattr(source, "name", str(source))).suffix.lstrip(".").lower()
+    if fmt == "parquet":
+        df = pd.read_parquet(source).astype(str)
+    elif fmt == "csv":
+        df = pd.read_csv(source, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    else:
+        raise ValueError(f"Неизвестный формат файла: {fmt}")
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    return df.fillna("").apply(lambda col: col.str.strip())
+
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hash(password)
+
+
+def _hash_passwords(passwords: list[str]) -> list[str]:
+    if len(passwords) < PARALLEL_HASH_MIN:
+        return [_hash_password(p) for p in passwords]
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_hash_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def _flag(errors: pd.Series, mask, text: str) -> None:
+    """Отмечает ошибкой строки по маске; у строки остаётся первая найденная ошибка."""
+    errors[np.asarray(mask, dtype=bool) & errors.eq("").to_numpy()] = text
+
+
+def _stage_and_merge(db, model, columns: list[str], rows: list[tuple], duplicate) -> int:
+    """Копирует rows во временную таблицу и вливает в model строки, для которых нет дубля.
+
+    duplicate(target, staging) — условие «такая строка уже есть».
+    """
+    if not rows:
+        return 0
+    target = model.__table__
+    staging = Table(
+        f"import_{target.name}", MetaData(),
+        *[Column(name, target.c[name].type) for name in columns],
+        prefixes=["TEMPORARY"],
+    )
+    conn = db.connection()
+    staging.create(conn)
+    try:
+        if conn.dialect.name == "postgresql":
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            with conn.connection.cursor() as cur:
+                cur.copy_expert(f"COPY {staging.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+        else:
+            conn.execute(insert(staging), [dict(zip(columns, r)) for r in rows])
+        merged = select(*[staging.c[name] for name in columns]).where(
+            ~exists().where(duplicate(target, staging)))
+        return conn.execute(insert(target).from_select(columns, merged)).rowcount
+    finally:
+        staging.drop(conn)
+
+
+#  проверки по видам
+def _check_users(db, df, errors) -> list[tuple]:
+    _flag(errors, ~df["role"].isin(["user", "org"]), "роль должна быть user или org")
+    _flag(errors, ~df["is_confirmed"].isin(["0", "1"]), "is_confirmed должен быть 0 или 1")
+    phone = df["phone"].str.replace(auth.PHONE_STRIP_RE, "", regex=True)
+    _flag(errors, ~phone.str.fullmatch(auth.PHONE_RE), "некорректный телефон")
+    _flag(errors, ~df["email"].str.fullmatch(auth.EMAIL_RE), "некорректный email")
+    _flag(errors, df["role"].eq("org") & df["org_name"].eq(""), "для организации нужен org_name")
+    _flag(errors, df["username"].duplicated(), "логин повторяется в файле")
+    _flag(errors, df["email"].duplicated(), "email повторяется в файле")
+    taken = db.query(User.username, User.email).filter(
+        User.username.in_(df["username"].unique().tolist()) | User.email.in_(df["email"].unique().tolist())
+    ).all()
+    _flag(errors, df["username"].isin({u for u, _ in taken}), "логин уже существует")
+    _flag(errors, df["email"].isin({e for _, e in taken}), "email уже существует")
+
+    ok = df[errors.eq("")]
+    hashes = _hash_passwords(ok["password"].tolist())
+    middle = np.where(ok["role"].eq("org"), ok["org_name"], ok["middle_name"])
+    return list(zip(
+        ok["username"], hashes, ok["role"], ok["first_name"], ok["last_name"], middle,
+        ok["phone"], ok["gender"], ok["email"], ok["is_confirmed"].astype(int),
+    ))
+
+
+def _check_trainers(db, df, errors) -> list[tuple]:
+    age = pd.to_numeric(df["age"], errors="coerce")
+    _flag(errors, ~age.between(14, 100), "возраст должен быть числом от 14 до 100")
+    _flag(errors, df["name"].duplicated(), "тренер повторяется в файле")
+    taken = {n for (n,) in db.query(Trainer.name).filter(Trainer.name.in_(df["name"].unique().tolist()))}
+    _flag(errors, df["name"].isin(taken), "тренер уже существует")
+
+    ok = df[errors.eq("")]
+    return list(zip(
+        ok["name"], ok["first_name"], ok["last_name"], ok["middle_name"],
+        age[ok.index].astype(int), ok["description"],
+    ))
+
+
+def _check_bookings(db, df, errors) -> tuple[list[tuple], list]:
+    dates = pd.to_datetime(df["date"], format="%Y-%m-%d", errors="coerce").fillna(
+        pd.to_datetime(df["date"], format="%d.%m.%Y", errors="coerce"))
+    times = pd.to_datetime(df["time"], format="%H:%M", errors="coerce").dt.strftime("%H:%M")
+    lanes = pd.to_numeric(df["lane"], errors="coerce")
+    user_ids = df["username"].map(dict(
+        db.query(User.username, User.id).filter(User.username.in_(df["username"].unique().tolist()))))
+    trainer_ids = df["trainer"].map(dict(
+        db.query(Trainer.name, Trainer.id).filter(Trainer.name.in_(df["trainer"].unique().tolist()))))
+    ts_ids = times.map(_timeslot_ids(db))
+
+    _flag(errors, dates.isna(), "дата должна быть ГГГГ-ММ-ДД или ДД.ММ.ГГГГ")
+    _flag(errors, ts_ids.isna(), "нет такого слота времени")
+    _flag(errors, ~lanes.between(1, NUM_LANES), f"дорожка должна быть от 1 до {NUM_LANES}")
+    _flag(errors, user_ids.isna(), "нет такого пользователя")
+    _flag(errors, df["trainer"].ne("") & trainer_ids.isna(), "нет такого тренера")
+
+    ok = errors.eq("")
+    frame = pd.DataFrame({
+        "date": dates.dt.date, "timeslot_id": ts_ids, "lane": lanes,
+        "user_id": user_ids, "trainer_id": trainer_ids,
+    })[ok]
+    if frame.empty:
+        return [], []
+    frame = frame.astype({"timeslot_id": int, "lane": int, "user_id": int})
+    _flag(errors, frame.duplicated(["date", "timeslot_id", "lane"]).reindex(df.index, fill_value=False),
+          "дорожка повторяется в файле")
+    with_trainer = frame[frame["trainer_id"].notna()]
+    _flag(errors, with_trainer.duplicated(["date", "timeslot_id", "trainer_id"]).reindex(df.index, fill_value=False),
+          "тренер повторяется в файле")
+
+    # занятость из сводки: одна выборка на диапазон дат файла, дальше — битовые операции
+    occ = pd.DataFrame(
+        db.query(SlotOccupancy.date, SlotOccupancy.timeslot_id, SlotOccupancy.booked_mask,
+                 SlotOccupancy.closed_mask, SlotOccupancy.trainer_ids)
+        .filter(SlotOccupancy.date.between(frame["date"].min(), frame["date"].max())).all(),
+        columns=["date", "timeslot_id", "booked_mask", "closed_mask", "busy_trainers"],
+    )
+    merged = frame.reset_index().merge(occ, on=["date", "timeslot_id"], how="left").set_index("index")
+    bit = np.left_shift(1, merged["lane"].to_numpy() - 1)
+    _flag(errors, pd.Series((merged["closed_mask"].fillna(0).to_numpy().astype(int) & bit) > 0,
+                            index=merged.index).reindex(df.index, fill_value=False), "дорожка закрыта")
+    _flag(errors, pd.Series((merged["booked_mask"].fillna(0).to_numpy().astype(int) & bit) > 0,
+                            index=merged.index).reindex(df.index, fill_value=False), "дорожка уже занята")
+    trainer_busy = [
+        pd.notna(tid) and str(int(tid)) in (busy or "").split(",")
+        for tid, busy in zip(merged["trainer_id"], merged["busy_trainers"])
+    ]
+    _flag(errors, pd.Series(trainer_busy, index=merged.index, dtype=bool).reindex(df.index, fill_value=False),
+          "тренер уже занят")
+
+    frame = frame[errors[frame.index].eq("")]
+    lane_ids = _lane_ids(db, range(1, NUM_LANES + 1))
+    rows = [
+        (uid, d, ts, lane_ids[lane], None if pd.isna(tid) else int(tid))
+        for uid, d, ts, lane, tid in zip(frame["user_id"], frame["date"], frame["timeslot_id"],
+                                         frame["lane"], frame["trainer_id"])
+    ]
+    return rows, list(set(zip(frame["date"], frame["timeslot_id"])))
+
+
+@with_session
+def import_frame(db, kind: str, df: pd.DataFrame) -> dict:
+    """Загружает таблицу вида kind; возвращает {"total", "inserted", "skipped", "errors"}.
+
+    errors — DataFrame (row, error) по отклонённым строкам (row — номер строки данных с 1);
+    skipped — прошедшие проверку строки, которые к моменту вставки уже кто-то добавил.
+    """
+    required, optional = IMPORT_COLUMNS[kind]
+    missing = [c for c in required if c not in df.columns]
+    if missing:
+        raise ValueError(f"В файле нет колонок: {', '.join(missing)}")
+    df = df.reset_index(drop=True).assign(**{c: v for c, v in optional.items() if c not in df.columns})
+    errors = pd.Series("", index=df.index, dtype=object)
+    for col in required:
+        _flag(errors, df[col].eq(""), f"не заполнено поле {col}")
+
+    if kind == "users":
+        rows = _check_users(db, df, errors)
+        inserted = _stage_and_merge(
+            db, User,
+            ["username", "pwd_hash", "role", "first_name", "last_name", "middle_name",
+             "phone", "gender", "email", "is_confirmed"],
+            rows,
+            lambda t, s: or_(t.c.username == s.c.username, t.c.email == s.c.email),
+        )
+        events.publish(db, "users")
+    elif kind == "trainers":
+        rows = _check_trainers(db, df, errors)
+        inserted = _stage_and_merge(
+            db, Trainer,
+            ["name", "first_name", "last_name", "middle_name", "agebigint", "description"],
+            rows,
+            lambda t, s: t.c.name == s.c.name,
+        )
+        events.publish(db, "trainers")
+    else:
+        rows, keys = _check_bookings(db, df, errors)
+        inserted = _stage_and_merge(
+            db, Booking,
+            ["user_id", "date", "timeslot_id", "lane", "trainer_id"],
+            rows,
+            lambda t, s: and_(t.c.date == s.c.date, t.c.timeslot_id == s.c.timeslot_id, t.c.lane == s.c.lane),
+        )
+        _touch_occupancy(db, keys)
+    db.commit()
+
+    bad = errors[errors.ne("")]
+    return {
+        "total": len(df),
+        "inserted": inserted,
+        "skipped": len(rows) - inserted,
+        "errors": pd.DataFrame({"row": bad.index + 1, "error": bad.to_numpy()}),
+    }
+
+
+def import_file(kind: str, source, fmt: str | None = None) -> dict:
+    return import_frame(kind, read_table(source, fmt))
@@ -0,0 +1,128 @@
+# logs.py — журнал приложения: JSON-строки в файл с ротацией, запись в отдельном потоке
+#
+# setup() настраивает корневой логгер один раз на процесс. Вызывающий поток только
+# кладёт запись в очередь (QueueHandler); форматирование и запись на диск делает
+# QueueListener в своём потоке, поэтому медленный диск не тормозит страницы.
+#
+# Настройки — [logging] в secrets: path, level, rotate = "size" | "time",
+# max_mb и backups (для size), when и backups (для time).
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+CONTEXT_FIELDS = ("session", "request", "user", "duration_ms")
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+SESSION_TTL = 3600.0     # контекст сессии без перезапусков столько секунд считается брошенным
+MAX_SESSIONS = 10000     # сверх этого числа брошенные сессии вычищаются при следующем bind()
+
+_listener: QueueListener | None = None
+_setup_lock = threading.Lock()
+_sessions: dict[str, tuple[float, dict]] = {}  # session_id Streamlit -> (monotonic, {"request": …, "user": …})
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: ts, level, logger, msg и поля контекста, если есть."""
+
+    def format(self, record):
+        data = {
+            "ts": f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(QueueHandler):
+    """Кладёт в очередь копию записи с уже подставленным текстом и контекстом сессии.
+
+    Контекст берётся в потоке скрипта Streamlit — в потоке записи его уже не узнать.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        ctx = get_script_run_ctx(suppress_warning=True)
+        if ctx is not None:
+            record.session = ctx.session_id
+            for key, value in _sessions.get(ctx.session_id, (0.0, {}))[1].items():
+                if getattr(record, key, None) is None:
+                    setattr(record, key, value)
+        return record
+
+
+def bind(**fields) -> None:
+    """Поля контекста текущей сессии Streamlit (user, …); request меняется на каждом перезапуске."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None:
+        return
+    now = time.monotonic()
+    if len(_sessions) > MAX_SESSIONS:
+        for session_id, (seen, _) in list(_sessions.items()):
+            if seen + SESSION_TTL <= now:
+                _sessions.pop(session_id, None)
+    _sessions[ctx.session_id] = (now, {"request": uuid.uuid4().hex[:12], **fields})
+
+
+@contextmanager
+def timed(logger: logging.Logger, message: str, level: int = logging.INFO):
+    """Пишет message с полем duration_ms — временем выполнения блока."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if logger.isEnabledFor(level):
+            logger.log(level, message, extra={"duration_ms": round((time.perf_counter() - start) * 1000, 1)})
+
+
+def _file_handler(cfg) -> logging.Handler:
+    path = cfg.get("path", "../app.log")
+    backups = int(cfg.get("backups", 10))
+    if cfg.get("rotate", "size") == "time":
+        return TimedRotatingFileHandler(path, when=cfg.get("when", "midnight"), backupCount=backups, encoding="utf-8")
+    return RotatingFileHandler(path, maxBytes=int(cfg.get("max_mb", 20)) * 2**20, backupCount=backups,
+                               encoding="utf-8")
+
+
+def setup() -> None:
+    """Настраивает корневой логгер; повторные вызовы (перезапуски скрипта) ничего не делают."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        cfg = st.secrets.get("logging", {})
+        file_handler = _file_handler(cfg)
+        file_handler.setFormatter(JsonFormatter())
+        console = logging.StreamHandler(sys.stderr)
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        log_queue = queue.SimpleQueue()
+        _listener = QueueListener(log_queue, file_handler, console, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(ContextQueueHandler(log_queue))
+        root.setLevel(cfg.get("level", "INFO"))
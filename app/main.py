@@ -4,22 +4,17 @@ st.set_page_config(layout='wide')
 
 import logging
 from app.db import init_db
-from app import utils
+from app import events, logs, metrics, utils
 from auth import login, register, register_org
 from booking import booking_page
 from admin import admin_page
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    handlers=[
-        logging.FileHandler("../app.log", encoding="utf-8"),
-        logging.StreamHandler(),
-    ]
-)
+logs.setup()  # один раз на процесс; запись в файл — в отдельном потоке
+metrics.start_server()  # /metrics на локальном порту, тоже один раз на процесс
 logger = logging.getLogger(__name__)
 
-init_db()
+init_db()  # миграции — один раз на процесс (db.migrate_once), дальше только проверка справочников
+events.start_listener()  # один поток на процесс: сброс кэшей по событиям других процессов
 
 for key, val in [
     ("logged_in", False),
@@ -28,6 +23,10 @@ for key, val in [
     ("auth_page", "login")
 ]:
     st.session_state.setdefault(key, val)
+logs.bind(user=st.session_state["username"] or None)
+
+HIGH_LOAD_MESSAGE = "Сейчас высокая нагрузка на сервер. Повторите действие через минуту."
+
 
 def logout_action():
     user = st.session_state["username"]
@@ -36,18 +35,26 @@ def logout_action():
     utils.safe_rerun()
 
 if not st.session_state["logged_in"]:
-    if st.session_state["auth_page"] == "login":
-        login()
-    elif st.session_state["auth_page"] == "register_org":
-        register_org()
-    else:
-        register()
+    # вход и регистрация тоже ходят в БД, и как раз в часы пик
+    try:
+        if st.session_state["auth_page"] == "login":
+            login()
+        elif st.session_state["auth_page"] == "register_org":
+            register_org()
+        else:
+            register()
+    except utils.Overloaded:
+        st.warning(HIGH_LOAD_MESSAGE)
 else:
     if st.session_state["role"] == "admin":
         st.sidebar.write(f"👤 **{st.session_state['username']}** ({st.session_state['role']})")
         if st.sidebar.button("Выход"):
             logout_action()
-        admin_page()
+        try:
+            with logs.timed(logger, "admin_page", logging.DEBUG), metrics.page("admin_page"):
+                admin_page()
+        except utils.Overloaded:
+            st.warning(HIGH_LOAD_MESSAGE)
     else:
         # Обычный пользователь или юр. лицо: кнопка справа в первой строке
         cols = st.columns([6, 1])
@@ -59,4 +66,8 @@ else:
                 f"</div>", unsafe_allow_html=True)
             if st.button("Выйти", key="logout_btn_right"):
                 logout_action()
-        booking_page()
+        try:
+            with logs.timed(logger, "booking_page", logging.DEBUG), metrics.page("booking_page"):
+                booking_page()
+        except utils.Overloaded:
+            st.warning(HIGH_LOAD_MESSAGE)
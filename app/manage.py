@@ -0,0 +1,195 @@
+# manage.py — служебные команды: python -m app.manage <команда>
+import argparse
+import sys
+import timeit
+from datetime import date, datetime, time, timedelta
+
+from app import db, export, importer, logs, utils
+
+
+def _date(value: str) -> date:
+    return date.fromisoformat(value)
+
+
+def cmd_occupancy(args) -> int:
+    if args.action == "rebuild":
+        n = utils.rebuild_occupancy(args.date_from, args.date_to)
+        print(f"slot_occupancy: перестроено строк: {n}")
+        return 0
+    drift = utils.verify_occupancy(args.date_from, args.date_to)
+    for d, ts_id in drift:
+        print(f"расхождение: {d} timeslot_id={ts_id}")
+    print(f"slot_occupancy: расхождений: {len(drift)}")
+    return 1 if drift else 0
+
+
+def cmd_export(args) -> int:
+    out = open(args.output, "wb") if args.output != "-" else sys.stdout.buffer
+    try:
+        for chunk in export.iter_export(args.kind, args.format, args.date_from, args.date_to, args.batch_size):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    return 0
+
+
+def cmd_import(args) -> int:
+    report = importer.import_file(args.kind, args.file, args.format)
+    print(f"строк: {report['total']}, добавлено: {report['inserted']}, пропущено: {report['skipped']}")
+    errors = report["errors"]
+    if args.errors:
+        errors.to_csv(args.errors, index=False)
+    else:
+        for row, error in errors.itertuples(index=False):
+            print(f"строка {row}: {error}")
+    return 1 if len(errors) else 0
+
+
+def cmd_migrate(args) -> int:
+    failed = db.migrate()
+    print(f"миграции применены, ошибок: {failed}" + (" (см. лог)" if failed else ""))
+    return 1 if failed else 0
+
+
+def cmd_archive(args) -> int:
+    before = db.archive_boundary(args.horizon)
+    moved = db.archive_partitions(args.horizon)
+    for name in moved:
+        print(f"в архив: {name}")
+    print(f"секций перенесено: {len(moved)} (всё до {before:%d.%m.%Y})")
+    return 0
+
+
+def _orm_slot_occupancy(s, d, time_str):
+    t = datetime.strptime(time_str, "%H:%M").time()
+    return (
+        s.query(db.SlotOccupancy.booked_mask, db.SlotOccupancy.closed_mask, db.SlotOccupancy.trainer_ids)
+        .join(db.Timeslot, db.SlotOccupancy.timeslot_id == db.Timeslot.id)
+        .filter(db.SlotOccupancy.date == d, db.Timeslot.time == t)
+        .first()
+    )
+
+
+def cmd_bench(args) -> int:
+    """Накладные расходы Python на вызов горячих запросов utils (SQLite в памяти, без сети).
+
+    Для сравнения рядом — те же выборки через db.query(...), как до заготовленных запросов.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    db.Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    utils.SessionLocal = Session
+    utils.ReplicaSessions = []
+    utils.add_user("bench", "bench", "Б", "Б", "", "+70000000000", "male", "bench@example.com", is_confirmed=1)
+    utils.add_timeslot(time(10, 0))
+    d = date(2030, 1, 7)
+    utils.add_booking("bench", d, "10:00", 1)
+
+    with Session() as s:
+        ts_id, lane_id = utils._get_timeslot(s, "10:00").id, utils._get_lane(s, 1).id
+        # имя -> (ORM-запрос, собираемый на каждом вызове; заготовленный запрос utils)
+        cases = {
+            "_get_lane": (
+                lambda: s.query(db.Lane).filter_by(number=1).first(),
+                lambda: utils._get_lane(s, 1),
+            ),
+            "_get_timeslot": (
+                lambda: s.query(db.Timeslot).filter_by(time=datetime.strptime("10:00", "%H:%M").time()).first(),
+                lambda: utils._get_timeslot(s, "10:00"),
+            ),
+            "user по логину": (
+                lambda: s.query(db.User).filter_by(username="bench").first(),
+                lambda: utils._user_by_name(s, "bench"),
+            ),
+            "_booking_exists": (
+                lambda: s.query(db.Booking).filter_by(date=d, timeslot_id=ts_id, lane_id=lane_id).first() is not None,
+                lambda: utils._booking_exists(s, d, ts_id, lane_id),
+            ),
+            "_slot_occupancy": (
+                lambda: _orm_slot_occupancy(s, d, "10:00"),
+                lambda: utils._slot_occupancy(s, d, "10:00"),
+            ),
+        }
+        print(f"{'':<18} {'ORM':>8} {'заготовка':>10}   мкс/вызов")
+        for name, fns in cases.items():
+            orm, prebuilt = (min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number for fn in fns)
+            print(f"{name:<18} {orm * 1e6:8.1f} {prebuilt * 1e6:10.1f}   ×{orm / prebuilt:.1f}")
+    return 0
+
+
+def cmd_grid_bench(args) -> int:
+    """Оба движка недельной сетки на рабочей БД (без кэшей страниц): мс на неделю."""
+    week = args.week or date.today()
+    week -= timedelta(days=week.weekday())
+    engines = {
+        "python": lambda: utils.assemble_week_grid(
+            week, utils.list_timeslots(), utils.week_occupancy(week, week + timedelta(days=6)),
+            utils.get_trainer_schedule_matrix(),
+        ),
+        "sql": lambda: utils.week_grid(week),
+    }
+    grids = {name: fn() for name, fn in engines.items()}
+    for name, fn in engines.items():
+        best = min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+        print(f"{name:<8} {best * 1e3:8.2f} мс/неделя")
+    if grids["python"] != grids["sql"]:
+        print(f"сетки различаются ({week:%d.%m.%Y}) — сверьте сводку: python -m app.manage occupancy verify")
+        return 1
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.manage")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    occ = sub.add_parser("occupancy", help="проверка/перестройка сводки slot_occupancy")
+    occ.add_argument("action", choices=["verify", "rebuild"])
+    occ.add_argument("--from", dest="date_from", type=_date, default=None)
+    occ.add_argument("--to", dest="date_to", type=_date, default=None)
+    occ.set_defaults(func=cmd_occupancy)
+
+    exp = sub.add_parser("export", help="выгрузка в CSV/Parquet потоком из серверного курсора")
+    exp.add_argument("kind", choices=list(export.EXPORT_COLUMNS))
+    exp.add_argument("--format", choices=list(export.FORMATS), default="csv")
+    exp.add_argument("--from", dest="date_from", type=_date, default=None)
+    exp.add_argument("--to", dest="date_to", type=_date, default=None)
+    exp.add_argument("--batch-size", type=int, default=export.BATCH_SIZE)
+    exp.add_argument("-o", "--output", default="-", help="файл; по умолчанию stdout")
+    exp.set_defaults(func=cmd_export)
+
+    imp = sub.add_parser("import", help="массовая загрузка из CSV/Parquet с отчётом об ошибках")
+    imp.add_argument("kind", choices=list(importer.IMPORT_COLUMNS))
+    imp.add_argument("file")
+    imp.add_argument("--format", choices=["csv", "parquet"], default=None, help="по умолчанию — по расширению")
+    imp.add_argument("--errors", default=None, help="куда сохранить отчёт об ошибках (CSV)")
+    imp.set_defaults(func=cmd_import)
+
+    mig = sub.add_parser("migrate", help="создание таблиц, миграции, индексы и секции на месяцы вперёд")
+    mig.set_defaults(func=cmd_migrate)
+
+    arc = sub.add_parser("archive", help="перенос месячных секций bookings/closed_slots в схему archive")
+    arc.add_argument("--horizon", type=int, default=None,
+                     help=f"сколько месяцев держать в горячих таблицах (по умолчанию {db.ARCHIVE_HORIZON_MONTHS})")
+    arc.set_defaults(func=cmd_archive)
+
+    bench = sub.add_parser("bench", help="микробенчмарк горячих запросов utils (мкс на вызов)")
+    bench.add_argument("-n", "--number", type=int, default=2000, help="вызовов на замер")
+    bench.set_defaults(func=cmd_bench)
+
+    grid = sub.add_parser("grid-bench", help="сравнение движков недельной сетки (python / sql) на рабочей БД")
+    grid.add_argument("--week", type=_date, default=None, help="любая дата недели; по умолчанию текущая")
+    grid.add_argument("-n", "--number", type=int, default=50, help="вызовов на замер")
+    grid.set_defaults(func=cmd_grid_bench)
+
+    args = parser.parse_args(argv)
+    logs.setup()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
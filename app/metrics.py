@@ -0,0 +1,159 @@
+# metrics.py — метрики приложения в формате Prometheus
+#
+# Счётчики и гистограммы обновляются на месте (utils, страницы, события пула engine),
+# а отдаются отдельным HTTP-потоком на локальном порту: start_server() один раз на
+# процесс. Состояние пула читается только в момент опроса, так что без опроса
+# остаются лишь инкременты в памяти. Настройки — [metrics] в secrets: port, api_port.
+#
+# Реестр у каждого процесса свой, поэтому и порт нужен свой: при нескольких процессах
+# Streamlit (или воркерах API) каждому задаётся WATERPOOL_METRICS_PORT, например
+# 9108, 9110, 9111..., и Prometheus опрашивает все эти порты. Переменная важнее secrets;
+# без неё все процессы берут общий порт и метрики отдаёт только первый.
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import streamlit as st
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9108      # процесс Streamlit
+DEFAULT_API_PORT = 9109  # процесс API (app/api.py)
+PORT_ENV = "WATERPOOL_METRICS_PORT"  # порт этого процесса, если их несколько
+
+BOOKINGS = Counter("waterpool_bookings_total", "Созданные брони", ["kind"])  # single | group
+CANCELLATIONS = Counter("waterpool_cancellations_total", "Отменённые брони", ["kind"])
+LOGINS = Counter("waterpool_logins_total", "Попытки входа", ["result"])  # ok | fail
+LOGIN_SECONDS = Histogram("waterpool_login_seconds", "Время проверки логина и пароля")
+DB_SECONDS = Histogram(
+    "waterpool_db_call_seconds", "Время вызова функций utils (сессия БД целиком)", ["function"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_RETRIES = Counter("waterpool_db_retries_total", "Повторы транзакций при временных ошибках", ["function"])
+PAGE_SECONDS = Histogram("waterpool_page_seconds", "Время отрисовки страницы", ["page"])
+PAGE_DB_SECONDS = Histogram("waterpool_page_db_seconds", "Время в БД за одну отрисовку страницы", ["page"])
+CACHE_REQUESTS = Counter("waterpool_cache_requests_total", "Обращения к кэшам st.cache_data", ["cache"])
+CACHE_MISSES = Counter("waterpool_cache_misses_total", "Промахи кэшей st.cache_data", ["cache"])
+POOL_CHECKOUTS = Counter("waterpool_db_pool_checkouts_total", "Выдачи соединений из пула", ["engine"])
+POOL_CONNECTS = Counter("waterpool_db_pool_connects_total", "Новые соединения с БД", ["engine"])
+POOL_INVALIDATED = Counter("waterpool_db_pool_invalidated_total", "Сброшенные соединения", ["engine"])
+POOL_STATE = Gauge("waterpool_db_pool_connections", "Соединения пула по состояниям", ["engine", "state"])
+POOL_WAIT = Histogram(
+    "waterpool_db_pool_wait_seconds", "Ожидание соединения из пула",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10),
+)
+POOL_HOLD = Histogram("waterpool_db_pool_hold_seconds", "Сколько функция utils держит соединение", ["function"])
+POOL_LEAKS = Counter("waterpool_db_pool_long_holds_total", "Соединения, удержанные дольше leak_seconds", ["function"])
+POOL_OLDEST = Gauge("waterpool_db_pool_oldest_checkout_seconds", "Возраст самого давнего выданного соединения",
+                    ["engine"])
+ADMISSION_SHED = Counter("waterpool_admission_shed_total", "Отклонённые под нагрузкой отчёты", ["function"])
+
+_local = threading.local()  # function и db_seconds — текущий вызов utils и время в БД потока скрипта
+_server_lock = threading.Lock()
+_server_started = False
+
+
+@contextmanager
+def db_call(function: str):
+    """Время вызова функции utils; соединения, взятые внутри, помечаются её именем."""
+    _local.function = function
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _local.function = None
+        DB_SECONDS.labels(function).observe(seconds)
+        _local.db_seconds = getattr(_local, "db_seconds", 0.0) + seconds
+
+
+@contextmanager
+def page(name: str):
+    """Время отрисовки страницы и сколько из него ушло на вызовы utils."""
+    _local.db_seconds = 0.0
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+        PAGE_DB_SECONDS.labels(name).observe(_local.db_seconds)
+
+
+def cached(name: str, **cache_kwargs):
+    """st.cache_data со счётчиками обращений и промахов (тело функции выполняется только при промахе)."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def miss(*args, **kwargs):
+            CACHE_MISSES.labels(name).inc()
+            return fn(*args, **kwargs)
+
+        cache = st.cache_data(**cache_kwargs)(miss)
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            CACHE_REQUESTS.labels(name).inc()
+            return cache(*args, **kwargs)
+
+        call.clear = cache.clear
+        return call
+    return decorate
+
+
+def instrument_engine(engine, name: str, leak_seconds: float = 30.0) -> None:
+    """События и состояние пула engine; удержание соединения дольше leak_seconds — в лог."""
+    held: dict[int, tuple[float, str]] = {}  # id записи пула -> (когда выдано, функция utils)
+
+    def on_checkout(dbapi_conn, record, proxy):
+        POOL_CHECKOUTS.labels(name).inc()
+        held[id(record)] = (time.monotonic(), getattr(_local, "function", None) or "other")
+
+    def on_checkin(dbapi_conn, record):
+        since, function = held.pop(id(record), (None, None))
+        if since is None:
+            return
+        seconds = time.monotonic() - since
+        POOL_HOLD.labels(function).observe(seconds)
+        if seconds > leak_seconds:
+            POOL_LEAKS.labels(function).inc()
+            logger.warning("%s держал соединение %s %.1f с — не закрытая вовремя сессия?", function, name, seconds)
+
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "checkin", on_checkin)
+    event.listen(engine, "connect", lambda *_: POOL_CONNECTS.labels(name).inc())
+    event.listen(engine, "invalidate", lambda *_: POOL_INVALIDATED.labels(name).inc())
+    POOL_OLDEST.labels(name).set_function(
+        lambda: max((time.monotonic() - since for since, _ in list(held.values())), default=0.0))
+    pool = engine.pool
+    if not hasattr(pool, "overflow"):  # у пулов SQLite этих счётчиков нет
+        return
+    POOL_STATE.labels(name, "size").set_function(pool.size)
+    POOL_STATE.labels(name, "checked_out").set_function(pool.checkedout)
+    POOL_STATE.labels(name, "idle").set_function(pool.checkedin)
+    # QueuePool.overflow() отсчитывается от -pool_size, пока пул не заполнен
+    POOL_STATE.labels(name, "overflow").set_function(lambda: max(pool.overflow(), 0))
+
+
+def start_server(port: int | None = None) -> bool:
+    """Поднимает HTTP-поток с /metrics на 127.0.0.1 один раз на процесс; занятый порт — не ошибка.
+
+    Порт: WATERPOOL_METRICS_PORT, затем аргумент, затем [metrics] port.
+    """
+    global _server_started
+    cfg = st.secrets.get("metrics", {})
+    port = int(os.environ.get(PORT_ENV) or port or cfg.get("port", DEFAULT_PORT))
+    with _server_lock:
+        if _server_started:
+            return True
+        try:
+            start_http_server(port, addr=cfg.get("addr", "127.0.0.1"))
+        except OSError as e:
+            logger.warning("Метрики на порту %d не запущены: %s (свой порт процесса — %s)", port, e, PORT_ENV)
+            return False
+        _server_started = True
+    logger.info("Метрики: http://%s:%d/metrics", cfg.get("addr", "127.0.0.1"), port)
+    return True
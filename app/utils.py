@@ -1,43 +1,607 @@
 # utils.py — адаптирован под новую схему
+import io
+import logging
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import NamedTuple
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 import streamlit as st
-from datetime import datetime, time as dt_time
+from sqlalchemy import (
+    Date, Integer, and_, bindparam, case, cast, event, func, insert, literal, select, true, tuple_, union_all,
+    update,
+)
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeout
+from sqlalchemy.orm import Session
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from datetime import date as dt_date, datetime, timedelta, time as dt_time
 from passlib.hash import bcrypt
+from tenacity import (
+    Retrying, retry_if_exception, stop_after_attempt, stop_after_delay, wait_random_exponential,
+)
 
+from app import events, metrics
 from app.db import (
-    SessionLocal, User, Lane, Timeslot, Trainer, TrainerSchedule,
-    Booking, OrgBookingGroup, ClosedSlot
+    ENGINE, MAX_OVERFLOW, POOL_SETTINGS, SessionLocal, ReplicaSessions, User, Lane, Timeslot, Trainer, TrainerSchedule,
+    Booking, OrgBookingGroup, ClosedSlot, SlotOccupancy, USER_SEARCH
 )
 
+logger = logging.getLogger(__name__)
+
+
+#  строки списков: именованные кортежи вместо dict — без __dict__ на строку и неизменяемы
+class BookingRow(NamedTuple):
+    id: int
+    user: str
+    date: dt_date
+    time: str
+    lane: int
+    trainer: str  # "—", если без тренера
+
+
+class GroupRow(NamedTuple):
+    id: int
+    date: dt_date
+    times: str  # "HH:MM,HH:MM,…"
+    lanes: str  # "1,2,…"
+
+
+class ClosedRow(NamedTuple):
+    id: int
+    date: dt_date
+    time: str
+    lane: int
+    comment: str
+
+
+class ScheduleRow(NamedTuple):
+    id: int
+    trainer: str
+    short_fio: str
+    day_of_week: int
+    time: str
+
+
+@lru_cache(maxsize=None)
+def _hhmm(t: dt_time) -> str:
+    """"HH:MM" слота: форматируется один раз на время, строка общая для всех строк."""
+    return sys.intern(t.strftime("%H:%M"))
+
+
+#  таблицы Arrow (as_arrow=True) — для st.dataframe без промежуточных dict и DataFrame
+ARROW_BATCH_SIZE = 5000
+
+USER_ARROW_SCHEMA = pa.schema([
+    ("id", pa.int64()), ("username", pa.string()), ("role", pa.string()),
+    ("first_name", pa.string()), ("last_name", pa.string()), ("middle_name", pa.string()),
+    ("phone", pa.string()), ("gender", pa.string()), ("email", pa.string()),
+    ("is_confirmed", pa.int64()),
+])
+BOOKING_ARROW_SCHEMA = pa.schema([
+    ("id", pa.int64()), ("user", pa.string()), ("date", pa.date32()),
+    ("time", pa.time64("us")), ("lane", pa.int64()), ("trainer", pa.string()),
+])
+
+
+def _arrow_table_copy(db, stmt, schema: pa.Schema) -> pa.Table:
+    """PostgreSQL: COPY (запрос) TO STDOUT в CSV и разбор pyarrow.csv — строки минуют Python."""
+    conn = db.connection()
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    buf = io.BytesIO()
+    with conn.connection.cursor() as cur:
+        query = cur.mogrify(str(compiled), compiled.params).decode()
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", buf)
+    buf.seek(0)
+    # в CSV от COPY NULL — пустое поле без кавычек, пустая строка — ""
+    return pa_csv.read_csv(
+        buf,
+        read_options=pa_csv.ReadOptions(column_names=schema.names),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=schema, strings_can_be_null=True, quoted_strings_can_be_null=False),
+    ).cast(schema)
+
+
+def _arrow_table(db, stmt, schema: pa.Schema, batch_size: int = ARROW_BATCH_SIZE) -> pa.Table:
+    """Результат запроса как pyarrow.Table; колонки времени (time64) отдаются строками "HH:MM".
+
+    На PostgreSQL (psycopg2) — через COPY, без Row на строку. Другие драйверы отдают только
+    кортежи: их читаем пачками по batch_size и каждую пачку сразу раскладываем по колонкам.
+    """
+    if db.get_bind().dialect.driver == "psycopg2":
+        table = _arrow_table_copy(db, stmt, schema)
+    else:
+        result = db.execute(stmt.execution_options(yield_per=batch_size))
+        batches = [
+            pa.record_batch([pa.array(col, type=f.type) for col, f in zip(zip(*part), schema)], schema=schema)
+            for part in result.partitions()
+        ]
+        table = pa.Table.from_batches(batches, schema=schema)
+    for i, f in enumerate(schema):
+        if pa.types.is_time(f.type):
+            table = table.set_column(i, f.name, pc.strftime(table.column(i), "%H:%M"))
+    return table
+
+
+class Overloaded(Exception):
+    """БД перегружена: соединение из пула не получено или отчёт отложен ради бронирований."""
+
+
+@contextmanager
+def _session(make_session=None):
+    """Сессия с уже взятым из пула соединением; ожидание пула — в метрику.
+
+    Не дождались соединения за pool_timeout — Overloaded вместо TimeoutError пула.
+    """
+    with (make_session or SessionLocal)() as db:
+        start = time.perf_counter()
+        try:
+            db.connection()
+        except PoolTimeout as e:
+            raise Overloaded("Нет свободных соединений с БД") from e
+        finally:
+            metrics.POOL_WAIT.observe(time.perf_counter() - start)
+        yield db
+
+
 def with_session(func):
     def wrapper(*args, **kwargs):
-        with SessionLocal() as db:
+        with metrics.db_call(func.__name__), _session() as db:
             return func(db, *args, **kwargs)
     return wrapper
 
+#  маршрутизация чтения на реплики
+STICKY_SECONDS = 5.0          # после записи сессия ещё столько читает с primary
+REPLICA_RETRY_SECONDS = 30.0  # недоступная реплика исключается на это время
+_sticky_until: dict = {}      # ключ сессии -> monotonic-время, до которого читаем с primary
+_replica_down: dict = {}      # индекс реплики -> monotonic-время, до которого её не трогаем
+# вызывающий вне Streamlit: API ставит его на каждый запрос, чтобы чужая запись
+# не уводила его чтения на primary
+caller_key: ContextVar = ContextVar("caller_key", default=None)
+
+
+def _session_key():
+    """Сессия Streamlit или caller_key, из которых идёт вызов; иначе (CLI, тесты) — общий ключ."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else caller_key.get()
+
+
+@event.listens_for(Session, "after_commit")
+def _mark_write(session) -> None:
+    now = time.monotonic()
+    if len(_sticky_until) > 10000:
+        # снимок: другие потоки пишут в словарь параллельно
+        for key, until in list(_sticky_until.items()):
+            if until <= now:
+                _sticky_until.pop(key, None)
+    _sticky_until[_session_key()] = now + STICKY_SECONDS
+
+
+def _pick_replica():
+    """(индекс, sessionmaker) доступной реплики или None, если читать нужно с primary."""
+    now = time.monotonic()
+    if not ReplicaSessions or _sticky_until.get(_session_key(), 0) > now:
+        return None
+    alive = [i for i in range(len(ReplicaSessions)) if _replica_down.get(i, 0) <= now]
+    if not alive:
+        return None
+    i = random.choice(alive)
+    return i, ReplicaSessions[i]
+
+
+def with_read_session(func):
+    """Как with_session, но для функций только на чтение: реплика, если она есть и доступна.
+
+    Сессия, которая только что писала, STICKY_SECONDS читает с primary (read-your-writes).
+    При ошибке соединения с репликой или пустом пуле реплики вызов повторяется на primary.
+    """
+    def wrapper(*args, **kwargs):
+        with metrics.db_call(func.__name__):
+            replica = _pick_replica()
+            if replica is not None:
+                i, make_session = replica
+                try:
+                    with _session(make_session) as db:
+                        return func(db, *args, **kwargs)
+                except OperationalError as e:
+                    _replica_down[i] = time.monotonic() + REPLICA_RETRY_SECONDS
+                    logger.warning("Реплика %d недоступна, читаем с primary: %s", i, getattr(e, "orig", e))
+                except Overloaded:
+                    # пул реплики занят, но сама она жива — из ротации не исключаем
+                    logger.warning("Реплика %d перегружена, читаем с primary", i)
+            with _session() as db:
+                return func(db, *args, **kwargs)
+    return wrapper
+
+
+#  повтор записи при временных ошибках БД
+RETRY_ATTEMPTS = 4          # всего попыток, включая первую
+RETRY_BUDGET_SECONDS = 3.0  # после стольких секунд новых попыток не будет
+RETRY_WAIT_MAX = 0.5        # потолок паузы между попытками (экспонента со случайным разбросом)
+# serialization_failure, deadlock_detected, lock_not_available, admin_shutdown, cannot_connect_now
+RETRYABLE_PGCODES = {"40001", "40P01", "55P03", "57P01", "57P03"}
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Временная ли ошибка: конфликт сериализации, дедлок, обрыв соединения, занятая SQLite."""
+    if not isinstance(exc, DBAPIError):
+        return False
+    if exc.connection_invalidated:
+        return True
+    code = getattr(exc.orig, "pgcode", None) or ""
+    return code in RETRYABLE_PGCODES or code.startswith("08") or "database is locked" in str(exc.orig)
+
+
+def _log_retry(name: str, retry_state) -> None:
+    metrics.DB_RETRIES.labels(name).inc()
+    exc = retry_state.outcome.exception()
+    logger.warning("%s: временная ошибка БД, попытка %d/%d: %s", name,
+                   retry_state.attempt_number, RETRY_ATTEMPTS, getattr(exc, "orig", exc))
+
+
+def with_retry_session(func):
+    """Как with_session, но при временной ошибке вся транзакция повторяется в новой сессии.
+
+    Номер попытки лежит в db.info["attempt"]: на повторе функция должна распознать,
+    что предыдущая попытка могла успеть закоммитить (COMMIT прошёл, ответ потерян).
+    """
+    def wrapper(*args, **kwargs):
+        retrying = Retrying(
+            retry=retry_if_exception(is_retryable),
+            stop=stop_after_attempt(RETRY_ATTEMPTS) | stop_after_delay(RETRY_BUDGET_SECONDS),
+            wait=wait_random_exponential(multiplier=0.05, max=RETRY_WAIT_MAX),
+            before_sleep=lambda retry_state: _log_retry(func.__name__, retry_state),
+            reraise=True,
+        )
+        with metrics.db_call(func.__name__):
+            for attempt in retrying:
+                with attempt, _session() as db:
+                    db.info["attempt"] = attempt.retry_state.attempt_number
+                    result = func(db, *args, **kwargs)
+        if attempt.retry_state.attempt_number > 1:
+            logger.info("%s: выполнено с попытки %d", func.__name__, attempt.retry_state.attempt_number)
+        return result
+    return wrapper
+
+
+#  допуск тяжёлых чтений (отчёты, выгрузки) под нагрузкой: бронированиям соединения нужнее
+# [pool] в secrets: report_slots — сколько таких запросов одновременно на процесс,
+# report_wait — сколько секунд отчёт ждёт своей очереди, shed_ratio — при какой доле
+# занятых соединений пула (size + max_overflow) отчёты сразу отклоняются
+LOW_PRIORITY_SLOTS = int(POOL_SETTINGS.get("report_slots", 2))
+LOW_PRIORITY_WAIT = float(POOL_SETTINGS.get("report_wait", 3))
+SHED_RATIO = float(POOL_SETTINGS.get("shed_ratio", 0.7))
+_low_priority = threading.BoundedSemaphore(LOW_PRIORITY_SLOTS)
+
+
+def _pool_load() -> float:
+    """Доля занятых соединений primary; у пулов без переполнения (SQLite) — 0."""
+    pool = ENGINE.pool
+    if not hasattr(pool, "overflow"):
+        return 0.0
+    return pool.checkedout() / (pool.size() + MAX_OVERFLOW)
+
+
+@contextmanager
+def admit(name: str):
+    """Очередь для тяжёлого чтения name; пул почти исчерпан или очередь не дошла — Overloaded."""
+    if _pool_load() >= SHED_RATIO or not _low_priority.acquire(timeout=LOW_PRIORITY_WAIT):
+        metrics.ADMISSION_SHED.labels(name).inc()
+        logger.warning("%s отклонён: высокая нагрузка на БД", name)
+        raise Overloaded(f"{name}: высокая нагрузка на БД")
+    try:
+        yield
+    finally:
+        _low_priority.release()
+
+
+def with_report_session(func):
+    """Как with_session, но вызов проходит через admit() — для отчётов и выгрузок."""
+    session_func = with_session(func)
+
+    def wrapper(*args, **kwargs):
+        with admit(func.__name__):
+            return session_func(*args, **kwargs)
+    return wrapper
+
+
+NUM_LANES = 6  # количество дорожек в бассейне
+FULL_LANE_MASK = (1 << NUM_LANES) - 1  # бит (n-1) — дорожка n
+
 #  helpers
 def safe_rerun() -> None:
     getattr(st, "rerun", st.experimental_rerun)()
 
 
+def _insert_ignore(db, model, rows: list[dict]) -> int:
+    """INSERT … ON CONFLICT DO NOTHING одним запросом; возвращает число вставленных строк."""
+    if not rows:
+        return 0
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return db.execute(insert(model).values(rows).on_conflict_do_nothing()).rowcount
+
+
+#  горячие запросы: конструкции собраны один раз при импорте, их ключ кэша мемоизирован,
+#  и SQL берётся из compiled cache engine без повторной сборки Query на каждый вызов
+_LANE_BY_NUMBER = select(Lane).where(Lane.number == bindparam("number")).limit(1)
+_TIMESLOT_BY_TIME = select(Timeslot).where(Timeslot.time == bindparam("time")).limit(1)
+_USER_BY_NAME = select(User).where(User.username == bindparam("username")).limit(1)
+_TRAINER_BY_NAME = select(Trainer).where(Trainer.name == bindparam("name")).limit(1)
+_SLOT_OCCUPANCY = (
+    select(SlotOccupancy.booked_mask, SlotOccupancy.closed_mask, SlotOccupancy.trainer_ids)
+    .join(Timeslot, SlotOccupancy.timeslot_id == Timeslot.id)
+    .where(SlotOccupancy.date == bindparam("date"), Timeslot.time == bindparam("time"))
+    .limit(1)
+)
+_LANE_CLOSED = select(ClosedSlot.id).where(
+    ClosedSlot.date == bindparam("date"), ClosedSlot.timeslot_id == bindparam("timeslot_id"),
+    ClosedSlot.lane_id == bindparam("lane_id"),
+).limit(1)
+# (с дорожкой, с тренером) -> запрос; неиспользуемые параметры просто не попадают в SQL
+_BOOKING_EXISTS = {
+    (by_lane, by_trainer): select(Booking.id).where(
+        Booking.date == bindparam("date"), Booking.timeslot_id == bindparam("timeslot_id"),
+        *([Booking.lane_id == bindparam("lane_id")] if by_lane else []),
+        *([Booking.trainer_id == bindparam("trainer_id")] if by_trainer else []),
+    ).limit(1)
+    for by_lane in (False, True) for by_trainer in (False, True)
+}
+_DUPLICATE_BOOKING = (
+    select(Booking.id)
+    .where(
+        Booking.user_id == bindparam("user_id"), Booking.date == bindparam("date"),
+        Booking.timeslot_id == bindparam("timeslot_id"), Booking.lane_id == bindparam("lane_id"),
+        Booking.trainer_id.is_not_distinct_from(bindparam("trainer_id")),
+    )
+    .limit(1)
+)
+
+
+@lru_cache(maxsize=256)
+def _parse_hhmm(time_str: str) -> dt_time:
+    return datetime.strptime(time_str, "%H:%M").time()
+
+
+def _user_by_name(db, username: str) -> User | None:
+    return db.scalars(_USER_BY_NAME, {"username": username}).first()
+
+
+def _trainer_by_name(db, name: str) -> Trainer | None:
+    return db.scalars(_TRAINER_BY_NAME, {"name": name}).first()
+
+
 #  внутренняя «лента» и «слот»
 def _get_lane(db, lane_number: int) -> Lane:
-    lane = db.query(Lane).filter_by(number=lane_number).first()
+    lane = db.scalars(_LANE_BY_NUMBER, {"number": lane_number}).first()
     if not lane:
         lane = Lane(number=lane_number, name=f"Дорожка {lane_number}")
         db.add(lane)
         db.flush()
     return lane
 
+def _lane_ids(db, lane_numbers) -> dict[int, int]:
+    """{номер дорожки: id}; недостающие дорожки создаются."""
+    lane_numbers = list(lane_numbers)
+    ids = dict(db.query(Lane.number, Lane.id).filter(Lane.number.in_(list(lane_numbers))))
+    for n in lane_numbers:
+        if n not in ids:
+            ids[n] = _get_lane(db, n).id
+    return ids
+
+def _timeslot_ids(db) -> dict[str, int]:
+    return {_hhmm(t): ts_id for ts_id, t in db.query(Timeslot.id, Timeslot.time)}
+
 def _get_timeslot(db, time_str: str) -> Timeslot:
-    t = datetime.strptime(time_str, "%H:%M").time()
-    ts = db.query(Timeslot).filter_by(time=t).first()
+    t = _parse_hhmm(time_str)
+    ts = db.scalars(_TIMESLOT_BY_TIME, {"time": t}).first()
     if not ts:
         ts = Timeslot(time=t)
         db.add(ts)
         db.flush()
+        events.publish(db, "timeslots")
     return ts
 
 
+#  сводка занятости (slot_occupancy)
+def _compute_occupancy(db, keys=None, date_from=None, date_to=None) -> dict:
+    """{(дата, timeslot_id): [booked_mask, closed_mask, {trainer_id}]} по сырым таблицам."""
+    bq = db.query(Booking.date, Booking.timeslot_id, Lane.number, Booking.trainer_id).join(
+        Lane, Booking.lane_id == Lane.id)
+    cq = db.query(ClosedSlot.date, ClosedSlot.timeslot_id, Lane.number).join(
+        Lane, ClosedSlot.lane_id == Lane.id)
+    if keys is not None:
+        bq = bq.filter(tuple_(Booking.date, Booking.timeslot_id).in_(keys))
+        cq = cq.filter(tuple_(ClosedSlot.date, ClosedSlot.timeslot_id).in_(keys))
+    if date_from is not None:
+        bq, cq = bq.filter(Booking.date >= date_from), cq.filter(ClosedSlot.date >= date_from)
+    if date_to is not None:
+        bq, cq = bq.filter(Booking.date <= date_to), cq.filter(ClosedSlot.date <= date_to)
+
+    occ = {}
+    for d, ts_id, lane, trainer_id in bq:
+        row = occ.setdefault((d, ts_id), [0, 0, set()])
+        row[0] |= 1 << (lane - 1)
+        if trainer_id is not None:
+            row[2].add(trainer_id)
+    for d, ts_id, lane in cq:
+        occ.setdefault((d, ts_id), [0, 0, set()])[1] |= 1 << (lane - 1)
+    return occ
+
+
+def _occupancy_dict(key, row) -> dict:
+    return {
+        "date": key[0],
+        "timeslot_id": key[1],
+        "booked_mask": row[0],
+        "closed_mask": row[1],
+        "trainer_ids": ",".join(map(str, sorted(row[2]))),
+    }
+
+
+def _touch_occupancy(db, keys) -> None:
+    """Пересчитывает сводку для слотов [(дата, timeslot_id)] в текущей транзакции.
+
+    Строки сводки блокируются до пересчёта, так что параллельные записи в тот же слот
+    выполняются по очереди и видят данные друг друга.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    db.flush()
+    _insert_ignore(db, SlotOccupancy, [{"date": d, "timeslot_id": ts_id} for d, ts_id in keys])
+    db.query(SlotOccupancy.date).filter(
+        tuple_(SlotOccupancy.date, SlotOccupancy.timeslot_id).in_(keys)
+    ).with_for_update().all()
+    occ = _compute_occupancy(db, keys=keys)
+    events.publish(db, "occupancy", [d for d, _ in keys])
+    db.execute(update(SlotOccupancy), [
+        _occupancy_dict(key, occ.get(key, [0, 0, set()])) for key in keys
+    ])
+
+
+def _booking_keys(db, *criteria) -> list:
+    return db.query(Booking.date, Booking.timeslot_id).filter(*criteria).distinct().all()
+
+
+@with_session
+def rebuild_occupancy(db, date_from=None, date_to=None) -> int:
+    """Перестраивает сводку за период (по умолчанию целиком); возвращает число строк."""
+    q = db.query(SlotOccupancy)
+    if date_from is not None:
+        q = q.filter(SlotOccupancy.date >= date_from)
+    if date_to is not None:
+        q = q.filter(SlotOccupancy.date <= date_to)
+    q.delete(synchronize_session=False)
+    occ = _compute_occupancy(db, date_from=date_from, date_to=date_to)
+    if occ:
+        db.execute(insert(SlotOccupancy), [_occupancy_dict(k, v) for k, v in occ.items()])
+    events.publish(db, "occupancy")
+    db.commit()
+    return len(occ)
+
+
+@with_session
+def verify_occupancy(db, date_from=None, date_to=None) -> list:
+    """Слоты (дата, timeslot_id), где сводка разошлась с bookings/closed_slots."""
+    q = db.query(SlotOccupancy)
+    if date_from is not None:
+        q = q.filter(SlotOccupancy.date >= date_from)
+    if date_to is not None:
+        q = q.filter(SlotOccupancy.date <= date_to)
+    stored = {
+        (o.date, o.timeslot_id): _occupancy_dict((o.date, o.timeslot_id), [
+            o.booked_mask, o.closed_mask, {int(x) for x in o.trainer_ids.split(",") if x}
+        ]) for o in q
+    }
+    computed = {k: _occupancy_dict(k, v) for k, v in _compute_occupancy(db, date_from=date_from, date_to=date_to).items()}
+    empty = lambda k: _occupancy_dict(k, [0, 0, set()])
+    return sorted(
+        k for k in stored.keys() | computed.keys()
+        if stored.get(k, empty(k)) != computed.get(k, empty(k))
+    )
+
+
+def _slot_occupancy(db, date, time_str):
+    row = db.execute(_SLOT_OCCUPANCY, {"date": date, "time": _parse_hhmm(time_str)}).first()
+    if not row:
+        return 0, 0, set()
+    return row[0], row[1], {int(x) for x in row[2].split(",") if x}
+
+
+def _week_occupancy(db, date_from, date_to) -> dict:
+    rows = (
+        db.query(SlotOccupancy.date, Timeslot.time, SlotOccupancy.booked_mask,
+                 SlotOccupancy.closed_mask, SlotOccupancy.trainer_ids)
+        .join(Timeslot, SlotOccupancy.timeslot_id == Timeslot.id)
+        .filter(SlotOccupancy.date.between(date_from, date_to))
+    )
+    return {
+        (d, _hhmm(t)): (booked, closed, {int(x) for x in trainers.split(",") if x})
+        for d, t, booked, closed, trainers in rows
+    }
+
+
+@with_read_session
+def week_occupancy(db, date_from, date_to) -> dict:
+    """{(дата, "HH:MM"): (booked_mask, closed_mask, {trainer_id})} — только непустые слоты."""
+    return _week_occupancy(db, date_from, date_to)
+
+
+#  недельная сетка: {(дата, "HH:MM"): (booked_mask, closed_mask, has_trainer)} по всем клеткам
+# [booking] grid_engine в secrets: "python" — из сводки slot_occupancy и расписания
+# (на страницах они кэшируются по отдельности), "sql" — неделя одним запросом по bookings
+# и closed_slots; сравнить на своих данных: python -m app.manage grid-bench
+GRID_ENGINES = ("python", "sql")
+GRID_ENGINE = st.secrets.get("booking", {}).get("grid_engine", "python")
+
+
+def assemble_week_grid(week_start, times, occupancy, schedule) -> dict:
+    """Сетка из week_occupancy и get_trainer_schedule_matrix (движок "python")."""
+    grid = {}
+    for i in range(7):
+        d = week_start + timedelta(days=i)
+        for t in times:
+            booked, closed, _ = occupancy.get((d, t), (0, 0, None))
+            grid[d, t] = (booked, closed, bool(schedule.get((d.weekday(), t))))
+    return grid
+
+
+def _week_days(db, week_start):
+    """Дни недели (date, dow): generate_series на PostgreSQL, UNION ALL из семи строк на SQLite."""
+    if db.get_bind().dialect.name == "postgresql":
+        series = func.generate_series(week_start, week_start + timedelta(days=6), timedelta(days=1)) \
+            .table_valued("value").render_derived()
+        return select(
+            cast(series.c.value, Date).label("date"),
+            cast(func.extract("isodow", series.c.value) - 1, Integer).label("dow"),
+        ).subquery("days")
+    days = [week_start + timedelta(days=i) for i in range(7)]
+    return union_all(*[
+        select(literal(d, Date).label("date"), literal(d.weekday(), Integer).label("dow")) for d in days
+    ]).subquery("days")
+
+
+@with_read_session
+def week_grid(db, week_start) -> dict:
+    """Сетка недели одним запросом (движок "sql"): дни × слоты × дорожки, затем по клеткам."""
+    week_end = week_start + timedelta(days=6)
+    days = _week_days(db, week_start)
+    sched = select(TrainerSchedule.day_of_week, TrainerSchedule.timeslot_id).distinct().subquery("sched")
+    flag = lambda col: func.max(case((col.is_not(None), 1), else_=0))
+    # дата × время × дорожка: занята, закрыта, есть ли тренер по расписанию
+    lanes = (
+        select(days.c.date, Timeslot.time, Lane.number.label("lane"),
+               flag(Booking.id).label("booked"), flag(ClosedSlot.id).label("closed"),
+               flag(sched.c.timeslot_id).label("has_trainer"))
+        .select_from(days)
+        .join(Timeslot, true())
+        .join(Lane, Lane.number.between(1, NUM_LANES))
+        .outerjoin(Booking, and_(Booking.date.between(week_start, week_end), Booking.date == days.c.date,
+                                 Booking.timeslot_id == Timeslot.id, Booking.lane_id == Lane.id))
+        .outerjoin(ClosedSlot, and_(ClosedSlot.date.between(week_start, week_end), ClosedSlot.date == days.c.date,
+                                    ClosedSlot.timeslot_id == Timeslot.id, ClosedSlot.lane_id == Lane.id))
+        .outerjoin(sched, and_(sched.c.day_of_week == days.c.dow, sched.c.timeslot_id == Timeslot.id))
+        .group_by(days.c.date, Timeslot.time, Lane.number)
+        .subquery("lanes")
+    )
+    bit = literal(1).op("<<")(lanes.c.lane - 1)
+    rows = db.execute(
+        select(lanes.c.date, lanes.c.time, func.sum(lanes.c.booked * bit), func.sum(lanes.c.closed * bit),
+               func.max(lanes.c.has_trainer))
+        .group_by(lanes.c.date, lanes.c.time)
+    )
+    return {(d, _hhmm(t)): (booked, closed, bool(has_trainer)) for d, t, booked, closed, has_trainer in rows}
+
+
 #  users
 @with_session
 def add_user(db, username: str, password: str,
@@ -62,19 +626,64 @@ def add_user(db, username: str, password: str,
         email=email,
         is_confirmed=is_confirmed
     ))
+    events.publish(db, "users")
     db.commit()
     return True
 
 
 @with_session
 def validate_user(db, username: str, password: str) -> str | None:
-    user = db.query(User).filter_by(username=username).first()
+    user = _user_by_name(db, username)
     return user.role if user and bcrypt.verify(password, user.pwd_hash) else None
 
 
-@with_session
-def list_users(db):
-    users = db.query(User).all()
+@with_read_session
+def get_user(db, username: str) -> dict | None:
+    user = db.query(User.id, User.role, User.is_confirmed).filter_by(username=username).first()
+    if not user:
+        return None
+    return {"id": user.id, "username": username, "role": user.role, "is_confirmed": user.is_confirmed}
+
+
+_USER_SORTS = {
+    "id": User.id,
+    "username": User.username,
+    "last_name": User.last_name,
+    "email": User.email,
+    "role": User.role,
+}
+
+
+def _users_query(db, search=None, role=None, confirmed=None):
+    q = db.query(User)
+    if search:
+        q = q.filter(USER_SEARCH.contains(search.strip().lower(), autoescape=True))
+    if role:
+        q = q.filter(User.role == role)
+    if confirmed is not None:
+        q = q.filter(User.is_confirmed == (1 if confirmed else 0))
+    return q
+
+
+@with_read_session
+def list_users(db, search: str | None = None, role: str | None = None,
+               confirmed: bool | None = None, sort: str = "id",
+               offset: int = 0, limit: int | None = None, as_arrow: bool = False):
+    """sort — ключ из _USER_SORTS, с префиксом «-» для убывания.
+
+    as_arrow=True — pyarrow.Table с колонками USER_ARROW_SCHEMA вместо списка dict.
+    """
+    col = _USER_SORTS.get(sort.lstrip("-"), User.id)
+    q = _users_query(db, search, role, confirmed)
+    q = q.order_by(col.desc() if sort.startswith("-") else col, User.id).offset(offset).limit(limit)
+    if as_arrow:
+        q = q.with_entities(
+            User.id, User.username, User.role, User.first_name, User.last_name,
+            func.coalesce(User.middle_name, ""), func.coalesce(User.phone, ""),
+            func.coalesce(User.gender, ""), User.email, User.is_confirmed,
+        )
+        return _arrow_table(db, q.statement, USER_ARROW_SCHEMA)
+    users = q.all()
     return [{
         "id": u.id,
         "username": u.username,
@@ -89,28 +698,64 @@ def list_users(db):
     } for u in users]
 
 
+@with_read_session
+def count_users(db, search: str | None = None, role: str | None = None,
+                confirmed: bool | None = None) -> int:
+    return _users_query(db, search, role, confirmed).count()
+
+
 @with_session
 def confirm_user(db, user_id: int):
     if (u := db.query(User).filter_by(id=user_id).first()):
         u.is_confirmed = 1
+        events.publish(db, "users")
         db.commit()
 
 
 @with_session
 def remove_user(db, user_id: int):
+    keys = _booking_keys(db, Booking.user_id == user_id)
     db.query(User).filter_by(id=user_id).delete()
+    _touch_occupancy(db, keys)
+    events.publish(db, "users")
     db.commit()
 
 
-#  lanes & timeslots
 @with_session
+def confirm_users(db, user_ids) -> int:
+    if not user_ids:
+        return 0
+    n = db.query(User).filter(
+        User.id.in_(list(user_ids)), User.is_confirmed == 0
+    ).update({User.is_confirmed: 1}, synchronize_session=False)
+    events.publish(db, "users")
+    db.commit()
+    return n
+
+
+@with_session
+def remove_users(db, user_ids) -> int:
+    if not user_ids:
+        return 0
+    keys = _booking_keys(db, Booking.user_id.in_(list(user_ids)))
+    n = db.query(User).filter(
+        User.id.in_(list(user_ids)), User.username != "admin"
+    ).delete(synchronize_session=False)
+    _touch_occupancy(db, keys)
+    events.publish(db, "users")
+    db.commit()
+    return n
+
+
+#  lanes & timeslots
+@with_read_session
 def list_lanes(db):
     return sorted(l.number for l in db.query(Lane).all())
 
 
-@with_session
+@with_read_session
 def list_timeslots(db):
-    return sorted(t.time.strftime("%H:%M") for t in db.query(Timeslot).all())
+    return sorted(_hhmm(t) for (t,) in db.query(Timeslot.time))
 
 
 @with_session
@@ -118,6 +763,7 @@ def add_timeslot(db, time_obj: dt_time) -> bool:
     if db.query(Timeslot).filter_by(time=time_obj).first():
         return False
     db.add(Timeslot(time=time_obj))
+    events.publish(db, "timeslots")
     db.commit()
     return True
 
@@ -126,17 +772,23 @@ def add_timeslot(db, time_obj: dt_time) -> bool:
 def remove_timeslot(db, time_str: str):
     t = datetime.strptime(time_str, "%H:%M").time()
     db.query(Timeslot).filter_by(time=t).delete()
+    events.publish(db, "timeslots")
+    events.publish(db, "schedule")
     db.commit()
 
 
 #  trainers (интерфейс прежний)
-@with_session
+def short_fio(last_name: str, first_name: str, middle_name: str | None) -> str:
+    return f"{last_name} {first_name[0]}.{middle_name[0] + '.' if middle_name else ''}"
+
+
+@with_read_session
 def list_trainers(db, full: bool = False):
     query = db.query(Trainer).all()
     if full:
         return [{
             "name": t.name,
-            "short_fio": f"{t.last_name} {t.first_name[0]}.{t.middle_name[0] + '.' if t.middle_name else ''}",
+            "short_fio": short_fio(t.last_name, t.first_name, t.middle_name),
             "age": t.agebigint,
             "description": t.description,
         } for t in query]
@@ -156,17 +808,22 @@ def add_trainer(db, name: str, first: str, last: str, middle: str,
         agebigint=age,
         description=desc
     ))
+    events.publish(db, "trainers")
     db.commit()
     return True
 
 
 @with_session
 def remove_trainer(db, name: str):
+    keys = _booking_keys(db, Booking.trainer_id.in_(db.query(Trainer.id).filter_by(name=name)))
     db.query(Trainer).filter_by(name=name).delete()
+    _touch_occupancy(db, keys)
+    events.publish(db, "trainers")
+    events.publish(db, "schedule")
     db.commit()
 
 
-@with_session
+@with_read_session
 def get_trainer_by_name(db, name: str):
     t = db.query(Trainer).filter_by(name=name).first()
     if t:
@@ -181,15 +838,35 @@ def get_trainer_by_name(db, name: str):
 
 
 #  trainer schedule
-@with_session
-def list_trainer_schedule(db):
-    sch = db.query(TrainerSchedule).all()
-    return [{
-        "id": s.id,
-        "trainer": s.trainer.name,
-        "day_of_week": s.day_of_week,
-        "time": s.timeslot.time.strftime("%H:%M"),
-    } for s in sch]
+def _trainer_schedule_rows(db, trainer_name=None):
+    q = (
+        db.query(
+            TrainerSchedule.id, TrainerSchedule.day_of_week, Timeslot.time,
+            Trainer.name, Trainer.last_name, Trainer.first_name, Trainer.middle_name,
+        )
+        .join(Trainer, TrainerSchedule.trainer_id == Trainer.id)
+        .join(Timeslot, TrainerSchedule.timeslot_id == Timeslot.id)
+    )
+    if trainer_name:
+        q = q.filter(Trainer.name == trainer_name)
+    return [
+        ScheduleRow(sid, name, short_fio(last, first, middle), dow, _hhmm(t))
+        for sid, dow, t, name, last, first, middle in q.order_by(Timeslot.time, Trainer.last_name)
+    ]
+
+
+@with_read_session
+def list_trainer_schedule(db, trainer_name: str | None = None):
+    return _trainer_schedule_rows(db, trainer_name)
+
+
+@with_read_session
+def get_trainer_schedule_matrix(db, trainer_name: str | None = None):
+    """{(день недели, "HH:MM"): [записи расписания]} — готово для таблицы в админке."""
+    matrix = {}
+    for row in _trainer_schedule_rows(db, trainer_name):
+        matrix.setdefault((row.day_of_week, row.time), []).append(row)
+    return matrix
 
 
 @with_session
@@ -207,41 +884,92 @@ def add_trainer_schedule(db, trainer_name: str, dow: int, time_str: str) -> bool
         timeslot_id=timeslot.id,
         day_of_week=dow
     ))
+    events.publish(db, "schedule")
     db.commit()
     return True
 
 
+@with_session
+def update_trainer_schedule(db, trainer_name: str, days, time_from: str, time_to: str,
+                            mode: str = "add") -> tuple[int, int] | None:
+    """Массовая правка расписания: тренер × дни недели × слоты от time_from до time_to.
+
+    mode: "add" — добавить недостающие, "remove" — удалить попавшие в диапазон,
+    "replace" — в выбранные дни оставить ровно этот диапазон.
+    Возвращает (добавлено, удалено) или None, если тренера нет.
+    """
+    trainer = db.query(Trainer).filter_by(name=trainer_name).first()
+    if not trainer:
+        return None
+    t_from = datetime.strptime(time_from, "%H:%M").time()
+    t_to = datetime.strptime(time_to, "%H:%M").time()
+    slot_ids = [ts_id for (ts_id,) in db.query(Timeslot.id).filter(Timeslot.time.between(t_from, t_to))]
+    days = set(days)
+    wanted = {(d, ts_id) for d in days for ts_id in slot_ids}
+    existing = {
+        (d, ts_id): sid for sid, d, ts_id in db.query(
+            TrainerSchedule.id, TrainerSchedule.day_of_week, TrainerSchedule.timeslot_id
+        ).filter(TrainerSchedule.trainer_id == trainer.id, TrainerSchedule.day_of_week.in_(days))
+    }
+
+    to_add = wanted - existing.keys() if mode in ("add", "replace") else set()
+    if mode == "remove":
+        to_remove = [existing[k] for k in wanted & existing.keys()]
+    elif mode == "replace":
+        to_remove = [sid for k, sid in existing.items() if k not in wanted]
+    else:
+        to_remove = []
+
+    added = _insert_ignore(db, TrainerSchedule, [
+        {"trainer_id": trainer.id, "day_of_week": d, "timeslot_id": ts_id}
+        for d, ts_id in sorted(to_add)
+    ])
+    removed = 0
+    if to_remove:
+        removed = db.query(TrainerSchedule).filter(
+            TrainerSchedule.id.in_(to_remove)
+        ).delete(synchronize_session=False)
+    events.publish(db, "schedule")
+    db.commit()
+    return added, removed
+
+
 @with_session
 def remove_trainer_schedule(db, schedule_id: int):
     db.query(TrainerSchedule).filter_by(id=schedule_id).delete()
+    events.publish(db, "schedule")
     db.commit()
 
 
 #  bookings
+def _lane_closed(db, date, timeslot_id, lane_id) -> bool:
+    return db.execute(_LANE_CLOSED, {"date": date, "timeslot_id": timeslot_id, "lane_id": lane_id}).first() is not None
+
+
 def _booking_exists(db, date, timeslot_id, lane_id=None, trainer_id=None) -> bool:
-    q = db.query(Booking).filter_by(date=date, timeslot_id=timeslot_id)
-    if lane_id is not None:
-        q = q.filter_by(lane_id=lane_id)
-    if trainer_id is not None:
-        q = q.filter_by(trainer_id=trainer_id)
-    return q.first() is not None
+    stmt = _BOOKING_EXISTS[lane_id is not None, trainer_id is not None]
+    params = {"date": date, "timeslot_id": timeslot_id, "lane_id": lane_id, "trainer_id": trainer_id}
+    return db.execute(stmt, params).first() is not None
 
 
-@with_session
+@with_retry_session
 def add_booking(db, username, date, time_str, lane_number, trainer_name=None):
-    user = db.query(User).filter_by(username=username).first()
+    user = _user_by_name(db, username)
     ts = _get_timeslot(db, time_str)
     lane = _get_lane(db, lane_number)
-    trainer = db.query(Trainer).filter_by(name=trainer_name).first() if trainer_name else None
-
-    exists = db.query(Booking).filter_by(
-        user_id=user.id,
-        date=date,
-        timeslot_id=ts.id,
-        lane_id=lane.id,
-        trainer_id=trainer.id if trainer else None
-    ).first()
+    trainer = _trainer_by_name(db, trainer_name) if trainer_name else None
+
+    exists = db.execute(_DUPLICATE_BOOKING, {
+        "user_id": user.id,
+        "date": date,
+        "timeslot_id": ts.id,
+        "lane_id": lane.id,
+        "trainer_id": trainer.id if trainer else None,
+    }).first()
     if exists:
+        # на повторе это наша же бронь: прошлая попытка закоммитила, но не получила ответ
+        return db.info.get("attempt", 1) > 1
+    if _lane_closed(db, date, ts.id, lane.id):
         return False
 
     booking = Booking(
@@ -252,68 +980,242 @@ def add_booking(db, username, date, time_str, lane_number, trainer_name=None):
         trainer_id=trainer.id if trainer else None
     )
     db.add(booking)
+    _touch_occupancy(db, [(date, ts.id)])
     db.commit()
+    metrics.BOOKINGS.labels("single").inc()
     return True
 
 
-@with_session
-def list_user_bookings(db, username):
-    user = db.query(User).filter_by(username=username).first()
-    if not user:
-        return []
-    bookings = db.query(Booking).filter_by(user_id=user.id).all()
-    return [{
-        "id": b.id,
-        "date": b.date,
-        "time": b.timeslot.time.strftime("%H:%M"),
-        "lane": b.lane.number,
-        "trainer": b.trainer.name if b.trainer else "—",
-    } for b in bookings]
+@with_retry_session
+def update_booking(db, booking_id, date, time_str, lane_number, trainer_name=None) -> bool:
+    """Переносит бронь на другой слот/дорожку/тренера.
 
+    False, если брони нет, дорожка закрыта или занята другой бронью, тренер занят.
+    """
+    booking = db.get(Booking, booking_id)
+    if booking is None:
+        return False
+    ts = _get_timeslot(db, time_str)
+    lane = _get_lane(db, lane_number)
+    trainer = _trainer_by_name(db, trainer_name) if trainer_name else None
+    if _lane_closed(db, date, ts.id, lane.id):
+        return False
+    taken = select(Booking.id).where(Booking.id != booking_id, Booking.date == date, Booking.timeslot_id == ts.id)
+    if db.execute(taken.where(Booking.lane_id == lane.id).limit(1)).first():
+        return False
+    if trainer and db.execute(taken.where(Booking.trainer_id == trainer.id).limit(1)).first():
+        return False
 
-@with_session
-def remove_booking(db, booking_id: int):
-    db.query(Booking).filter_by(id=booking_id).delete()
+    keys = {(booking.date, booking.timeslot_id), (date, ts.id)}
+    booking.date, booking.timeslot_id, booking.lane_id = date, ts.id, lane.id
+    booking.trainer_id = trainer.id if trainer else None
+    db.flush()
+    _touch_occupancy(db, sorted(keys))
     db.commit()
+    return True
 
 
-@with_session
-def list_all_bookings_for_date(db, date):
-    bookings = db.query(Booking).filter_by(date=date).all()
-    return [{
-        "id": b.id,
-        "user": b.user.username,
-        "date": b.date,
-        "time": b.timeslot.time.strftime("%H:%M"),
-        "lane": b.lane.number,
-        "trainer": b.trainer.name if b.trainer else "—",
-    } for b in bookings]
+def _booking_query(db, *criteria):
+    """Брони одним запросом с join-ами — без ленивой подгрузки timeslot/lane/trainer на строку."""
+    return (
+        db.query(Booking.id, User.username, Booking.date, Timeslot.time, Lane.number,
+                 func.coalesce(Trainer.name, "—"))
+        .join(User, Booking.user_id == User.id)
+        .join(Timeslot, Booking.timeslot_id == Timeslot.id)
+        .join(Lane, Booking.lane_id == Lane.id)
+        .outerjoin(Trainer, Booking.trainer_id == Trainer.id)
+        .filter(*criteria)
+        .order_by(Booking.date, Timeslot.time, Lane.number)
+    )
+
+
+def _booking_rows(db, *criteria, query=None) -> list[BookingRow]:
+    return [
+        BookingRow(bid, username, d, _hhmm(t), lane, trainer)
+        for bid, username, d, t, lane, trainer in (query if query is not None else _booking_query(db, *criteria))
+    ]
+
+
+MY_HISTORY_PAGE = 20  # прошедших броней за одно «Показать ещё»
+
+
+@with_read_session
+def list_user_bookings(db, username, date_from=None, date_to=None) -> list[BookingRow]:
+    """Брони пользователя за [date_from, date_to] (границы необязательны) по возрастанию.
+
+    Отбор по user_id и дате — по индексу ix_bookings_user_date.
+    """
+    criteria = [Booking.user_id == select(User.id).where(User.username == username).scalar_subquery()]
+    if date_from is not None:
+        criteria.append(Booking.date >= date_from)
+    if date_to is not None:
+        criteria.append(Booking.date <= date_to)
+    return _booking_rows(db, *criteria)
+
+
+@with_read_session
+def list_user_history(db, username, before, limit=MY_HISTORY_PAGE, offset=0) -> list[BookingRow]:
+    """Брони пользователя до даты before, от новых к старым, страница limit с offset."""
+    query = (
+        _booking_query(
+            db,
+            Booking.user_id == select(User.id).where(User.username == username).scalar_subquery(),
+            Booking.date < before,
+        )
+        .order_by(None)
+        .order_by(Booking.date.desc(), Timeslot.time.desc(), Lane.number)
+        .limit(limit)
+        .offset(offset)
+    )
+    return _booking_rows(db, query=query)
+
+
+@with_read_session
+def booking_owner(db, booking_id: int, group: bool = False) -> str | None:
+    """Логин владельца брони (group=True — группового бронирования) или None."""
+    model = OrgBookingGroup if group else Booking
+    row = db.query(User.username).join(model, model.user_id == User.id).filter(model.id == booking_id).first()
+    return row[0] if row else None
+
+
+@with_retry_session
+def remove_booking(db, booking_id: int):
+    keys = _booking_keys(db, Booking.id == booking_id)
+    n = db.query(Booking).filter_by(id=booking_id).delete()
+    _touch_occupancy(db, keys)
+    db.commit()
+    metrics.CANCELLATIONS.labels("single").inc(n)
 
 
 @with_session
+def remove_bookings(db, booking_ids=None, date_from=None, date_to=None) -> int:
+    """Удаляет брони по списку id и/или диапазону дат одним DELETE.
+
+    Групповые бронирования, чьи брони попали под удаление, сужаются или удаляются в той же транзакции.
+    """
+    if booking_ids is None and date_from is None and date_to is None:
+        raise ValueError("remove_bookings: нужен список id или диапазон дат")
+    q = db.query(Booking)
+    if booking_ids is not None:
+        if not booking_ids:
+            return 0
+        q = q.filter(Booking.id.in_(list(booking_ids)))
+    if date_from is not None:
+        q = q.filter(Booking.date >= date_from)
+    if date_to is not None:
+        q = q.filter(Booking.date <= date_to)
+    keys = q.with_entities(Booking.date, Booking.timeslot_id).distinct().all()
+    group_ids = {gid for (gid,) in q.with_entities(Booking.group_id).filter(Booking.group_id.is_not(None)).distinct()}
+    n = q.delete(synchronize_session=False)
+    _shrink_groups(db, group_ids)
+    _touch_occupancy(db, keys)
+    db.commit()
+    return n
+
+
+def _shrink_groups(db, group_ids) -> None:
+    """Групповые бронирования по оставшимся в них броням: времена и дорожки сужаются, пустые удаляются."""
+    if not group_ids:
+        return
+    left = {}
+    rows = (
+        db.query(Booking.group_id, Timeslot.time, Lane.number)
+        .join(Timeslot, Booking.timeslot_id == Timeslot.id)
+        .join(Lane, Booking.lane_id == Lane.id)
+        .filter(Booking.group_id.in_(group_ids))
+    )
+    for gid, t, lane in rows:
+        times, lanes = left.setdefault(gid, (set(), set()))
+        times.add(t)
+        lanes.add(lane)
+    empty = [gid for gid in group_ids if gid not in left]
+    if empty:
+        db.query(OrgBookingGroup).filter(OrgBookingGroup.id.in_(empty)).delete(synchronize_session=False)
+    for gid, (times, lanes) in left.items():
+        times = sorted(times)
+        db.query(OrgBookingGroup).filter_by(id=gid).update({
+            "time": times[0],
+            "times": ",".join(_hhmm(t) for t in times),
+            "lanes": ",".join(str(l) for l in sorted(lanes)),
+        }, synchronize_session=False)
+
+
+@with_read_session
+def list_all_bookings_for_date(db, date, as_arrow: bool = False) -> list[BookingRow] | pa.Table:
+    """as_arrow=True — pyarrow.Table с колонками BOOKING_ARROW_SCHEMA (время — "HH:MM")."""
+    if as_arrow:
+        return _arrow_table(db, _booking_query(db, Booking.date == date).statement, BOOKING_ARROW_SCHEMA)
+    return _booking_rows(db, Booking.date == date)
+
+
+@with_read_session
 def lane_trainer_status(db, date, time_str):
-    ts = _get_timeslot(db, time_str)
-    bks = db.query(Booking).filter_by(date=date, timeslot_id=ts.id).all()
+    t = datetime.strptime(time_str, "%H:%M").time()
+    bks = db.query(Booking).join(Timeslot, Booking.timeslot_id == Timeslot.id).filter(
+        Booking.date == date, Timeslot.time == t
+    ).all()
     lanes = [bk.lane.number for bk in bks]
     trainers = [bk.trainer.name for bk in bks if bk.trainer]
     return lanes, trainers
 
 
-@with_session
+@with_read_session
 def get_scheduled_trainers(db, date, time_str):
-    ts = _get_timeslot(db, time_str)
-    sch = db.query(TrainerSchedule).filter_by(
-        day_of_week=date.weekday(), timeslot_id=ts.id
+    t = datetime.strptime(time_str, "%H:%M").time()
+    sch = db.query(TrainerSchedule).join(Timeslot, TrainerSchedule.timeslot_id == Timeslot.id).filter(
+        TrainerSchedule.day_of_week == date.weekday(), Timeslot.time == t
     ).all()
     return [s.trainer.name for s in sch]
 
 
+@with_read_session
+def get_slot_options(db, date, time_str):
+    """Всё, что нужно формам бронирования для одного слота, за одну сессию."""
+    t = _parse_hhmm(time_str)
+    booked_mask, closed_mask, trainer_ids = _slot_occupancy(db, date, time_str)
+    scheduled = (
+        db.query(Trainer)
+        .join(TrainerSchedule, TrainerSchedule.trainer_id == Trainer.id)
+        .join(Timeslot, TrainerSchedule.timeslot_id == Timeslot.id)
+        .filter(TrainerSchedule.day_of_week == date.weekday(), Timeslot.time == t)
+        .all()
+    )
+
+    busy_lanes = lanes_from_mask(booked_mask)
+    closed_lanes = lanes_from_mask(closed_mask)
+    return {
+        "closed": closed_mask == FULL_LANE_MASK,
+        "closed_lanes": closed_lanes,
+        "busy_lanes": busy_lanes,
+        "free_lanes": lanes_from_mask(FULL_LANE_MASK & ~(booked_mask | closed_mask)),
+        "busy_trainers": sorted(tr.name for tr in scheduled if tr.id in trainer_ids),
+        "trainers": [{
+            "name": tr.name,
+            "short_fio": short_fio(tr.last_name, tr.first_name, tr.middle_name),
+            "first_name": tr.first_name,
+            "last_name": tr.last_name,
+            "middle_name": tr.middle_name or "",
+            "age": tr.agebigint,
+            "description": tr.description,
+            "busy": tr.id in trainer_ids,
+        } for tr in scheduled],
+    }
+
+
 #  групповые бронирования
-@with_session
+@with_retry_session
 def add_org_booking_group(db, username, date, times, lanes):
-    user = db.query(User).filter_by(username=username).first()
+    user = _user_by_name(db, username)
     if not user:
         return False
+    if db.info.get("attempt", 1) > 1 and db.query(OrgBookingGroup.id).filter_by(
+        user_id=user.id, date=date, times=",".join(times), lanes=",".join(str(l) for l in lanes)
+    ).first():
+        return True  # прошлая попытка успела закоммитить
+    lanes_mask = sum(1 << (l - 1) for l in lanes)
+    closed = _closed_masks(db, date, date)
+    if any(closed.get((date, t_str), 0) & lanes_mask for t_str in times):
+        return False
 
     base_ts = _get_timeslot(db, times[0])
     group = OrgBookingGroup(
@@ -328,8 +1230,10 @@ def add_org_booking_group(db, username, date, times, lanes):
     db.flush()
 
     try:
+        keys = []
         for t_str in times:
             ts = _get_timeslot(db, t_str)
+            keys.append((date, ts.id))
             for lane_num in lanes:
                 lane = _get_lane(db, lane_num)
                 db.add(Booking(
@@ -340,48 +1244,78 @@ def add_org_booking_group(db, username, date, times, lanes):
                     trainer_id=None,
                     group_id=group.id
                 ))
+        _touch_occupancy(db, keys)
         db.commit()
+        metrics.BOOKINGS.labels("group").inc()
         return True
-    except Exception:
+    except Exception as e:
         db.rollback()
+        if is_retryable(e):
+            raise
         return False
 
 
-@with_session
-def list_org_booking_groups(db, username):
-    user = db.query(User).filter_by(username=username).first()
+@with_read_session
+def list_org_booking_groups(db, username) -> list[GroupRow]:
+    user = _user_by_name(db, username)
     if not user:
         return []
-    groups = db.query(OrgBookingGroup).filter_by(user_id=user.id).all()
-    return [{
-        "id": g.id,
-        "date": g.date,
-        "times": g.times,
-        "lanes": g.lanes,
-    } for g in groups]
+    rows = db.query(OrgBookingGroup.id, OrgBookingGroup.date, OrgBookingGroup.times, OrgBookingGroup.lanes)
+    return [GroupRow(*r) for r in rows.filter_by(user_id=user.id)]
 
 
-@with_session
+@with_retry_session
 def remove_org_booking_group(db, group_id: int):
+    keys = _booking_keys(db, Booking.group_id == group_id)
     db.query(Booking).filter_by(group_id=group_id).delete()
-    db.query(OrgBookingGroup).filter_by(id=group_id).delete()
+    n = db.query(OrgBookingGroup).filter_by(id=group_id).delete()
+    _touch_occupancy(db, keys)
     db.commit()
+    metrics.CANCELLATIONS.labels("group").inc(n)
 
 
 #  closed slots
-@with_session
-def list_closed_slots(db, date):
-    slots = db.query(ClosedSlot).filter_by(date=date).order_by(ClosedSlot.timeslot_id).all()
-    return [{
-        "id": s.id,
-        "date": s.date,
-        "time": s.timeslot.time.strftime("%H:%M"),
-        "comment": s.comment or "",
-    } for s in slots]
+def lanes_from_mask(mask: int) -> list[int]:
+    return [n for n in range(1, NUM_LANES + 1) if mask >> (n - 1) & 1]
+
+
+def _closed_masks(db, date_from, date_to, time_obj=None) -> dict:
+    """{(дата, "HH:MM"): маска закрытых дорожек} за диапазон дат."""
+    q = (
+        db.query(ClosedSlot.date, Timeslot.time, Lane.number)
+        .join(Timeslot, ClosedSlot.timeslot_id == Timeslot.id)
+        .join(Lane, ClosedSlot.lane_id == Lane.id)
+        .filter(ClosedSlot.date.between(date_from, date_to))
+    )
+    if time_obj is not None:
+        q = q.filter(Timeslot.time == time_obj)
+    masks = {}
+    for d, t, lane in q:
+        key = (d, _hhmm(t))
+        masks[key] = masks.get(key, 0) | 1 << (lane - 1)
+    return masks
+
+
+@with_read_session
+def closed_lane_masks(db, date_from, date_to) -> dict:
+    return {k: closed for k, (_, closed, _) in _week_occupancy(db, date_from, date_to).items() if closed}
+
+
+@with_read_session
+def list_closed_slots(db, date) -> list[ClosedRow]:
+    rows = (
+        db.query(ClosedSlot.id, ClosedSlot.date, Timeslot.time, Lane.number, ClosedSlot.comment)
+        .join(Timeslot, ClosedSlot.timeslot_id == Timeslot.id)
+        .join(Lane, ClosedSlot.lane_id == Lane.id)
+        .filter(ClosedSlot.date == date)
+        .order_by(Timeslot.time, Lane.number)
+    )
+    return [ClosedRow(sid, d, _hhmm(t), lane, comment or "") for sid, d, t, lane, comment in rows]
 
 
 @with_session
-def add_closed_slot(db, date, time_str, comment=None, lane_number=1) -> bool:
+def add_closed_slot(db, date, time_str, comment=None, *, lane_number: int) -> bool:
+    """Закрывает одну дорожку слота; весь слот — close_slots(..., lanes=None)."""
     ts = _get_timeslot(db, time_str)
     lane = _get_lane(db, lane_number)
     if db.query(ClosedSlot).filter_by(date=date, timeslot_id=ts.id, lane_id=lane.id).first():
@@ -393,20 +1327,199 @@ def add_closed_slot(db, date, time_str, comment=None, lane_number=1) -> bool:
         lane_id=lane.id,
         timeslot_id=ts.id
     ))
+    _touch_occupancy(db, [(date, ts.id)])
     db.commit()
     return True
 
 
+def _closure_targets(db, date_from, date_to, time_from, time_to, lanes):
+    t_from = datetime.strptime(time_from, "%H:%M").time()
+    t_to = datetime.strptime(time_to, "%H:%M").time()
+    slots = db.query(Timeslot.id, Timeslot.time).filter(Timeslot.time.between(t_from, t_to)).all()
+    lane_ids = _lane_ids(db, lanes or range(1, NUM_LANES + 1))
+    dates = [date_from + timedelta(days=i) for i in range((date_to - date_from).days + 1)]
+    return dates, slots, lane_ids
+
+
+@with_session
+def close_slots(db, date_from, date_to, time_from: str, time_to: str,
+                lanes=None, comment: str = "") -> dict:
+    """Закрывает даты × слоты × дорожки (по умолчанию все) одним INSERT.
+
+    Возвращает {"added": число новых строк, "collisions": брони, попавшие под закрытие}.
+    """
+    dates, slots, lane_ids = _closure_targets(db, date_from, date_to, time_from, time_to, lanes)
+    added = _insert_ignore(db, ClosedSlot, [
+        {"date": d, "time": t, "timeslot_id": ts_id, "lane_id": lane_id, "comment": comment or ""}
+        for d in dates for ts_id, t in slots for lane_id in lane_ids.values()
+    ])
+    collisions = _booking_rows(
+        db,
+        Booking.date.between(date_from, date_to),
+        Booking.timeslot_id.in_([ts_id for ts_id, _ in slots]),
+        Booking.lane_id.in_(list(lane_ids.values())),
+    )
+    _touch_occupancy(db, [(d, ts_id) for d in dates for ts_id, _ in slots])
+    db.commit()
+    return {"added": added, "collisions": collisions}
+
+
+@with_session
+def open_slots(db, date_from, date_to, time_from: str, time_to: str, lanes=None) -> int:
+    """Снимает закрытия в диапазоне одним DELETE; возвращает число удалённых строк."""
+    dates, slots, lane_ids = _closure_targets(db, date_from, date_to, time_from, time_to, lanes)
+    n = db.query(ClosedSlot).filter(
+        ClosedSlot.date.between(date_from, date_to),
+        ClosedSlot.timeslot_id.in_([ts_id for ts_id, _ in slots]),
+        ClosedSlot.lane_id.in_(list(lane_ids.values())),
+    ).delete(synchronize_session=False)
+    _touch_occupancy(db, [(d, ts_id) for d in dates for ts_id, _ in slots])
+    db.commit()
+    return n
+
+
+def _bookings_in(db, slot_keys):
+    """Брони в слотах [(дата, timeslot_id)]."""
+    if not slot_keys:
+        return []
+    return _booking_rows(db, tuple_(Booking.date, Booking.timeslot_id).in_(slot_keys))
+
+
+@with_read_session
+def bookings_in_slots(db, slots) -> list[BookingRow]:
+    """Брони, которые заденет закрытие слотов [(дата, "HH:MM")]."""
+    ts_ids = _timeslot_ids(db)
+    return _bookings_in(db, [(d, ts_ids[t]) for d, t in slots if t in ts_ids])
+
+
+@with_session
+def apply_closed_changes(db, close=(), reopen=(), comment: str = "") -> dict:
+    """Применяет набор правок календаря одной транзакцией.
+
+    close / reopen — списки (дата, "HH:MM"); закрываются и открываются все дорожки слота.
+    """
+    ts_ids = _timeslot_ids(db)
+    close_keys = [(d, ts_ids[t]) for d, t in close if t in ts_ids]
+    reopen_keys = [(d, ts_ids[t]) for d, t in reopen if t in ts_ids]
+    lane_ids = _lane_ids(db, range(1, NUM_LANES + 1))
+    slot_times = {ts_id: datetime.strptime(t, "%H:%M").time() for t, ts_id in ts_ids.items()}
+
+    added = _insert_ignore(db, ClosedSlot, [
+        {"date": d, "time": slot_times[ts_id], "timeslot_id": ts_id, "lane_id": lane_id, "comment": comment or ""}
+        for d, ts_id in close_keys for lane_id in lane_ids.values()
+    ])
+    removed = 0
+    if reopen_keys:
+        removed = db.query(ClosedSlot).filter(
+            tuple_(ClosedSlot.date, ClosedSlot.timeslot_id).in_(reopen_keys)
+        ).delete(synchronize_session=False)
+    collisions = _bookings_in(db, close_keys)
+    _touch_occupancy(db, close_keys + reopen_keys)
+    db.commit()
+    return {"added": added, "removed": removed, "collisions": collisions}
+
+
 @with_session
 def remove_closed_slot(db, slot_id: int):
+    keys = db.query(ClosedSlot.date, ClosedSlot.timeslot_id).filter_by(id=slot_id).all()
     db.query(ClosedSlot).filter_by(id=slot_id).delete()
+    _touch_occupancy(db, keys)
     db.commit()
 
 
-@with_session
-def is_slot_closed(db, date, time_str) -> bool:
-    ts = _get_timeslot(db, time_str)
-    return db.query(ClosedSlot).filter_by(date=date, timeslot_id=ts.id).first() is not None
+@with_read_session
+def is_slot_closed(db, date, time_str, lane_number: int | None = None) -> bool:
+    """Без lane_number — закрыт ли слот целиком (все дорожки)."""
+    mask = _slot_occupancy(db, date, time_str)[1]
+    if lane_number is None:
+        return mask == FULL_LANE_MASK
+    return bool(mask >> (lane_number - 1) & 1)
+
+#  поиск свободного времени
+def _availability_matrix(db, date_from, date_to, slots, trainer_id=None):
+    """Маски занятых и закрытых дорожек (дни × слоты) и, если задан тренер, его доступность.
+
+    slots — [(timeslot_id, time)] в порядке столбцов. Маски берутся из slot_occupancy одним запросом.
+    """
+    n_days = (date_to - date_from).days + 1
+    col = {ts_id: j for j, (ts_id, _) in enumerate(slots)}
+    booked = np.zeros((n_days, len(slots)), dtype=np.uint16)
+    closed = np.zeros_like(booked)
+    trainer_busy = np.zeros(booked.shape, dtype=bool)
+
+    rows = [
+        r for r in db.query(
+            SlotOccupancy.date, SlotOccupancy.timeslot_id, SlotOccupancy.booked_mask,
+            SlotOccupancy.closed_mask, SlotOccupancy.trainer_ids,
+        ).filter(SlotOccupancy.date.between(date_from, date_to))
+        if r[1] in col
+    ]
+    if rows:
+        d, ts_id, b_mask, c_mask, trainers = zip(*rows)
+        di = np.fromiter(((x - date_from).days for x in d), dtype=np.int64, count=len(d))
+        ti = np.fromiter((col[x] for x in ts_id), dtype=np.int64, count=len(ts_id))
+        booked[di, ti] = b_mask
+        closed[di, ti] = c_mask
+        if trainer_id is not None:
+            tid = str(trainer_id)
+            trainer_busy[di, ti] = [tid in t.split(",") for t in trainers]
+
+    trainer_ok = None
+    if trainer_id is not None:
+        week = np.zeros((7, len(slots)), dtype=bool)
+        for dow, ts_id in db.query(TrainerSchedule.day_of_week, TrainerSchedule.timeslot_id).filter(
+            TrainerSchedule.trainer_id == trainer_id
+        ):
+            if ts_id in col:
+                week[dow, col[ts_id]] = True
+        dows = (np.arange(n_days) + date_from.weekday()) % 7
+        trainer_ok = week[dows] & ~trainer_busy
+    return booked, closed, trainer_ok
+
+
+@with_read_session
+def find_free_slots(db, date_from, date_to, time_from: str | None = None, time_to: str | None = None,
+                    weekdays=None, lanes=None, trainer_name: str | None = None, limit: int = 10):
+    """Ближайшие limit слотов, где свободна хотя бы одна из нужных дорожек (и тренер, если задан)."""
+    q = db.query(Timeslot.id, Timeslot.time)
+    if time_from:
+        q = q.filter(Timeslot.time >= datetime.strptime(time_from, "%H:%M").time())
+    if time_to:
+        q = q.filter(Timeslot.time <= datetime.strptime(time_to, "%H:%M").time())
+    slots = q.order_by(Timeslot.time).all()
+    if not slots or date_from > date_to:
+        return []
+
+    trainer_id = None
+    if trainer_name:
+        trainer_id = db.query(Trainer.id).filter_by(name=trainer_name).scalar()
+        if trainer_id is None:
+            return []
+
+    booked, closed, trainer_ok = _availability_matrix(db, date_from, date_to, slots, trainer_id)
+    wanted = sum(1 << (l - 1) for l in lanes) if lanes else FULL_LANE_MASK
+    free = ~(booked | closed) & wanted
+    ok = free != 0
+    if weekdays is not None:
+        dows = (np.arange(ok.shape[0]) + date_from.weekday()) % 7
+        ok &= np.isin(dows, list(weekdays))[:, None]
+    if trainer_ok is not None:
+        ok &= trainer_ok
+    now = datetime.now()
+    if date_from <= now.date() <= date_to:
+        today = (now.date() - date_from).days
+        ok[:today] = False
+        ok[today] &= np.array([t > now.time() for _, t in slots])
+    elif date_to < now.date():
+        return []
+
+    days, cols = np.nonzero(ok)
+    return [{
+        "date": date_from + timedelta(days=int(d)),
+        "time": _hhmm(slots[c][1]),
+        "lanes": lanes_from_mask(int(free[d, c])),
+        "trainer": trainer_name,
+    } for d, c in zip(days[:limit], cols[:limit])]
 
 @with_session
 def add_slot(db, trainer_name: str, date: str, time_start: str, time_end: str) -> bool:
@@ -424,5 +1537,6 @@ def add_slot(db, trainer_name: str, date: str, time_start: str, time_end: str) -
     if db.query(TrainerSchedule).filter_by(trainer_id=trainer.id, timeslot_id=ts.id, day_of_week=dow).first():
         return False
     db.add(TrainerSchedule(trainer_id=trainer.id, timeslot_id=ts.id, day_of_week=dow))
+    events.publish(db, "schedule")
     db.commit()
     return True
@@ -1,5 +1,6 @@
 import sys
 import os
+import uuid
 import pytest
 
 # Добавить корень проекта в sys.path
@@ -8,7 +9,8 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 from app.db import Base
 from app import utils
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 
 @pytest.fixture(scope="session")
@@ -29,3 +31,24 @@ def session(sqlite_engine):
 @pytest.fixture(autouse=True)
 def patch_session(monkeypatch, session):
     monkeypatch.setattr(utils, "SessionLocal", lambda: session)
+
+
+@pytest.fixture
+def pg_session():
+    """Сессия на свежей базе PostgreSQL (создаётся рядом с TEST_PG_URL и удаляется после теста)."""
+    url = os.environ.get("TEST_PG_URL")
+    if not url:
+        pytest.skip("TEST_PG_URL не задан")
+    admin = create_engine(url, isolation_level="AUTOCOMMIT")
+    name = f"pool_test_{uuid.uuid4().hex[:8]}"
+    with admin.connect() as conn:
+        conn.execute(text(f"CREATE DATABASE {name}"))
+    engine = create_engine(make_url(url).set(database=name))
+    try:
+        with sessionmaker(bind=engine)() as db:
+            yield db
+    finally:
+        engine.dispose()
+        with admin.connect() as conn:
+            conn.execute(text(f"DROP DATABASE {name}"))
+        admin.dispose()
@@ -1,5 +1,5 @@
 from app import utils
-from datetime import date, time
+from datetime import date, time, timedelta
 
 
 def test_add_and_remove_trainer():
@@ -29,11 +29,287 @@ def test_add_and_remove_closed_slot():
     today = date.today()
     slot_time = time(12, 0)
     utils.add_timeslot(slot_time)
-    ok = utils.add_closed_slot(today, "12:00", "тест закрытия")
+    ok = utils.add_closed_slot(today, "12:00", "тест закрытия", lane_number=1)
     assert ok
     closed = utils.list_closed_slots(today)
-    assert any(s["time"] == "12:00" for s in closed)
-    slot_id = [s["id"] for s in closed if s["time"] == "12:00"][0]
+    assert any(s.time == "12:00" for s in closed)
+    slot_id = [s.id for s in closed if s.time == "12:00"][0]
     utils.remove_closed_slot(slot_id)
     closed = utils.list_closed_slots(today)
-    assert all(s["time"] != "12:00" for s in closed)
+    assert all(s.time != "12:00" for s in closed)
+
+def test_list_users_search_and_paging():
+    for i in range(3):
+        utils.add_user(f"pager{i}", "pw", "Page", f"Family{i}", "", f"+7999000000{i}", "male", f"pager{i}@wp.ru")
+    assert utils.count_users(search="PAGER") == 3
+    assert utils.count_users(search="family1") == 1
+    page = utils.list_users(search="pager", sort="-username", offset=1, limit=1)
+    assert [u["username"] for u in page] == ["pager1"]
+    pending = utils.list_users(search="pager", confirmed=False)
+    assert len(pending) == 3 and all(not u["is_confirmed"] for u in pending)
+    assert utils.count_users(search="pager", role="org") == 0
+
+def test_bulk_confirm_and_remove_users():
+    for i in range(3):
+        utils.add_user(f"bulk{i}", "pw", "Bulk", f"User{i}", "", f"+7999111000{i}", "male", f"bulk{i}@wp.ru")
+    ids = [u["id"] for u in utils.list_users(search="bulk")]
+    assert utils.confirm_users(ids) == 3
+    assert utils.count_users(search="bulk", confirmed=False) == 0
+    assert utils.remove_users(ids[:2]) == 2
+    assert [u["username"] for u in utils.list_users(search="bulk")] == ["bulk2"]
+
+def test_remove_bookings_by_ids_and_range():
+    utils.add_user("bulkbooker", "pw", "B", "B", "", "+79992220000", "male", "bulkbooker@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(11, 0))
+    d1, d2 = date(2031, 3, 3), date(2031, 3, 4)
+    for lane in (1, 2, 3):
+        utils.add_booking("bulkbooker", d1, "11:00", lane)
+        utils.add_booking("bulkbooker", d2, "11:00", lane)
+    ids = [b.id for b in utils.list_all_bookings_for_date(d1)][:2]
+    assert utils.remove_bookings(ids) == 2
+    assert len(utils.list_all_bookings_for_date(d1)) == 1
+    assert utils.remove_bookings(date_from=d1, date_to=d2) == 4
+    assert not utils.list_all_bookings_for_date(d2)
+
+
+def test_remove_bookings_updates_org_groups():
+    utils.add_user("bulkorg", "pw", "O", "Rg", "", "+79992220001", "male", "bulkorg@wp.ru",
+                   role="org", org_name="ООО Пловцы", is_confirmed=1)
+    utils.add_timeslot(time(13, 0))
+    utils.add_timeslot(time(14, 0))
+    d1, d2 = date(2031, 3, 10), date(2031, 3, 11)
+    assert utils.add_org_booking_group("bulkorg", d1, ["13:00", "14:00"], [1, 2])
+    assert utils.add_org_booking_group("bulkorg", d2, ["13:00", "14:00"], [1, 2])
+
+    # снята половина брони d1 — группа сужается до 14:00
+    ids = [b.id for b in utils.list_all_bookings_for_date(d1) if b.time == "13:00"]
+    assert utils.remove_bookings(ids) == 2
+    assert [(g.date, g.times, g.lanes) for g in utils.list_org_booking_groups("bulkorg")] == [
+        (d1, "14:00", "1,2"), (d2, "13:00,14:00", "1,2")]
+
+    assert utils.remove_bookings(date_from=d2, date_to=d2) == 4
+    assert [g.date for g in utils.list_org_booking_groups("bulkorg")] == [d1]
+
+def test_trainer_schedule_matrix():
+    utils.add_trainer("Матрица Тренер Первый", "Тренер", "Матрица", "Первый", 40, "Описание")
+    utils.add_trainer("Другой Тренер", "Тренер", "Другой", "", 41, "Описание")
+    utils.add_timeslot(time(13, 0))
+    utils.add_trainer_schedule("Матрица Тренер Первый", 2, "13:00")
+    utils.add_trainer_schedule("Другой Тренер", 2, "13:00")
+    matrix = utils.get_trainer_schedule_matrix()
+    assert {s.short_fio for s in matrix[(2, "13:00")]} >= {"Матрица Т.П.", "Другой Т."}
+    only = utils.get_trainer_schedule_matrix("Другой Тренер")
+    assert all(s.trainer == "Другой Тренер" for rows in only.values() for s in rows)
+    assert (2, "13:00") in only
+
+def test_update_trainer_schedule_bulk():
+    utils.add_trainer("Сезонный Тренер", "Тренер", "Сезонный", "", 30, "Описание")
+    for h in (14, 15, 16):
+        utils.add_timeslot(time(h, 0))
+    assert utils.update_trainer_schedule("Сезонный Тренер", [0, 2], "14:00", "16:00") == (6, 0)
+    # повтор ничего не меняет
+    assert utils.update_trainer_schedule("Сезонный Тренер", [0, 2], "14:00", "16:00") == (0, 0)
+    assert utils.update_trainer_schedule("Сезонный Тренер", [2], "15:00", "16:00", mode="remove") == (0, 2)
+    assert utils.update_trainer_schedule("Сезонный Тренер", [0], "16:00", "16:00", mode="replace") == (0, 2)
+    rows = utils.list_trainer_schedule("Сезонный Тренер")
+    assert sorted((r.day_of_week, r.time) for r in rows) == [(0, "16:00"), (2, "14:00")]
+    assert utils.update_trainer_schedule("Нет Такого", [0], "14:00", "16:00") is None
+
+def test_close_slots_range_and_lanes():
+    utils.add_user("closer", "pw", "C", "C", "", "+79993330000", "male", "closer@wp.ru", is_confirmed=1)
+    for h in (9, 10):
+        utils.add_timeslot(time(h, 0))
+    d1, d2 = date(2032, 5, 3), date(2032, 5, 4)
+    utils.add_booking("closer", d2, "10:00", 2)
+    res = utils.close_slots(d1, d2, "09:00", "10:00", lanes=[2, 3], comment="ремонт")
+    assert res["added"] == 8
+    assert [(c.date, c.time, c.lane) for c in res["collisions"]] == [(d2, "10:00", 2)]
+    assert utils.close_slots(d1, d2, "09:00", "10:00", lanes=[2, 3])["added"] == 0
+
+    assert utils.is_slot_closed(d1, "09:00", 3)
+    assert not utils.is_slot_closed(d1, "09:00", 1)
+    assert not utils.is_slot_closed(d1, "09:00")
+    masks = utils.closed_lane_masks(d1, d2)
+    assert utils.lanes_from_mask(masks[(d1, "10:00")]) == [2, 3]
+    opts = utils.get_slot_options(d1, "09:00")
+    assert opts["closed_lanes"] == [2, 3] and 2 not in opts["free_lanes"]
+
+    assert utils.open_slots(d1, d1, "09:00", "10:00", lanes=[3]) == 2
+    assert utils.lanes_from_mask(utils.closed_lane_masks(d1, d1)[(d1, "09:00")]) == [2]
+    utils.close_slots(d1, d1, "09:00", "09:00")
+    assert utils.is_slot_closed(d1, "09:00")
+
+def test_apply_closed_changes():
+    utils.add_user("stager", "pw", "S", "S", "", "+79994440000", "male", "stager@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(9, 0))
+    utils.add_timeslot(time(10, 0))
+    d = date(2033, 6, 6)
+    utils.add_booking("stager", d, "09:00", 4)
+    preview = utils.bookings_in_slots([(d, "09:00")])
+    assert [(b.user, b.lane) for b in preview] == [("stager", 4)]
+
+    res = utils.apply_closed_changes(close=[(d, "09:00"), (d, "10:00")], comment="staged")
+    assert res["added"] == 2 * utils.NUM_LANES and len(res["collisions"]) == 1
+    assert utils.is_slot_closed(d, "10:00")
+    res = utils.apply_closed_changes(reopen=[(d, "10:00")])
+    assert res["removed"] == utils.NUM_LANES
+    assert not utils.is_slot_closed(d, "10:00", 1)
+    assert utils.is_slot_closed(d, "09:00")
+
+def test_utilization_report():
+    from app import analytics
+    utils.add_user("analyst", "pw", "Ana", "Lyst", "", "+79993330000", "male", "ana@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(11, 0))
+    monday = date(2031, 1, 6)
+    assert utils.add_booking("analyst", monday, "11:00", 3)
+    assert utils.add_booking("analyst", monday, "11:00", 4)
+    utils.add_closed_slot(monday, "11:00", "ремонт", lane_number=6)
+
+    report = analytics.utilization_report(monday, monday + timedelta(days=6))
+    assert report["total"] == 2
+    lanes = report["by_lane"].set_index("lane")
+    assert lanes.loc[3, "bookings"] == 1 and lanes.loc[1, "bookings"] == 0
+    assert lanes.loc[6, "capacity"] == lanes.loc[1, "capacity"] - 1
+    cell = report["heatmap"].query("weekday == 0 and time == '11:00'").iloc[0]
+    assert cell["bookings"] == 2 and cell["capacity"] == utils.NUM_LANES - 1
+    assert report["monthly"]["bookings"].sum() == 2
+
+def test_export_bookings_csv_and_parquet():
+    import io
+    import pyarrow.parquet as pq
+    from app import export
+    utils.add_user("exporter", "pw", "Ex", "Porter", "", "+79993330001", "male", "exp@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(11, 0))
+    day = date(2031, 2, 3)
+    for lane in (1, 2, 3):
+        assert utils.add_booking("exporter", day, "11:00", lane)
+
+    chunks = list(export.iter_export("bookings", "csv", day, day, batch_size=2))
+    assert len(chunks) == 2
+    lines = b"".join(chunks).decode("utf-8-sig").splitlines()
+    assert lines[0].startswith("id,date,time,lane,username")
+    assert [line.split(",")[3] for line in lines[1:]] == ["1", "2", "3"]
+    assert all(",2031-02-03,11:00," in line for line in lines[1:])
+
+    table = pq.read_table(io.BytesIO(b"".join(export.iter_export("bookings", "parquet", day, day, batch_size=2))))
+    assert table.num_rows == 3
+    assert table.column("username").to_pylist() == ["exporter"] * 3
+
+def test_import_bookings_reports_bad_rows():
+    import pandas as pd
+    from app import importer
+    utils.add_user("importer", "pw", "Im", "Porter", "", "+79993330002", "male", "imp@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(11, 0))
+    day = date(2031, 3, 3)
+    assert utils.add_booking("importer", day, "11:00", 1)
+    utils.add_closed_slot(day, "11:00", "ремонт", lane_number=5)
+
+    df = pd.DataFrame({
+        "username": ["importer", "importer", "importer", "nobody", "importer", "importer"],
+        "date": ["2031-03-03", "03.03.2031", "2031-03-03", "2031-03-03", "2031-03-03", "2031-03-03"],
+        "time": ["11:00", "11:00", "11:00", "11:00", "11:00", "11:00"],
+        "lane": ["1", "2", "2", "3", "5", "9"],
+    })
+    report = importer.import_frame("bookings", df)
+    assert report["inserted"] == 1
+    assert report["errors"].set_index("row")["error"].to_dict() == {
+        1: "дорожка уже занята",
+        3: "дорожка повторяется в файле",
+        4: "нет такого пользователя",
+        5: "дорожка закрыта",
+        6: f"дорожка должна быть от 1 до {utils.NUM_LANES}",
+    }
+    assert utils.get_slot_options(day, "11:00")["busy_lanes"] == [1, 2]
+    assert utils.verify_occupancy(day, day) == []
+
+def test_import_users_and_trainers():
+    import io
+    from app import importer
+    users = (
+        "username,password,first_name,last_name,phone,email\n"
+        "imp1,pw,Ivan,Ivanov,+7 999 444-00-01,imp1@wp.ru\n"
+        "imp2,pw,Petr,Petrov,89994440002,imp2@wp.ru\n"
+    )
+    report = importer.import_file("users", io.BytesIO(users.encode()), "csv")
+    assert report["inserted"] == 1
+    assert report["errors"].to_dict("records") == [{"row": 2, "error": "некорректный телефон"}]
+    assert utils.validate_user("imp1", "pw") == "user"
+
+    trainers = "name,first_name,last_name,age\nТренер Импорт,Имя,Фамилия,30\nТренер Импорт,Имя,Фамилия,31\n"
+    report = importer.import_file("trainers", io.BytesIO(trainers.encode()), "csv")
+    assert report["inserted"] == 1 and len(report["errors"]) == 1
+    assert utils.get_trainer_by_name("Тренер Импорт")["age"] == 30
+
+
+def test_arrow_listings():
+    utils.add_user("arrowuser", "pw", "Стрела", "Арроу", "", "+79990003344", "male", "arrow@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(11, 0))
+    d = date(2033, 3, 3)
+    utils.add_booking("arrowuser", d, "11:00", 4)
+
+    users = utils.list_users(search="arrowuser", as_arrow=True)
+    assert users.schema == utils.USER_ARROW_SCHEMA
+    assert users.to_pylist() == utils.list_users(search="arrowuser")
+
+    table = utils.list_all_bookings_for_date(d, as_arrow=True)
+    assert table.column_names == ["id", "user", "date", "time", "lane", "trainer"]
+    assert table.to_pylist() == [b._asdict() for b in utils.list_all_bookings_for_date(d)]
+    assert utils.list_all_bookings_for_date(d + timedelta(days=1), as_arrow=True).num_rows == 0
+
+
+def test_arrow_listings_copy_path(monkeypatch, pg_session):
+    from app import db
+    db.migrate(pg_session.get_bind())
+    monkeypatch.setattr(utils, "SessionLocal", lambda: pg_session)
+    utils.add_user("arrowpg", "pw", "Стрела", "Арроу", "", "+79990003355", "male", "arrowpg@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(11, 0))
+    utils.add_trainer("Тренер, \"Стрела\"", "С", "С", "", 30, "")
+    d = date.today()
+    assert utils.add_booking("arrowpg", d, "11:00", 4, "Тренер, \"Стрела\"")
+    assert utils.add_booking("arrowpg", d, "11:00", 2)
+
+    calls = []
+    monkeypatch.setattr(utils, "_arrow_table_copy",
+                        lambda *a, _f=utils._arrow_table_copy: calls.append(1) or _f(*a))
+    users = utils.list_users(search="arrowpg", as_arrow=True)
+    assert users.schema == utils.USER_ARROW_SCHEMA
+    assert users.to_pylist() == utils.list_users(search="arrowpg")
+    assert users.column("middle_name").to_pylist() == [""]
+    table = utils.list_all_bookings_for_date(d, as_arrow=True)
+    assert table.to_pylist() == [b._asdict() for b in utils.list_all_bookings_for_date(d)]
+    assert calls == [1, 1]
+
+
+def test_legacy_closures_expand_to_all_lanes():
+    from sqlalchemy import create_engine, text
+    from app import db
+
+    engine = create_engine("sqlite://")
+    db.Base.metadata.create_all(engine)
+    d = "2031-02-03"
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO lanes (id, number, name) VALUES (10, 1, 'a'), (11, 2, 'b'), (12, 3, 'c')"))
+        conn.execute(text("INSERT INTO timeslots (id, time) VALUES (1, '09:00:00'), (2, '10:00:00')"))
+        # старая запись «слот закрыт» (дорожка 1) и новая — закрыты дорожки 1 и 3
+        conn.execute(text(f"INSERT INTO closed_slots (date, time, comment, lane_id, timeslot_id) VALUES "
+                          f"('{d}', '09:00:00', 'ремонт', 10, 1), ('{d}', '10:00:00', '', 10, 2), "
+                          f"('{d}', '10:00:00', '', 12, 2)"))
+        conn.execute(text(f"INSERT INTO slot_occupancy (date, timeslot_id, booked_mask, closed_mask, trainer_ids) "
+                          f"VALUES ('{d}', 1, 0, 1, ''), ('{d}', 2, 0, 5, '')"))
+
+    assert db.apply_data_migrations(engine) == ["closed_slots_all_lanes"]
+    assert db.apply_data_migrations(engine) == []
+    with engine.connect() as conn:
+        masks = dict(conn.execute(text("SELECT timeslot_id, closed_mask FROM slot_occupancy")).all())
+        comments = conn.execute(text("SELECT DISTINCT comment FROM closed_slots WHERE timeslot_id = 1")).scalars()
+        assert masks == {1: 0b111, 2: 0b101} and list(comments) == ["ремонт"]
+    engine.dispose()
+
+
+def test_booking_rejected_on_closed_lane():
+    utils.add_user("closer", "pw", "C", "L", "", "+79990004455", "male", "closer@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(16, 0))
+    d = date(2031, 2, 4)
+    assert utils.add_closed_slot(d, "16:00", "соревнования", lane_number=3)
+    assert not utils.add_booking("closer", d, "16:00", 3)
+    assert utils.add_booking("closer", d, "16:00", 4)
@@ -0,0 +1,117 @@
+import asyncio
+import json
+from concurrent.futures import Executor, Future
+from datetime import date, time
+
+import pytest
+
+from app import api, utils
+
+
+class _InlineExecutor(Executor):
+    """Запросы к БД в том же потоке — тестовая SQLite-сессия не переносит другие потоки."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+@pytest.fixture(autouse=True)
+def inline_db(monkeypatch):
+    monkeypatch.setattr(api, "_db_pool", _InlineExecutor())
+    api._availability.clear()
+
+
+def call(method, path, body=None, token=None, headers=()):
+    """Один запрос к ASGI-приложению в процессе: (статус, заголовки, JSON или None)."""
+    path, _, query = path.partition("?")
+    raw_headers = [(k.encode(), v.encode()) for k, v in headers]
+    if token:
+        raw_headers.append((b"authorization", f"Bearer {token}".encode()))
+    scope = {"type": "http", "method": method, "path": path,
+             "query_string": query.encode(), "headers": raw_headers}
+    messages = [{"type": "http.request", "body": json.dumps(body).encode() if body else b""}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(api.app(scope, receive, send))
+    status = sent[0]["status"]
+    resp_headers = {k.decode(): v.decode() for k, v in sent[0]["headers"]}
+    payload = sent[1]["body"]
+    return status, resp_headers, json.loads(payload) if payload else None
+
+
+def test_api_booking_flow():
+    utils.add_user("apiuser", "pw", "Api", "User", "", "+79990000001", "male", "api@wp.ru", is_confirmed=1)
+    utils.add_user("apiother", "pw", "Api", "Other", "", "+79990000002", "male", "api2@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(15, 0))
+    d = date(2032, 5, 3)  # понедельник
+
+    assert call("POST", "/api/login", {"username": "apiuser", "password": "bad"})[0] == 401
+    assert call("GET", "/api/my/bookings")[0] == 401
+    status, _, data = call("POST", "/api/login", {"username": "apiuser", "password": "pw"})
+    assert status == 200
+    token = data["token"]
+    other = call("POST", "/api/login", {"username": "apiother", "password": "pw"})[2]["token"]
+
+    status, headers, week = call("GET", "/api/availability?week=2032-05-05")
+    assert status == 200 and week["week"] == "2032-05-03"
+    etag = headers["etag"]
+    assert call("GET", "/api/availability?week=2032-05-03", headers=[("if-none-match", etag)])[0] == 304
+
+    body = {"date": d.isoformat(), "time": "15:00", "lane": 3}
+    assert call("POST", "/api/bookings", body, token)[0] == 200
+    assert call("POST", "/api/bookings", body, other)[0] == 409
+
+    # бронь сбросила кэш недели — старый ETag больше не подходит
+    status, headers, week = call("GET", "/api/availability?week=2032-05-03",
+                                 headers=[("if-none-match", etag)])
+    assert status == 200 and headers["etag"] != etag
+    slot = week["times"].index("15:00")
+    assert week["days"][0]["booked"][slot] == 1 << 2
+
+    bookings = call("GET", "/api/my/bookings", token=token)[2]["bookings"]
+    mine = [b for b in bookings if b["date"] == d.isoformat()]
+    assert len(mine) == 1 and mine[0]["lane"] == 3
+    assert call("DELETE", f"/api/bookings/{mine[0]['id']}", token=other)[0] == 404
+    assert call("DELETE", f"/api/bookings/{mine[0]['id']}", token=token)[0] == 200
+    assert call("GET", "/api/slot?date=2032-05-03&time=15:00", token=token)[2]["free_lanes"] == [1, 2, 3, 4, 5, 6]
+
+
+def test_api_rejects_unknown_slots_and_bad_lists():
+    utils.add_user("apiorg", "pw", "Api", "Org", "", "+79990000003", "male", "apiorg@wp.ru",
+                   role="org", org_name="ООО Api", is_confirmed=1)
+    utils.add_timeslot(time(15, 0))
+    token = call("POST", "/api/login", {"username": "apiorg", "password": "pw"})[2]["token"]
+    d = date(2032, 5, 4).isoformat()
+    before = utils.list_timeslots()
+
+    # время, которого нет в расписании, не заводит новый слот
+    assert call("POST", "/api/bookings", {"date": d, "time": "03:17", "lane": 2}, token)[0] == 400
+    assert call("POST", "/api/groups", {"date": d, "times": ["23:59"], "lanes": [1]}, token)[0] == 400
+    assert utils.list_timeslots() == before
+
+    for body in ({"times": "15:00", "lanes": [1]}, {"times": ["25:99"], "lanes": [1]},
+                 {"times": ["15:00"], "lanes": ["x"]}, {"times": [None], "lanes": [1]}):
+        status, _, data = call("POST", "/api/groups", {"date": d, **body}, token)
+        assert status == 400 and "error" in data
+    assert utils.list_timeslots() == before
+
+
+def test_api_write_keeps_other_callers_on_replicas(monkeypatch):
+    monkeypatch.setattr(utils, "_sticky_until", {})
+    utils.add_user("apisticky", "pw", "Api", "Sticky", "", "+79990000004", "male", "sticky@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(15, 0))
+    utils._sticky_until.clear()
+    token = call("POST", "/api/login", {"username": "apisticky", "password": "pw"})[2]["token"]
+    body = {"date": date(2032, 5, 5).isoformat(), "time": "15:00", "lane": 1}
+    assert call("POST", "/api/bookings", body, token)[0] == 200
+    # запись пометила только этого вызывающего, общий ключ процесса не тронут
+    assert "api:apisticky" in utils._sticky_until and None not in utils._sticky_until
+    assert utils.caller_key.get() is None
@@ -15,11 +15,11 @@ def test_user_booking_and_cancel():
     ok = utils.add_booking(username, today, time_str, 1, trainer)
     assert ok
     bookings = utils.list_user_bookings(username)
-    assert any(b["trainer"] == trainer for b in bookings)
-    booking_id = [b["id"] for b in bookings if b["trainer"] == trainer][0]
+    assert any(b.trainer == trainer for b in bookings)
+    booking_id = [b.id for b in bookings if b.trainer == trainer][0]
     utils.remove_booking(booking_id)
     bookings = utils.list_user_bookings(username)
-    assert all(b["trainer"] != trainer for b in bookings)
+    assert all(b.trainer != trainer for b in bookings)
 
 def test_double_booking():
     username, trainer, time_str = setup_user_trainer_schedule()
@@ -56,4 +56,118 @@ def test_group_org_booking():
     ok = utils.add_org_booking_group("orguser", today, ["09:00", "10:00"], [1, 2])
     assert ok
     groups = utils.list_org_booking_groups("orguser")
-    assert any(g["date"] == today for g in groups)
+    assert any(g.date == today for g in groups)
+
+
+def test_get_slot_options():
+    username, trainer, time_str = setup_user_trainer_schedule()
+    monday = date(2030, 1, 7)
+    utils.add_booking(username, monday, time_str, 3, trainer)
+    opts = utils.get_slot_options(monday, time_str)
+    assert 3 in opts["busy_lanes"]
+    assert 3 not in opts["free_lanes"]
+    assert trainer in opts["busy_trainers"]
+    assert any(t["name"] == trainer and t["busy"] for t in opts["trainers"])
+    assert not opts["closed"]
+
+
+def test_find_free_slots():
+    username, trainer, time_str = setup_user_trainer_schedule()
+    utils.add_timeslot(time(11, 0))
+    monday = date(2034, 1, 2)
+    for lane in range(1, 7):
+        utils.add_booking(username, monday, "10:00", lane)
+    utils.close_slots(monday, monday, "11:00", "11:00", lanes=[1, 2, 3])
+
+    found = utils.find_free_slots(monday, monday, "10:00", "11:00", limit=5)
+    assert [(s["date"], s["time"]) for s in found] == [(monday, "11:00")]
+    assert found[0]["lanes"] == [4, 5, 6]
+    assert utils.find_free_slots(monday, monday, "11:00", "11:00", lanes=[1, 2]) == []
+
+    # тренер работает только по понедельникам в 10:00, а 02.01 он уже занят
+    with_trainer = utils.find_free_slots(monday, date(2034, 1, 16), trainer_name=trainer, limit=2)
+    assert [(s["date"], s["time"]) for s in with_trainer] == [(date(2034, 1, 9), "10:00"), (date(2034, 1, 16), "10:00")]
+    tuesdays = utils.find_free_slots(monday, date(2034, 1, 16), "10:00", "10:00", weekdays=[1])
+    assert [s["date"] for s in tuesdays] == [date(2034, 1, 3), date(2034, 1, 10)]
+
+
+def test_slot_occupancy_maintained():
+    username, trainer, time_str = setup_user_trainer_schedule()
+    d = date(2035, 2, 5)
+    utils.add_booking(username, d, time_str, 1, trainer)
+    utils.add_booking(username, d, time_str, 4)
+    utils.close_slots(d, d, time_str, time_str, lanes=[6])
+    occ = utils.week_occupancy(d, d)
+    booked, closed, trainers = occ[(d, time_str)]
+    assert utils.lanes_from_mask(booked) == [1, 4]
+    assert utils.lanes_from_mask(closed) == [6]
+    assert len(trainers) == 1
+
+    ids = [b.id for b in utils.list_all_bookings_for_date(d)]
+    utils.remove_booking(ids[0])
+    utils.open_slots(d, d, time_str, time_str)
+    booked, closed, trainers = utils.week_occupancy(d, d)[(d, time_str)]
+    assert utils.lanes_from_mask(booked) == [4] and closed == 0 and not trainers
+    assert utils.verify_occupancy(d, d) == []
+
+    # дрейф: удаление мимо utils — verify замечает, rebuild чинит
+    from app.db import Booking
+    db = utils.SessionLocal()
+    db.query(Booking).filter(Booking.date == d).delete()
+    db.commit()
+    assert len(utils.verify_occupancy(d, d)) == 1
+    utils.rebuild_occupancy(d, d)
+    assert utils.verify_occupancy(d, d) == []
+    assert (d, time_str) not in utils.week_occupancy(d, d)
+
+
+def test_user_bookings_window_and_history():
+    utils.add_user("pager", "pw", "Pa", "Ger", "", "+79990007788", "male", "pager@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(11, 0))
+    days = [date(2030, 3, d) for d in range(1, 8)]
+    for d in days:
+        assert utils.add_booking("pager", d, "11:00", 2)
+
+    week = utils.list_user_bookings("pager", date(2030, 3, 4), date(2030, 3, 6))
+    assert [b.date.day for b in week] == [4, 5, 6]
+    assert [b.date.day for b in utils.list_user_bookings("pager", date(2030, 3, 6))] == [6, 7]
+
+    first = utils.list_user_history("pager", date(2030, 3, 6), limit=3)
+    assert [b.date.day for b in first] == [5, 4, 3]
+    rest = utils.list_user_history("pager", date(2030, 3, 6), limit=3, offset=3)
+    assert [b.date.day for b in rest] == [2, 1]
+
+
+def test_week_grid_engines_agree():
+    username, trainer, time_str = setup_user_trainer_schedule()
+    utils.add_timeslot(time(12, 0))
+    week = date(2030, 6, 3)  # понедельник
+    assert utils.add_booking(username, week, time_str, 2, trainer)
+    assert utils.add_booking(username, date(2030, 6, 5), "12:00", 6)
+    assert utils.add_closed_slot(week, time_str, "ремонт", lane_number=4)
+
+    grid = utils.week_grid(week)
+    assert grid[week, time_str] == (0b000010, 0b001000, True)
+    assert grid[date(2030, 6, 5), "12:00"] == (0b100000, 0, False)
+    assert grid[date(2030, 6, 9), time_str] == (0, 0, False)  # в воскресенье тренера нет
+
+    times = utils.list_timeslots()
+    python_grid = utils.assemble_week_grid(
+        week, times, utils.week_occupancy(week, date(2030, 6, 9)), utils.get_trainer_schedule_matrix()
+    )
+    assert grid == python_grid and len(grid) == 7 * len(times)
+
+
+def test_update_booking_respects_closed_and_busy_lanes():
+    username, trainer, time_str = setup_user_trainer_schedule()
+    d = date(2030, 9, 2)
+    assert utils.add_booking(username, d, time_str, 1, trainer)
+    assert utils.add_booking(username, d, time_str, 2)
+    assert utils.add_closed_slot(d, time_str, "ремонт", lane_number=3)
+    booking = [b for b in utils.list_user_bookings(username, d, d) if b.lane == 1][0]
+
+    assert not utils.update_booking(booking.id, d, time_str, 3, trainer)  # закрыта
+    assert not utils.update_booking(booking.id, d, time_str, 2, trainer)  # занята другой бронью
+    assert utils.update_booking(booking.id, d, time_str, 4, None)
+    assert sorted(b.lane for b in utils.list_user_bookings(username, d, d)) == [2, 4]
+    assert utils.week_occupancy(d, d)[d, time_str][0] == 0b1010
@@ -1,3 +1,5 @@
+import pytest
+
 from app import utils
 
 
@@ -36,3 +38,260 @@ def test_add_duplicate_user():
         "dupl", "pass2", "Имя2", "Фам2", "", "+78889997777", "male", "dupl@t.ru"
     )
     assert fail is False
+
+def test_archive_boundary_and_sqlite_fallback(session):
+    from datetime import date
+    from app import db
+    boundary = db.archive_boundary(0)
+    assert boundary == date.today().replace(day=1)
+    older = db.archive_boundary(14)
+    assert older.day == 1 and (boundary.year - older.year) * 12 + boundary.month - older.month == 14
+    # на SQLite нет секций: архивировать нечего, история читается из самой таблицы
+    assert db.archive_partitions(engine=session.get_bind()) == []
+    assert db.history_model(session, db.Booking, date(2000, 1, 1)) is db.Booking
+
+def test_history_without_archive_run(pg_session):
+    from datetime import date, timedelta
+    from sqlalchemy import func, select
+    from app import db
+    engine = pg_session.get_bind()
+    db.migrate(engine)
+    # archive_partitions ни разу не запускался: история до горизонта читается из пустого архива
+    for model in (db.Booking, db.ClosedSlot):
+        assert pg_session.scalar(select(func.count()).select_from(db.history_model(pg_session, model))) == 0
+        early = db.archive_boundary() - timedelta(days=1)
+        assert pg_session.scalar(select(func.count()).select_from(db.history_model(pg_session, model, early))) == 0
+    assert db.history_model(pg_session, db.Booking, date.today()) is db.Booking
+
+def test_read_replica_routing(monkeypatch):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app.db import Base, Trainer
+    replica = create_engine("sqlite://")
+    Base.metadata.create_all(replica)
+    with sessionmaker(bind=replica)() as db:
+        db.add(Trainer(name="Только на реплике", first_name="Р", last_name="Р", middle_name="",
+                       agebigint=30, description=""))
+        db.commit()
+    monkeypatch.setattr(utils, "ReplicaSessions", [sessionmaker(bind=replica)])
+    monkeypatch.setattr(utils, "_sticky_until", {})
+    monkeypatch.setattr(utils, "_replica_down", {})
+
+    assert utils.list_trainers() == ["Только на реплике"]
+    # запись на primary: эта же сессия какое-то время читает с primary
+    assert utils.add_trainer("Тренер Primary", "П", "П", "", 30, "")
+    assert "Тренер Primary" in utils.list_trainers()
+    utils._sticky_until.clear()
+    assert utils.list_trainers() == ["Только на реплике"]
+
+    # недоступная реплика: чтение уходит на primary, реплика помечается как упавшая
+    broken = create_engine("sqlite:////nonexistent/dir/replica.db")
+    monkeypatch.setattr(utils, "ReplicaSessions", [sessionmaker(bind=broken)])
+    assert "Тренер Primary" in utils.list_trainers()
+    assert 0 in utils._replica_down
+
+    # пул реплики исчерпан: чтение тоже уходит на primary, но реплика остаётся в ротации
+    from sqlalchemy.pool import QueuePool
+    busy = create_engine("sqlite://", poolclass=QueuePool, pool_size=1, max_overflow=0, pool_timeout=0.01)
+    monkeypatch.setattr(utils, "ReplicaSessions", [sessionmaker(bind=busy)])
+    utils._replica_down.clear()
+    with busy.connect():
+        assert "Тренер Primary" in utils.list_trainers()
+    assert 0 not in utils._replica_down
+
+def test_events_dispatched_after_commit(monkeypatch):
+    from datetime import date, time
+    from app import events
+    monkeypatch.setattr(events, "_handlers", {})
+    got = []
+    events.subscribe("occupancy")(lambda weeks: got.append(("occupancy", weeks)))
+    events.subscribe("trainers")(lambda weeks: got.append(("trainers", weeks)))
+
+    utils.add_timeslot(time(13, 0))
+    utils.add_closed_slot(date(2031, 4, 3), "13:00", "событие", lane_number=2)
+    assert got == [("occupancy", ["2031-03-31"])]
+    assert utils.add_trainer("Тренер Событие", "С", "С", "", 30, "")
+    assert got[-1] == ("trainers", None)
+
+    # откат транзакции — событий нет
+    got.clear()
+    with utils.SessionLocal() as db:
+        events.publish(db, "occupancy", [date(2031, 4, 3)])
+        db.rollback()
+    assert got == []
+
+
+def test_prebuilt_lookups(session):
+    from datetime import date, time
+    utils.add_user("lookup", "pw", "L", "L", "", "+79990004455", "male", "lookup@wp.ru", is_confirmed=1)
+    utils.add_trainer("Тренер Поиск", "П", "П", "", 30, "")
+    utils.add_timeslot(time(17, 0))
+    d = date(2031, 6, 2)
+    assert utils.add_booking("lookup", d, "17:00", 5, "Тренер Поиск")
+    assert not utils.add_booking("lookup", d, "17:00", 5, "Тренер Поиск")
+
+    ts_id, lane_id = utils._get_timeslot(session, "17:00").id, utils._get_lane(session, 5).id
+    trainer_id = utils._trainer_by_name(session, "Тренер Поиск").id
+    assert utils._user_by_name(session, "lookup").email == "lookup@wp.ru"
+    assert utils._booking_exists(session, d, ts_id)
+    assert utils._booking_exists(session, d, ts_id, lane_id, trainer_id)
+    assert not utils._booking_exists(session, d, ts_id, utils._get_lane(session, 6).id)
+    assert not utils._booking_exists(session, d, ts_id, trainer_id=trainer_id + 1)
+    assert utils._slot_occupancy(session, d, "17:00") == (1 << 4, 0, {trainer_id})
+
+
+def test_retry_session_repeats_transient_errors(monkeypatch):
+    from datetime import date, time
+    from sqlalchemy.exc import IntegrityError, OperationalError
+    monkeypatch.setattr(utils, "RETRY_WAIT_MAX", 0)
+    attempts = []
+
+    @utils.with_retry_session
+    def flaky(db, fail_times, error=OperationalError, message="database is locked"):
+        attempts.append(db.info["attempt"])
+        if len(attempts) <= fail_times:
+            raise error("COMMIT", {}, Exception(message))
+        return "ok"
+
+    assert flaky(2) == "ok" and attempts == [1, 2, 3]
+    attempts.clear()
+    with pytest.raises(OperationalError):
+        flaky(10)
+    assert attempts == list(range(1, utils.RETRY_ATTEMPTS + 1))
+    attempts.clear()
+    with pytest.raises(IntegrityError):  # не временная — без повторов
+        flaky(1, IntegrityError, "UNIQUE constraint failed")
+    assert attempts == [1]
+
+    # повтор после потерянного ответа на COMMIT: бронь уже есть — это успех, дубля нет
+    utils.add_user("retry", "pw", "R", "R", "", "+79990005566", "male", "retry@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(18, 0))
+    d = date(2031, 7, 7)
+    real_commit = utils.Session.commit
+    lost = []
+
+    def commit_then_drop(self):
+        real_commit(self)
+        if not lost:
+            lost.append(1)
+            raise OperationalError("COMMIT", {}, Exception("server closed the connection"),
+                                   connection_invalidated=True)
+
+    monkeypatch.setattr(utils.Session, "commit", commit_then_drop)
+    assert utils.add_booking("retry", d, "18:00", 2)
+    monkeypatch.setattr(utils.Session, "commit", real_commit)
+    assert len([b for b in utils.list_user_bookings("retry") if b.date == d]) == 1
+
+
+def test_json_log_lines():
+    import json
+    import logging
+    import queue
+    from app import logs
+
+    q = queue.SimpleQueue()
+    handler = logs.ContextQueueHandler(q)
+    logger = logging.getLogger("test_json_log_lines")
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        logger.warning("бронь %s", 42, extra={"user": "vasya", "duration_ms": 1.5})
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception("сбой")
+    finally:
+        logger.removeHandler(handler)
+
+    formatter = logs.JsonFormatter()
+    first, second = (json.loads(formatter.format(q.get_nowait())) for _ in range(2))
+    assert first["msg"] == "бронь 42" and first["level"] == "WARNING"
+    assert first["user"] == "vasya" and first["duration_ms"] == 1.5
+    assert second["msg"] == "сбой" and "ZeroDivisionError" in second["exc"]
+
+
+def test_log_sessions_are_pruned(monkeypatch):
+    from types import SimpleNamespace
+    from app import logs
+
+    monkeypatch.setattr(logs, "_sessions", {f"old{i}": (0.0, {}) for i in range(3)})
+    monkeypatch.setattr(logs, "MAX_SESSIONS", 2)
+    monkeypatch.setattr(logs, "SESSION_TTL", 1.0)
+    monkeypatch.setattr(logs, "get_script_run_ctx", lambda suppress_warning=False: SimpleNamespace(session_id="live"))
+    logs.bind(user="vasya")
+    assert list(logs._sessions) == ["live"] and logs._sessions["live"][1]["user"] == "vasya"
+
+
+def test_metrics_counters():
+    from datetime import date, time
+    from prometheus_client import REGISTRY
+    from app import metrics
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    booked = sample("waterpool_bookings_total", kind="single")
+    calls = sample("waterpool_db_call_seconds_count", function="add_booking")
+    utils.add_user("metric", "pw", "M", "M", "", "+79990006677", "male", "metric@wp.ru", is_confirmed=1)
+    utils.add_timeslot(time(19, 0))
+    assert utils.add_booking("metric", date(2031, 8, 4), "19:00", 1)
+    assert sample("waterpool_bookings_total", kind="single") == booked + 1
+    assert sample("waterpool_db_call_seconds_count", function="add_booking") == calls + 1
+
+    runs = []
+
+    @metrics.cached("test_square", ttl=60)
+    def square(x):
+        runs.append(x)
+        return x * x
+
+    square.clear()
+    assert [square(3), square(3), square(4)] == [9, 9, 16] and runs == [3, 4]
+    assert sample("waterpool_cache_requests_total", cache="test_square") == 3
+    assert sample("waterpool_cache_misses_total", cache="test_square") == 2
+
+
+def test_pool_hold_and_admission(monkeypatch):
+    import threading
+    from prometheus_client import REGISTRY
+    from sqlalchemy import create_engine, text
+    from app import metrics
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine, "test_hold", leak_seconds=0)
+    leaks = sample("waterpool_db_pool_long_holds_total", function="slow_report")
+    with metrics.db_call("slow_report"), engine.connect() as conn:
+        conn.execute(text("select 1"))
+    assert sample("waterpool_db_pool_hold_seconds_count", function="slow_report") >= 1
+    assert sample("waterpool_db_pool_long_holds_total", function="slow_report") == leaks + 1
+    engine.dispose()
+
+    # одно место в очереди отчётов: второй отчёт ждёт report_wait и отклоняется
+    monkeypatch.setattr(utils, "_low_priority", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(utils, "LOW_PRIORITY_WAIT", 0.01)
+    shed = sample("waterpool_admission_shed_total", function="test_report")
+    with utils.admit("test_report"):
+        with pytest.raises(utils.Overloaded):
+            with utils.admit("test_report"):
+                pass
+    with utils.admit("test_report"):
+        pass
+    assert sample("waterpool_admission_shed_total", function="test_report") == shed + 1
+
+    monkeypatch.setattr(utils, "_pool_load", lambda: 1.0)
+    with pytest.raises(utils.Overloaded):
+        with utils.admit("test_report"):
+            pass
+
+def test_metrics_port_per_process(monkeypatch):
+    from app import metrics
+    started = []
+    monkeypatch.setattr(metrics, "start_http_server", lambda port, addr: started.append(port))
+    monkeypatch.setattr(metrics, "_server_started", False)
+    monkeypatch.setenv(metrics.PORT_ENV, "9131")
+    assert metrics.start_server(metrics.DEFAULT_API_PORT)
+    assert metrics.start_server()  # второй вызов в том же процессе ничего не запускает
+    assert started == [9131]